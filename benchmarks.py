@@ -0,0 +1,236 @@
+"""benchmarks
+Do the transforms actually make anything faster?
+
+testing.py checks that the transforms do the right thing, this
+checks that they are worth doing.  Each workload below is timed
+undecorated and with each transform (in a fresh copy of this module
+so they don't step on each other) using LittleTimer.compare, which
+runs the trials round robin and gives us a speedup and a p-value.
+
+python benchmarks.py --out results.json
+python benchmarks.py --baseline results.json   # exits 1 on a regression
+
+A regression is a speedup that fell more than --tolerance below the
+baseline's, or a transform that makes a workload significantly slower
+than leaving it alone.
+"""
+
+import math
+
+# A DEBUG that works for both @smartdebug ("if DEBUG:") and
+# @debuggable (DEBUG(...) calls): it's false, and calling it does nothing
+class Debug:
+    def __call__(self,*args):
+        return
+    def __nonzero__(self):
+        return False
+DEBUG = Debug()
+
+def numeric_loop(n=200):
+    "Global and module attribute lookups in a tight loop"
+    total = 0.0
+    for i in xrange(n):
+        total += math.sin(i)*math.pi + math.sqrt(i)
+    return total
+
+class Particle(object):
+    def __init__(self,x,y):
+        self.x = x
+        self.y = y
+        self.angle = 0.0
+
+    def step(self):
+        self.angle += math.pi/180
+        self.x += math.cos(self.angle)*self.speed()
+        self.y += math.sin(self.angle)*self.speed()
+        return math.hypot(self.x,self.y)
+
+    def speed(self):
+        return abs(math.sin(self.angle))+1
+
+PARTICLES = [Particle(i,i) for i in xrange(20)]
+
+def attribute_methods(particles=PARTICLES):
+    "Methods that lean on attributes and module functions"
+    total = 0.0
+    for p in particles:
+        total += p.step()
+    return total
+
+def debug_laden(n=100):
+    "Code sprinkled with debug checks and calls"
+    total = 0
+    for i in xrange(n):
+        if DEBUG:
+            DEBUG('at',i,total)
+        DEBUG('i is',i)
+        total += i
+        if DEBUG: total += 0
+    return total
+
+def leaf(x):
+    return x+1
+
+def middle(x):
+    return leaf(x)+leaf(x+1)
+
+def outer(x):
+    return middle(x)+middle(x+1)
+
+def call_chain(n=50):
+    "Deep chains of calls between module level functions"
+    total = 0
+    for i in xrange(n):
+        total += outer(i)
+    return total
+
+# Workload -> (what we time, the functions it runs through)
+WORKLOADS = {
+    'numeric_loop':('numeric_loop',['numeric_loop']),
+    'attribute_methods':('attribute_methods',['attribute_methods','Particle.step','Particle.speed']),
+    'debug_laden':('debug_laden',['debug_laden']),
+    'call_chain':('call_chain',['call_chain','outer','middle','leaf']),
+    }
+
+def __no_debug_tests__(module):
+    "Problems with smartdebug's debug_laden:  the if DEBUG: tests should all be gone"
+    from byteplay import Code,POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE
+    ops = [op for op,_ in Code.from_code(module.debug_laden.func_code).code]
+    if POP_JUMP_IF_FALSE in ops or POP_JUMP_IF_TRUE in ops:
+        return 'the if DEBUG: tests are still there'
+    return None
+
+# 'workload/transform' -> check(module), which returns what is wrong
+# with the transformed code (or None).  A transform that quietly
+# does nothing would time the same code twice
+CHECKS = {
+    'debug_laden/smartdebug':__no_debug_tests__,
+    }
+
+def __decorate__(decorator):
+    "Apply a decorator to the workload's functions in place"
+    def apply(module,names):
+        for name in names:
+            decorator(__lookup__(module,name))
+        return
+    return apply
+
+def __mass__(rewriter):
+    "Run a mass rewriter as if it were at the bottom of the module"
+    def apply(module,names):
+        exec 'from bytecode_toys import %s\n%s()'%(rewriter,rewriter) in vars(module)
+        return
+    return apply
+
+def __transforms__():
+    "Transform name -> apply(module,function names)"
+    import bytecode_toys
+    return {
+        'cache_globals':__decorate__(bytecode_toys.cache_globals),
+        'smartdebug':__decorate__(bytecode_toys.smartdebug),
+        'debuggable':__decorate__(bytecode_toys.debuggable),
+        'make_local_modules_constant':__mass__('make_local_modules_constant'),
+        'make_local_functions_constant':__mass__('make_local_functions_constant'),
+        }
+
+def __lookup__(module,dotted):
+    "The function called dotted (e.g. Particle.step) in module"
+    value = module
+    for name in dotted.split('.'):
+        value = getattr(value,name)
+    return getattr(value,'im_func',value)
+
+def __fresh__(label):
+    "A brand new copy of this module, for a transform to work on"
+    import imp,os
+    source = os.path.splitext(__file__)[0]+'.py'
+    return imp.load_source('benchmarks_'+label,source)
+
+def run(workloads=None,transforms=None,trials=15,target=0.005,checks=None):
+    """Time each transform on each workload against the undecorated version
+
+    Returns {'workload/transform':{...}} with the median times (in
+    seconds), the speedup (2.0 is twice as fast) and the p-value.
+    Raises RuntimeError if a transform fails its entry in checks
+    (CHECKS by default)"""
+    from bytecode_toys import LittleTimer
+    all_transforms = __transforms__()
+    if workloads is None: workloads = sorted(WORKLOADS)
+    if transforms is None: transforms = sorted(all_transforms)
+    if checks is None: checks = CHECKS
+
+    baseline = __fresh__('baseline')
+    results = {}
+    for transform in transforms:
+        module = __fresh__(transform)
+        for workload in workloads:
+            entry,names = WORKLOADS[workload]
+            all_transforms[transform](module,names)
+            check = checks.get(workload+'/'+transform)
+            problem = check and check(module)
+            if problem: raise RuntimeError('%s/%s: %s'%(workload,transform,problem))
+        for workload in workloads:
+            entry,names = WORKLOADS[workload]
+            C = LittleTimer.compare([getattr(baseline,entry),getattr(module,entry)],
+                                    trials=trials,target=target,
+                                    labels=['baseline',transform])
+            results[workload+'/'+transform] = {
+                'baseline':C['baseline'].median,
+                'transformed':C[transform].median,
+                'speedup':C.speedup(transform),
+                'pvalue':C.pvalue(transform),
+                }
+    return results
+
+def regressions(results,baseline=None,tolerance=0.1,alpha=0.05):
+    """The results that got worse, as {'workload/transform':reason}
+
+    Something regressed if its speedup is more than tolerance below
+    the one in baseline (results from an earlier run), or if the
+    transform makes the workload significantly slower than not
+    transforming it at all"""
+    bad = {}
+    for key,result in sorted(results.iteritems()):
+        if result['speedup'] < 1 and result['pvalue'] < alpha:
+            bad[key] = 'slower than undecorated (speedup %.3f)'%result['speedup']
+        if baseline and key in baseline:
+            before = baseline[key]['speedup']
+            if result['speedup'] < before*(1-tolerance):
+                bad[key] = 'speedup fell from %.3f to %.3f'%(before,result['speedup'])
+    return bad
+
+def main(argv=None):
+    import argparse,json,platform
+    parser = argparse.ArgumentParser(description='Benchmark the bytecode_toys transforms')
+    parser.add_argument('--out',help='write the results here as JSON')
+    parser.add_argument('--baseline',help='JSON results from an earlier run to compare against')
+    parser.add_argument('--tolerance',type=float,default=0.1,
+                        help='how far a speedup may fall below the baseline (default 0.1)')
+    parser.add_argument('--trials',type=int,default=15)
+    parser.add_argument('--target',type=float,default=0.005,
+                        help='seconds per trial (default 0.005)')
+    parser.add_argument('--workload',action='append',choices=sorted(WORKLOADS))
+    parser.add_argument('--transform',action='append',choices=sorted(__transforms__()))
+    args = parser.parse_args(argv)
+
+    results = run(args.workload,args.transform,args.trials,args.target)
+    for key,result in sorted(results.iteritems()):
+        print '%-50s %9.3f %9.3g'%(key,result['speedup'],result['pvalue'])
+
+    if args.out:
+        with open(args.out,'w') as out:
+            json.dump({'python':platform.python_version(),'results':results},
+                      out,indent=2,sort_keys=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)['results']
+    bad = regressions(results,baseline,args.tolerance)
+    for key,reason in sorted(bad.iteritems()):
+        print 'REGRESSION',key,reason
+    return 1 if bad else 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
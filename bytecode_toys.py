@@ -37,34 +37,369 @@ Pat Miller -- patrick.miller@gmail.com
 
 __version__ = (0,1)
 
+import threading,weakref
 
-def __transform_codeobjects__(co,f):
-    "In this helper, we apply a transform across nested function defs"
-    # Only transform code objects
+# The on-disk code cache, if any (see enable_code_cache), and what
+# the pass driver is working on: the folds made while filling the
+# cache (see __fold__) and the function's own code (see __transform_code__)
+__code_cache__ = None
+__recording__ = threading.local()
+
+# Functions whose transforms depend on things that can change (like
+# logging levels), with their original code and passes.  See refresh_logging
+__refreshable__ = weakref.WeakKeyDictionary()
+
+def __instructions__(co):
+    "The (opcode,arg) pairs in a code object, straight from the bytecodes (no byteplay)"
+    from opcode import HAVE_ARGUMENT,EXTENDED_ARG
+    bytecodes = co.co_code
+    extended = 0
+    pc = 0
+    while pc < len(bytecodes):
+        op = ord(bytecodes[pc])
+        arg = None
+        if op >= HAVE_ARGUMENT:
+            arg = ord(bytecodes[pc+1]) + ord(bytecodes[pc+2])*256 + extended
+            extended = 0
+            pc += 3
+            if op == EXTENDED_ARG:
+                extended = arg << 16
+                continue
+        else:
+            pc += 1
+        yield op,arg
+
+def __nested_codeobjects__(co):
+    "The code objects that co makes functions from, in the order byteplay finds them"
+    from opcode import opmap
+    makers = (opmap['MAKE_FUNCTION'],opmap['MAKE_CLOSURE'])
+    result = []
+    last = None
+    for op,arg in __instructions__(co):
+        if op in makers: result.append(co.co_consts[last])
+        last = arg if op == opmap['LOAD_CONST'] else None
+    return result
+
+def __run_passes__(code,co,passes,f):
+    """Run passes over a byteplay Code (nested ones first).  True if anything changed
+
+    Nested code that no pass touched is swapped back for its
+    original code object so that it doesn't get reassembled"""
+    from byteplay import Code,LOAD_CONST
+    changed = False
+    nested = iter(__nested_codeobjects__(co))
+    for pc,(op,arg) in enumerate(code.code):
+        if op == LOAD_CONST and isinstance(arg,Code):
+            original = next(nested)
+            if __run_passes__(arg,original,passes,f):
+                changed = True
+            else:
+                code.code[pc] = (LOAD_CONST,original)
+
+    for transform in passes:
+        if transform(code,f): changed = True
+    return changed
+
+def __transform_code__(co,passes,f):
+    """In this helper, we apply passes across a code object and nested function defs
+
+    Each pass gets the byteplay Code (edit code.code in place) and
+    the function we are working on, and returns True if it changed
+    anything.  We disassemble once, and only reassemble if needed.
+    If the code cache is on (see enable_code_cache), we look there
+    first and save what we make"""
+    from byteplay import Code
+    cache = __code_cache__
+    key = cache and __cache_key__(co,passes,f)
+    if key:
+        cached = cache.load(key,co,f)
+        if cached is not None: return cached
+
+    # While recording, __fold__ notes where each folded value came
+    # from, and __assume__ what the code relies on them being
+    previous = (getattr(__recording__,'recipes',None),getattr(__recording__,'assumptions',None),
+                getattr(__recording__,'top',None))
+    __recording__.recipes = {} if key else None
+    __recording__.assumptions = [] if key else None
+    try:
+        code = Code.from_code(co)
+        __recording__.top = code  # Passes can tell f's own code from nested code
+        if not __run_passes__(code,co,passes,f):
+            if key: cache.store(key,None)
+            return co
+        if not key: return code.to_code()
+
+        # We build the code with placeholders for the folds, save
+        # that, then cook it just like a load from the cache would
+        values = __placehold__(code,__recording__.recipes)
+        result = code.to_code()
+        cache.store(key,result,__recording__.assumptions)
+        return __cook__(result,lambda recipe,placeholder: values[id(placeholder)])
+    finally:
+        __recording__.recipes,__recording__.assumptions,__recording__.top = previous
+
+def __fold__(const,recipe):
+    """The LOAD_CONST for a value folded into the code
+
+    recipe tells the code cache how to find the value again when it
+    loads the code in another process: ('global',name,attr,...) for
+    a global (or builtin) and its attributes, ('cell',name,attr,...)
+    for a closure variable, ('const',value,attr,...) for attributes
+    of a constant"""
+    from byteplay import LOAD_CONST
+    instruction = (LOAD_CONST,const)
+    recipes = getattr(__recording__,'recipes',None)
+    if recipes is not None:
+        recipes[id(instruction)] = (instruction,recipe)
+    return instruction
+
+def __recipe__(instruction):
+    "The recipe noted for an instruction made by __fold__ (or None)"
+    recipes = getattr(__recording__,'recipes',None)
+    if recipes is None: return None
+    noted,recipe = recipes.get(id(instruction),(None,None))
+    if noted is not instruction: return None
+    return recipe
+
+def __assume__(instruction):
+    """Note that the code we are making relies on the value a folded LOAD_CONST has
+
+    A pass that computes with a folded value (instead of just loading
+    it) calls this.  The code cache only hands back its code if the
+    recipe still gives an equal value"""
+    recipe = __recipe__(instruction)
+    if recipe is not None:
+        __recording__.assumptions.append((recipe,instruction[1]))
+    return
+
+def __placehold__(code,recipes):
+    """Swap the folds in code (and nested code) for recipe placeholders
+
+    Returns the folded values by id of their placeholder"""
+    from byteplay import Code,LOAD_CONST
+    values = {}
+    for pc,instruction in enumerate(code.code):
+        op,arg = instruction
+        if op != LOAD_CONST: continue
+        if isinstance(arg,Code):
+            values.update(__placehold__(arg,recipes))
+            continue
+        noted,recipe = recipes.get(id(instruction),(None,None))
+        if noted is instruction:
+            placeholder = ('bytecode_toys.recipe',)+recipe
+            values[id(placeholder)] = arg
+            code.code[pc] = (LOAD_CONST,placeholder)
+    return values
+
+def __cook__(co,value_of):
+    "Replace the recipe placeholders in co (and nested code objects) with value_of(recipe,placeholder)"
     from types import CodeType
-    if not isinstance(co,CodeType): return co
-
-    # First, transform all the underlying code objects
-    constants = tuple( __transform_codeobjects__(k,f)
-                       for k in co.co_consts )
-
-    # co.co_consts is read-only, we must rebuild a new code obj
-    co = CodeType(
-        co.co_argcount,
-        co.co_nlocals,
-        co.co_stacksize,
-        co.co_flags,
-        co.co_code,
-        constants,
-        co.co_names,
-        co.co_varnames,
-        co.co_filename,
-        co.co_name,
-        co.co_firstlineno,
-        co.co_lnotab,
-        co.co_freevars,
-        co.co_cellvars)
-    return f(co)
+    consts = []
+    changed = False
+    for const in co.co_consts:
+        if isinstance(const,CodeType):
+            cooked = __cook__(const,value_of)
+        elif type(const) is tuple and const[:1] == ('bytecode_toys.recipe',):
+            cooked = value_of(const[1:],const)
+        else:
+            cooked = const
+        changed = changed or cooked is not const
+        consts.append(cooked)
+    if not changed: return co
+    return CodeType(co.co_argcount,co.co_nlocals,co.co_stacksize,co.co_flags,
+                    co.co_code,tuple(consts),co.co_names,co.co_varnames,
+                    co.co_filename,co.co_name,co.co_firstlineno,co.co_lnotab,
+                    co.co_freevars,co.co_cellvars)
+
+def __follow_recipe__(recipe,f):
+    "Find a folded value again.  Raises LookupError or AttributeError if it is gone"
+    kind,value,attrs = recipe[0],recipe[1],recipe[2:]
+    if kind == 'global':
+        missing = object()
+        name = value
+        value = f.func_globals.get(name,missing)
+        if value is missing: value = __builtins__[name]
+    elif kind == 'cell':
+        cells = dict(zip(f.func_code.co_freevars,f.func_closure or ()))
+        try:
+            value = cells[value].cell_contents
+        except ValueError:
+            raise LookupError(value)  # Empty cell
+    for attr in attrs:
+        value = getattr(value,attr)
+    return value
+
+def __cache_key__(co,passes,f):
+    """The code cache key for running passes over co for f (None if we can't cache)
+
+    Passes that are plain functions are known by name, others need a
+    cache_key attribute.  A pass's cache_flags name globals that
+    steer it (like DEBUG), and their values go into the key too, as
+    does whatever its cache_state(f) returns"""
+    import hashlib,imp,marshal
+    from types import FunctionType
+    try:
+        hasher = hashlib.sha1(marshal.dumps(co))
+    except ValueError:
+        return None  # Already has live objects in it
+    hasher.update(imp.get_magic())
+    hasher.update(repr(__version__))
+    for transform in passes:
+        key = getattr(transform,'cache_key',None)
+        if key is None:
+            if not isinstance(transform,FunctionType) or transform.func_closure: return None
+            key = (transform.__module__,transform.__name__)
+        flags = [(flag,f.func_globals.get(flag)) for flag in getattr(transform,'cache_flags',())]
+        state = getattr(transform,'cache_state',None)
+        hasher.update(repr((key,flags,state and state(f))))
+    return hasher.hexdigest()
+
+class CodeCache:
+    """An on-disk cache of transformed code objects (see enable_code_cache)
+
+    Each entry is a marshalled code object in its own file, named by
+    its key.  Writes go to a temporary file that is renamed into
+    place, so processes sharing a directory never see half an entry.
+    When the directory grows past max_bytes, we throw out the least
+    recently used entries.  hits and misses count the loads."""
+
+    def __init__(self,directory,max_bytes=64<<20):
+        import os
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory): raise  # Lost a race is OK
+        return
+
+    def __path(self,key):
+        import os
+        return os.path.join(self.directory,key+'.code')
+
+    def load(self,key,co,f):
+        """The cached code for key, with its folds cooked for f
+
+        co is the untransformed code (returned if the passes did nothing).
+        None if we don't have it, a folded value can't be found again,
+        or one the code was computed from has changed"""
+        import os,marshal
+        path = self.__path(key)
+        try:
+            with open(path,'rb') as entry:
+                cached,assumptions = marshal.loads(entry.read())
+            os.utime(path,None)
+        except (IOError,OSError,EOFError,ValueError,TypeError):
+            self.misses += 1
+            return None
+        try:
+            for recipe,value in assumptions:
+                now = __follow_recipe__(recipe,f)
+                if type(now) is not type(value) or now != value:
+                    self.misses += 1
+                    return None
+            if cached is not None:
+                cached = __cook__(cached,lambda recipe,placeholder: __follow_recipe__(recipe,f))
+        except (LookupError,AttributeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if cached is None: return co
+        return cached
+
+    def store(self,key,co,assumptions=()):
+        """Save co (None means the passes did nothing) for key.  Quietly gives up if it can't
+
+        assumptions are (recipe,value) pairs that must still hold
+        when we load it (see __assume__)"""
+        import os,marshal,tempfile
+        try:
+            data = marshal.dumps((co,tuple(assumptions)))
+        except ValueError:
+            return  # Something in there doesn't marshal (and has no recipe)
+        try:
+            handle,temporary = tempfile.mkstemp(dir=self.directory,suffix='.tmp')
+            try:
+                os.write(handle,data)
+            finally:
+                os.close(handle)
+            try:
+                os.rename(temporary,self.__path(key))
+            except OSError:
+                os.remove(temporary)  # Windows won't rename over a file
+        except (IOError,OSError):
+            return
+        self.evict()
+        return
+
+    def evict(self):
+        "Remove least recently used entries until we fit in max_bytes"
+        import os
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.code'): continue
+            try:
+                info = os.stat(os.path.join(self.directory,name))
+            except OSError:
+                continue  # Someone else evicted it
+            entries.append((info.st_mtime,info.st_size,name))
+            total += info.st_size
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _,size,name = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.directory,name))
+            except OSError:
+                pass
+            total -= size
+        return
+
+    def clear(self):
+        "Remove every entry"
+        import os
+        for name in os.listdir(self.directory):
+            if name.endswith('.code'):
+                try:
+                    os.remove(os.path.join(self.directory,name))
+                except OSError:
+                    pass
+        return
+
+def enable_code_cache(directory=None,max_bytes=64<<20):
+    """Keep transformed code on disk so other processes can skip the work
+
+    Taking code apart and putting it back together with byteplay takes
+    a while, and short-lived worker processes pay for it every time
+    they start.  With this on, the decorators and the import hook look
+    for their output in directory (by default ~/.cache/bytecode_toys)
+    first.  Entries are keyed by the original code, the passes, the
+    flags the passes look at (DEBUG, DEBUGGING, ...) and the Python
+    version.  Values folded by cache_globals and friends are looked up
+    again by name when the code is loaded.  Returns the CodeCache"""
+    import os
+    global __code_cache__
+    if directory is None:
+        directory = os.path.join(os.path.expanduser('~'),'.cache','bytecode_toys')
+    __code_cache__ = CodeCache(directory,max_bytes)
+    return __code_cache__
+
+def disable_code_cache():
+    "Stop using the on-disk code cache (the files stay where they are)"
+    global __code_cache__
+    __code_cache__ = None
+    return
+
+def __transform_function__(f,passes):
+    "Apply passes to f's code.  Returns f"
+    original = f.func_code
+    f.func_code = __transform_code__(original,passes,f)
+    if [p for p in passes if getattr(p,'refreshable',False)]:
+        __refreshable__[f] = (original,passes)
+    return f
 
 def __pc_to_byteplay_offset__(codelist):
     "byteplay offsets do not correspond to actual bytecode offsets"
@@ -82,6 +417,92 @@ def __pc_to_byteplay_offset__(codelist):
             pc += 1
     return result
 
+def __clone_instructions__(base):
+    "Clone a block of instructions, giving it fresh labels"
+    from byteplay import Label,CodeList
+    # Pull out all the label targets.  Instructions without labels
+    # are shared, so the code cache still knows them (see __fold__)
+    targets = dict( (x[0],Label()) for x in base if isinstance(x[0],Label) )
+
+    def relabel(x):
+        op,arg = x
+        if isinstance(op,Label): return (targets[op],arg)
+        if isinstance(arg,Label): return (op,targets.get(arg,arg))
+        return x
+    return CodeList(relabel(x) for x in base)
+
+def __best_clock__():
+    "Pick the highest resolution monotonic clock this Python has"
+    import platform,time
+    for name in ('perf_counter','monotonic'):
+        clock = getattr(time,name,None)
+        if clock is not None: return clock
+
+    # Older Pythons don't have one, so we fall back to the
+    # best wall clock for the platform
+    if platform.system() == 'Windows':
+        return time.clock
+    return time.time
+
+def __percentile__(ordered,p):
+    "Linearly interpolated p-th percentile (0-100) of a sorted list"
+    if not ordered: return 0.0
+    k = (len(ordered)-1)*p/100.0
+    lo = int(k)
+    hi = min(lo+1,len(ordered)-1)
+    return ordered[lo] + (ordered[hi]-ordered[lo])*(k-lo)
+
+def __mann_whitney__(xs,ys):
+    """Two-sided Mann-Whitney U test, returns the p-value
+
+    Uses the normal approximation (with a tie correction), which is
+    fine for the 20 or more trials you want anyway"""
+    from math import sqrt,erfc
+    n1 = len(xs)
+    n2 = len(ys)
+    if not n1 or not n2: return 1.0
+
+    # Rank everything together, ties get the average rank
+    pooled = sorted([(x,0) for x in xs]+[(y,1) for y in ys])
+    ranks = [0.0]*len(pooled)
+    ties = 0.0
+    i = 0
+    while i < len(pooled):
+        j = i
+        while j+1 < len(pooled) and pooled[j+1][0] == pooled[i][0]:
+            j += 1
+        for k in xrange(i,j+1):
+            ranks[k] = (i+j)/2.0+1
+        t = j-i+1
+        ties += t**3-t
+        i = j+1
+
+    r1 = sum(r for r,(_,which) in zip(ranks,pooled) if which == 0)
+    u = r1 - n1*(n1+1)/2.0
+    n = n1+n2
+    variance = n1*n2/12.0*((n+1) - ties/(n*(n-1)))
+    if variance <= 0: return 1.0
+    z = (abs(u - n1*n2/2.0)-0.5)/sqrt(variance)
+    return min(1.0,erfc(max(z,0.0)/sqrt(2.0)))
+
+def __pin_to_cpu__(cpu):
+    "Pin this process to one CPU if the platform lets us.  Returns True if it worked"
+    import os
+    if hasattr(os,'sched_setaffinity'):
+        os.sched_setaffinity(0,[cpu])
+        return True
+
+    # Older Pythons on Linux can still get at it through libc
+    try:
+        import ctypes,ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        mask = (ctypes.c_ulong*16)()   # a 1024 bit cpu_set_t
+        bits = 8*ctypes.sizeof(ctypes.c_ulong)
+        mask[cpu//bits] = 1 << (cpu%bits)
+        return libc.sched_setaffinity(0,ctypes.sizeof(mask),ctypes.byref(mask)) == 0
+    except (ImportError,OSError,AttributeError,TypeError,IndexError):
+        return False
+
 class LittleTimer:
     """A timer to use with a with block.
 
@@ -105,8 +526,25 @@ class LittleTimer:
     t = time.time()-t0
 
     and doesn't restrict you to a one-liner string for evaluation
-    
+
     e.g. timer.Timer('a = b*c').timeit(10)
+
+    A single run can't tell you anything about the noise on a busy
+    machine, so you can also ask for a number of trials.  Each trial
+    runs the unrolled body again, the cost of the empty clock
+    prologue/epilogue is measured and subtracted, and you get
+    the spread:
+
+    with LittleTimer(1000,trials=50) as T:
+        a = b*c
+    print T.median,T.p90,T.p99,'+/-',T.stddev
+
+    If you don't know how many copies you want, use n=None and
+    the timer picks a count that runs for about target seconds:
+
+    with LittleTimer(None,target=0.5) as T:
+        a = b*c
+    print T.n,'copies took',T.time,'each'
     """
     
     __tick = 1e-6
@@ -119,15 +557,41 @@ class LittleTimer:
         self.__tick = tick
         return
 
-    def __init__(self,n=10):
-        "__init__(n) - n is the number of replications of the body"
+    def __init__(self,n=10,trials=1,unroll=1000,target=0.1,memory=False):
+        """__init__(n,trials,unroll,target,memory) - n is the number of replications of the body
+
+        trials is the number of times the whole unrolled body is run.
+        With more than one trial, the clock overhead is subtracted
+        and the statistics (median, p90, ...) become meaningful
+
+        If n is None, we pick n so that one trial takes about target
+        seconds.  Past unroll copies, the copies are run inside a
+        tight loop (whose overhead is measured and subtracted) so the
+        code we build stays a reasonable size
+
+        With memory set, we also make one extra (untimed) run to
+        count what the body allocates.  See allocations,
+        retained_bytes and collections"""
         self.__n = n
+        self.__trials = trials
+        self.__auto = n is None
+        if self.__auto: self.__n = 0
+        self.__unroll = unroll
+        self.__target = target
         self.__once = 0.0
+        self.__samples = []
+        self.__sorted = []
+        self.__overhead = 0.0
+        self.__memory = memory
+        self.__allocations = 0.0
+        self.__retained = 0.0
+        self.__collections = (0.0,0.0,0.0)
         self.__locals = {}
         self.__globals = {}
         self.__bytecodes = []
         self.__line = 0
-        self.__code = None
+        self.__filename = '<timer>'
+        self.__newlocals = True
         self.__oneshot = False
         return
 
@@ -167,9 +631,11 @@ class LittleTimer:
             POP_TOP,POP_BLOCK
 
         frame = inspect.currentframe(1)
-        self.__code = code = Code.from_code(frame.f_code)
+        code = Code.from_code(frame.f_code)
         self.__line = frame.f_lineno
         self.__globals = frame.f_globals
+        self.__filename = code.filename
+        self.__newlocals = code.newlocals
 
         # The SetLineno instructions get in the way here
         # since I want to find the actual instruction
@@ -222,41 +688,344 @@ class LittleTimer:
 
     def __exit__(self,*args):
         "On exit, we build a timer function and run it to collect the time"
-        self.timeit(self.__n)
+        self.timeit()
         if self.__oneshot: print 'Rate',self.rate,'per second'
         return False
 
-    def timeit(self,n=None):
+    def timeit(self,n=None,trials=None):
         """Re-run the timing routine.  Returns the time for one iteration.
-        
-        This computes new rate, time, etc.. and resets the implied count"""
-        from byteplay import \
+
+        This computes new rate, time, etc.. and resets the implied count
+        (and the number of trials if you give one).  In auto mode
+        (n=None) the count is recalibrated unless you give one here"""
+        timerbody,emptybody,trials = self.__prepare(n,trials)
+
+        # We try to be careful with garbage collection runs
+        try:
+            import gc
+            gc.collect()   # Do a pre-emptive collection now
+            if gc.isenabled(): gc.disable()
+            if emptybody is not None:
+                overhead = min(emptybody() for i in xrange(trials))
+            else:
+                overhead = 0.0
+            raw = [timerbody() for i in xrange(trials)]
+        finally:
+            gc.enable()
+
+        # The memory run is separate so the bookkeeping doesn't
+        # show up in the times
+        if self.__memory:
+            self.__measure_memory(timerbody,emptybody)
+        return self.__record(raw,overhead)
+
+    def __measure_memory(self,timerbody,emptybody):
+        """Used internally to see what each execution of the body allocates
+
+        The allocation count is the net number of new objects the
+        garbage collector tracks (which is what drives collections).
+        The retained bytes come from tracemalloc if this Python has
+        it.  Otherwise, we add up the sizes of the new gc-tracked
+        objects (so strings and numbers are not counted)."""
+        import gc,sys
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+
+        def one_run(body):
+            try:
+                gc.collect()
+                if gc.isenabled(): gc.disable()
+                if tracemalloc is not None:
+                    started = not tracemalloc.is_tracing()
+                    if started: tracemalloc.start()
+                    before = tracemalloc.get_traced_memory()[0]
+                else:
+                    before = set(id(x) for x in gc.get_objects())
+                count = gc.get_count()[0]
+                body()
+                allocated = gc.get_count()[0] - count
+                if tracemalloc is not None:
+                    retained = tracemalloc.get_traced_memory()[0] - before
+                    if started: tracemalloc.stop()
+                else:
+                    after = gc.get_objects()
+                    retained = sum(sys.getsizeof(x) for x in after
+                                   if id(x) not in before
+                                   and x is not before and x is not after)
+            finally:
+                gc.enable()
+            return allocated,retained
+
+        allocated,retained = one_run(timerbody)
+        if emptybody is not None:
+            # Take out whatever the loop and clock cost us
+            empty_allocated,empty_retained = one_run(emptybody)
+            allocated -= empty_allocated
+            retained -= empty_retained
+
+        n = float(max(self.__n,1))
+        self.__allocations = max(allocated,0)/n
+        self.__retained = max(retained,0)/n
+
+        # A gen0 collection happens each time the net allocation
+        # count passes the first threshold, and each older generation
+        # is collected once every threshold collections of the one below
+        collections = []
+        rate = self.__allocations
+        for threshold in gc.get_threshold():
+            rate = rate/threshold if threshold else 0.0
+            collections.append(rate)
+        self.__collections = tuple(collections)
+        return
+
+    @classmethod
+    def from_callable(cls,f,n=10,trials=1,unroll=1000,target=0.1):
+        """Build a timer whose body is just a call to f()
+
+        Handy when the thing you want to time already lives in a
+        function (say, a decorated and an undecorated version).
+        Nothing is run until you call timeit()"""
+        from byteplay import LOAD_CONST,CALL_FUNCTION,POP_TOP
+        timer = cls(n,trials,unroll,target)
+        timer.__bytecodes = [
+            (LOAD_CONST,f),
+            (CALL_FUNCTION,0),
+            (POP_TOP,None),
+            ]
+        timer.__globals = getattr(f,'func_globals',{})
+        co = getattr(f,'func_code',None)
+        if co is not None:
+            timer.__filename = co.co_filename
+            timer.__line = co.co_firstlineno
+        return timer
+
+    @staticmethod
+    def compare(candidates,n=None,trials=30,target=0.01,labels=None):
+        """Time several bodies against each other.  Returns a Comparison
+
+        candidates is a list of LittleTimers (e.g. from with blocks)
+        or callables (which are wrapped with from_callable, picking
+        n to take about target seconds unless you give one).  The
+        first candidate is the baseline.
+
+        Rather than timing one candidate and then the next (and
+        picking up any drift on the machine in between), we run
+        the trials round-robin with the garbage collector off:
+
+        C = LittleTimer.compare([plain,cached])
+        print C
+        if C.significant(1): print C.speedup(1),'times faster'
+        """
+        import gc
+        timers = []
+        names = []
+        for i,candidate in enumerate(candidates):
+            if isinstance(candidate,LittleTimer):
+                timers.append(candidate)
+                names.append('timer%d'%i)
+            else:
+                timers.append(LittleTimer.from_callable(candidate,n,trials,target=target))
+                names.append(getattr(candidate,'__name__','candidate%d'%i))
+        if labels is not None:
+            names = list(labels)
+
+        prepared = [timer.__prepare(n,trials) for timer in timers]
+        raw = [[] for timer in timers]
+        overheads = [[] for timer in timers]
+
+        # We rotate who goes first in each round so nobody always
+        # gets the warm (or cold) slot
+        try:
+            gc.collect()   # Do a pre-emptive collection now
+            if gc.isenabled(): gc.disable()
+            for trial in xrange(trials):
+                for j in xrange(len(timers)):
+                    i = (trial+j)%len(timers)
+                    timerbody,emptybody,_ = prepared[i]
+                    if emptybody is not None:
+                        overheads[i].append(emptybody())
+                    raw[i].append(timerbody())
+        finally:
+            gc.enable()
+
+        for timer,times,overhead in zip(timers,raw,overheads):
+            timer.__record(times,min(overhead) if overhead else 0.0)
+        return Comparison(timers,names)
+
+    def scaling(self,workers=None,pin=False,trials=None):
+        """Run the timer body in 1..workers processes at once.  Returns a Scaling
+
+        Each process runs the same unrolled body (the workers are
+        forked, so they get the captured locals and globals for free)
+        and they all start together.  If the per-worker rate holds up
+        as workers are added, the body is CPU bound.  If it falls off,
+        you are fighting over memory bandwidth, a lock, or a noisy
+        neighbor.  With pin set, worker i is pinned to cpu i.
+
+        with LittleTimer(1000) as T:
+            a = b*c
+        print T.scaling(4)
+        """
+        import os,multiprocessing
+        assert hasattr(os,'fork'),"scaling needs a platform that can fork"
+        cpus = multiprocessing.cpu_count()
+        if workers is None: workers = cpus
+
+        # Build (and calibrate) once in the parent, the children inherit it
+        timerbody,emptybody,trials = self.__prepare(None,trials)
+        n = float(max(self.__n,1))
+
+        results = {}
+        for count in xrange(1,workers+1):
+            ready = multiprocessing.Queue()
+            done = multiprocessing.Queue()
+            go = multiprocessing.Event()
+            processes = [
+                multiprocessing.Process(
+                    target=__scaling_worker__,
+                    args=(timerbody,emptybody,trials,
+                          (i%cpus) if pin else None,ready,go,done,i))
+                for i in xrange(count)]
+            for process in processes: process.start()
+            finished = False
+            try:
+                for process in processes: __from_workers__(ready,processes)
+                go.set()
+                samples = [None]*count
+                for process in processes:
+                    i,raw,overhead = __from_workers__(done,processes)
+                    samples[i] = [max(t-overhead,0.0)/n for t in raw]
+                finished = True
+            finally:
+                # If one worker died, the others may be stuck waiting on go
+                if not finished:
+                    for process in processes:
+                        if process.is_alive(): process.terminate()
+                for process in processes: process.join()
+            results[count] = samples
+        return Scaling(results)
+
+    def __prepare(self,n,trials):
+        """Used internally to build the timer functions for a run
+
+        Returns the timer body, the empty body used to measure the
+        overhead (or None if we don't need one) and the trial count"""
+        # We override some of the stored information on a rerun
+        if n is not None:
+            self.__n = n
+            self.__auto = False
+        elif self.__auto:
+            self.__n = self.__calibrate()
+        if trials is None:
+            trials = self.__trials
+        else:
+            self.__trials = trials
+
+        copies,loops,rest = self.__shape(self.__n)
+        timerbody = self.__build(copies,loops,rest)
+        self.__timerbody = timerbody
+
+        # With only one unrolled trial we just report what we saw.
+        # Otherwise we also time an empty body (with the same loop, if
+        # any) so we can subtract the cost of the clock calls and loop
+        emptybody = None
+        if trials > 1 or loops > 0:
+            emptybody = self.__build(0,loops,0)
+        return timerbody,emptybody,trials
+
+    def __record(self,raw,overhead):
+        "Used internally to turn raw trial times into the statistics"
+        self.__overhead = overhead
+        try:
+            self.__samples = [max(t-overhead,0.0)/self.__n for t in raw]
+        except ZeroDivisionError:
+            self.__samples = [0.0 for t in raw]
+        self.__sorted = sorted(self.__samples)
+        if len(raw) > 1:
+            self.__once = self.median
+        else:
+            self.__once = self.__samples[0]
+        return self.__once
+
+    def __calibrate(self):
+        "Used internally to pick a replication count that takes about target seconds"
+        import gc
+        target = self.__target
+        n = 1
+        while True:
+            timerbody = self.__build(*self.__shape(n))
+            try:
+                if gc.isenabled(): gc.disable()
+                elapsed = timerbody()
+            finally:
+                gc.enable()
+
+            # Once we're within a factor of ten or so, we can
+            # just scale up.  Until then, the clock is too coarse
+            if elapsed >= target/10 or n >= 1<<30: break
+            n *= 10
+        if elapsed <= 0: return n
+        return max(1,int(n*target/elapsed))
+
+    def __shape(self,n):
+        """Used internally to split n replications into (copies,loops,rest)
+
+        Up to the unroll factor, we just unroll everything.  Past
+        that we run loops trips around a block of copies and finish
+        off with rest straight copies"""
+        if n <= self.__unroll: return n,0,0
+        copies = self.__unroll
+        return copies,n//copies,n%copies
+
+    def __build(self,copies,loops=0,rest=0):
+        """Used internally to build a timer function with copies of the body
+
+        If loops is non-zero, the copies are wrapped in a tight
+        loop that runs that many times and rest more copies follow"""
+        from byteplay import Code,CodeList,Label, \
             SetLineno, \
             LOAD_CONST,STORE_FAST,ROT_TWO, \
             CALL_FUNCTION,RETURN_VALUE, \
-            BINARY_SUBTRACT, BINARY_DIVIDE
-        from types import FunctionType
+            BINARY_SUBTRACT, \
+            SETUP_LOOP,GET_ITER,FOR_ITER,POP_TOP, \
+            JUMP_ABSOLUTE,POP_BLOCK
 
-        # We override some of the stored information on a rerun
-        if n is None:
-            n = self.__n
-        else:
-            self.__n = n
-        instructions = self.__bytecodes
+        from types import FunctionType
 
         # Now we replicate the code the right number of times
-        base = instructions[:]
-        for i in xrange(1,self.__n):
-            instructions.extend(self.__clone(base))
+        base = self.__bytecodes
+        instructions = CodeList()
+        for i in xrange(copies):
+            instructions.extend(__clone_instructions__(base))
+
+        # Past the unroll factor, the copies go inside a loop
+        # of the form: for _ in xrange(loops): copies
+        if loops:
+            top = Label()
+            exit = Label()
+            end = Label()
+            instructions[0:0] = [
+                (SETUP_LOOP,end),
+                (LOAD_CONST,xrange(loops)),
+                (GET_ITER,None),
+                (top,None),
+                (FOR_ITER,exit),
+                (POP_TOP,None),
+                ]
+            instructions.extend([
+                (JUMP_ABSOLUTE,top),
+                (exit,None),
+                (POP_BLOCK,None),
+                (end,None),
+                ])
+            for i in xrange(rest):
+                instructions.extend(__clone_instructions__(base))
 
-        # insert time.time at front and back
+        # insert the clock at front and back
         # sub at end and return
-        import platform,time
-        if platform.system() == 'Windows':
-            gettime = time.clock
-        else:
-            gettime = time.time
-        
+        gettime = __best_clock__()
         instructions[0:0] = [
             (LOAD_CONST,gettime),
             (CALL_FUNCTION,0),
@@ -266,8 +1035,6 @@ class LittleTimer:
             (CALL_FUNCTION,0),
             (ROT_TWO,None),
             (BINARY_SUBTRACT,None),
-            (LOAD_CONST,self.__n),
-            (BINARY_DIVIDE,None),
             ])
 
         # We may use local values in this new function
@@ -283,33 +1050,16 @@ class LittleTimer:
         # with as the line number
         instructions.insert(0,(SetLineno,self.__line))
         instructions.append((RETURN_VALUE,None))
-        
-        timerbody = FunctionType(
-            self.__code.to_code(),
+
+        # The body takes no arguments, even if the with block
+        # lived inside a function that did
+        code = Code(instructions,(),(),False,False,
+                    self.__newlocals,'timerbody',
+                    self.__filename,self.__line,None)
+        return FunctionType(
+            code.to_code(),
             self.__globals,
             'timerbody')
-        self.__timerbody = timerbody
-
-        # We try to be careful with garbage collection runs
-        try:
-            import gc
-            gc.collect()   # Do a pre-emptive collection now
-            if gc.isenabled(): gc.disable()
-            self.__once = timerbody()
-        finally:
-            gc.enable()
-        return self.__once
-
-    def __clone(self,base):
-        "Used internally to clone blocks of instructions with labels"
-        from byteplay import Label,CodeList
-        # Pull out all the label targets
-        targets = dict( (x[0],Label()) for x in base if isinstance(x[0],Label) )
-
-        return CodeList(
-            (targets.get(x[0],x[0]),
-                   targets.get(x[1],x[1]))
-            for x in base)
 
     @property
     def rate(self):
@@ -321,63 +1071,280 @@ class LittleTimer:
 
     @property
     def rate_errorbar(self):
-        "a bound on the rate accuracy based on clock granularity"
-        time_for_all = self.__once*self.__n
-        # Each clock can be off a tick, about 1 microsecond
-        bar_time = time_for_all + 2*self.tick
+        "a bound on the rate accuracy based on clock granularity (and trial spread)"
+        # Each clock can be off a tick, about 1 microsecond, so
+        # the slowest believable time is time + time_errorbar
         try:
-            bar_once = bar_time / self.__n
-            bar_rate = 1.0/bar_once
+            bar_rate = 1.0/(self.__once + self.time_errorbar)
         except ZeroDivisionError:
             return 0
         return self.rate - bar_rate
 
     @property
     def time(self):
-        "time for one execution in seconds"
+        "time for one execution in seconds (the median if we ran trials)"
         return self.__once
 
     @property
     def time_errorbar(self):
-        "a bound on the time accuracy based on clock granularity"
+        "a bound on the time accuracy based on clock granularity (and trial spread)"
         try:
-            return 2*self.tick/self.__n
+            bar = 2*self.tick/self.__n
         except ZeroDivisionError:
-            return 2*self.tick
+            bar = 2*self.tick
 
+        # With trials, we can do better than guessing.  Use a
+        # 95% confidence interval if it is wider than the tick
+        trials = len(self.__samples)
+        if trials > 1:
+            from math import sqrt
+            bar = max(bar,1.96*self.stddev/sqrt(trials))
+        return bar
 
-def __cache_globals__(co,func_globals):
-    "Cache global objects in co_consts.  See @cache_globals.  Returns code object"
-    from byteplay import Code, LOAD_CONST, LOAD_GLOBAL, LOAD_ATTR
-    # First, we want to crack open the function and look at it's bytecodes
-    code = Code.from_code(co)
+    @property
+    def n(self):
+        "number of replications of the body (picked for you in auto mode)"
+        return self.__n
+
+    @property
+    def unroll(self):
+        "largest number of straight copies before we switch to a loop"
+        return self.__unroll
+
+    @property
+    def allocations(self):
+        "net new gc-tracked objects per execution (memory mode only)"
+        return self.__allocations
+
+    @property
+    def retained_bytes(self):
+        "net bytes still held after each execution (memory mode only)"
+        return self.__retained
+
+    @property
+    def collections(self):
+        "(gen0,gen1,gen2) collections each execution would trigger (memory mode only)"
+        return self.__collections
+
+    @property
+    def trials(self):
+        "number of trials run by the last timeit()"
+        return len(self.__samples)
+
+    @property
+    def samples(self):
+        "time for one execution in each trial, in the order they ran"
+        return list(self.__samples)
+
+    @property
+    def overhead(self):
+        "measured cost of the clock prologue/epilogue (subtracted from each trial)"
+        return self.__overhead
+
+    def percentile(self,p):
+        "time for one execution at the p-th percentile (0-100) of the trials"
+        return __percentile__(self.__sorted,p)
+
+    @property
+    def min(self):
+        "fastest time for one execution over all trials"
+        return self.percentile(0)
+
+    @property
+    def median(self):
+        "median time for one execution over all trials"
+        return self.percentile(50)
+
+    @property
+    def p90(self):
+        "90th percentile time for one execution over all trials"
+        return self.percentile(90)
+
+    @property
+    def p99(self):
+        "99th percentile time for one execution over all trials"
+        return self.percentile(99)
+
+    @property
+    def stddev(self):
+        "sample standard deviation of the time for one execution"
+        samples = self.__samples
+        if len(samples) < 2: return 0.0
+        mean = sum(samples)/len(samples)
+        from math import sqrt
+        return sqrt(sum((x-mean)**2 for x in samples)/(len(samples)-1))
+
+
+def __from_workers__(queue,processes,poll=0.5):
+    """The next thing a LittleTimer.scaling worker puts on queue
+
+    A worker that crashed (or was killed) will never put anything, so
+    rather than wait forever, we raise RuntimeError if one has died"""
+    import Queue
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Queue.Empty:
+            dead = [process for process in processes if process.exitcode not in (None,0)]
+            if dead:
+                raise RuntimeError('scaling worker %s died with exit code %s'%(dead[0].name,dead[0].exitcode))
+
+def __scaling_worker__(timerbody,emptybody,trials,cpu,ready,go,done,index):
+    "Body of each LittleTimer.scaling worker process"
+    import gc
+    if cpu is not None: __pin_to_cpu__(cpu)
+    ready.put(index)
+    go.wait()
+    try:
+        gc.collect()
+        if gc.isenabled(): gc.disable()
+        if emptybody is not None:
+            overhead = min(emptybody() for i in xrange(trials))
+        else:
+            overhead = 0.0
+        raw = [timerbody() for i in xrange(trials)]
+    finally:
+        gc.enable()
+    done.put((index,raw,overhead))
+    return
+
+class Scaling:
+    """The result of LittleTimer.scaling()
+
+    For each number of workers, we keep the per-execution time of
+    every trial in every worker.  From that you get the per-worker
+    rates, the aggregate throughput (the sum of those rates), and
+    the efficiency: the throughput over what perfect scaling of
+    one worker would give.
+
+    print S
+    S.rates(4), S.throughput(4), S.efficiency(4)
+    """
+    def __init__(self,samples):
+        self.samples = samples
+        return
+
+    @property
+    def workers(self):
+        "the worker counts we ran"
+        return sorted(self.samples)
+
+    def rates(self,workers):
+        "executions per second in each worker (by median)"
+        result = []
+        for times in self.samples[workers]:
+            median = __percentile__(sorted(times),50)
+            result.append(1.0/median if median else 0.0)
+        return result
+
+    def throughput(self,workers):
+        "total executions per second across all the workers"
+        return sum(self.rates(workers))
+
+    def efficiency(self,workers):
+        "throughput relative to perfect scaling of a single worker"
+        try:
+            return self.throughput(workers)/(workers*self.throughput(1))
+        except (ZeroDivisionError,KeyError):
+            return 0.0
+
+    def __str__(self):
+        lines = ['%7s %14s %10s %14s %14s'%('workers','throughput','efficiency','slowest','fastest')]
+        for workers in self.workers:
+            rates = self.rates(workers)
+            lines.append('%7d %14.4g %10.3f %14.4g %14.4g'%(
+                workers,self.throughput(workers),self.efficiency(workers),
+                min(rates),max(rates)))
+        return '\n'.join(lines)
+
+class Comparison:
+    """The result of LittleTimer.compare()
+
+    The first timer is the baseline.  For each candidate you can
+    get the speedup over the baseline (ratio of the medians, so 2.0
+    means twice as fast) and the p-value of a two-sided Mann-Whitney
+    U test on the trial times to tell a real win from noise.
+    Candidates can be picked by position or by label.
+
+    print C
+    C.speedup('cached'), C.pvalue('cached'), C.significant('cached')
+    """
+    def __init__(self,timers,labels):
+        self.timers = timers
+        self.labels = labels
+        return
+
+    def __index(self,which):
+        "Used internally to find a candidate by position or label"
+        if isinstance(which,basestring):
+            return self.labels.index(which)
+        return which
+
+    def __getitem__(self,which):
+        "the LittleTimer for a candidate"
+        return self.timers[self.__index(which)]
+
+    def speedup(self,which):
+        "how many times faster than the baseline (by median)"
+        try:
+            return self.timers[0].median/self[which].median
+        except ZeroDivisionError:
+            return float('inf')
+
+    def pvalue(self,which):
+        "chance of seeing a difference this big from noise alone"
+        return __mann_whitney__(self.timers[0].samples,self[which].samples)
+
+    def significant(self,which,alpha=0.05):
+        "is the difference from the baseline real (at level alpha)?"
+        return self.pvalue(which) < alpha
+
+    def __str__(self):
+        lines = ['%-20s %12s %12s %9s %9s'%('','median','p90','speedup','p-value')]
+        for i,(label,timer) in enumerate(zip(self.labels,self.timers)):
+            lines.append('%-20s %12.4g %12.4g %9.3f %9.3g'%(
+                label,timer.median,timer.p90,self.speedup(i),self.pvalue(i)))
+        return '\n'.join(lines)
+
+def __cache_globals__(code,f):
+    "Cache global objects in co_consts.  See @cache_globals.  Returns True if changed"
+    from byteplay import LOAD_CONST, LOAD_GLOBAL, LOAD_ATTR
+    func_globals = f.func_globals
 
     # Look at each load global and replace with a load const if the
     # global value is currently available.  At the same time, if we
     # find something like <const>.attr (and the attr is available),
     # we keep folding
     missing = object()
+    changed = False
     pc = 0
     while pc < len(code.code):
         op,arg = code.code[pc]
         if op == LOAD_GLOBAL:
             const = func_globals.get(arg,missing)
             if const is not missing:
-                code.code[pc] = (LOAD_CONST,const)
+                code.code[pc] = __fold__(const,('global',arg))
+                changed = True
             else:
                 const = __builtins__.get(arg,missing)
                 if const is not missing:
-                    code.code[pc] = (LOAD_CONST,const)
+                    code.code[pc] = __fold__(const,('global',arg))
+                    changed = True
 
         elif op == LOAD_ATTR:
-            prev_op,prev_arg = code.code[pc-1]
-            const = getattr(prev_arg,arg,missing)
+            # Only fold attributes of things we already folded
+            prev = code.code[pc-1]
+            const = missing
+            if prev[0] == LOAD_CONST:
+                const = getattr(prev[1],arg,missing)
             if const is not missing:
-                code.code[pc-1:pc+1] = [(LOAD_CONST,const)]
+                recipe = __recipe__(prev) or ('const',prev[1])
+                code.code[pc-1:pc+1] = [__fold__(const,recipe+(arg,))]
+                changed = True
                 pc -= 1
         pc += 1
 
-    return code.to_code()
+    return changed
 
 def cache_globals(f):
     """This decorator will fold global references into local constants
@@ -394,127 +1361,622 @@ def cache_globals(f):
     code), but we suffer the lookup every time.   This decorator looks each
     global up once (at decoration time) and caches it as a special local
     constant."""
-    def action(co):
-        return __cache_globals__(co,f.func_globals)
-    f.func_code = __transform_codeobjects__(f.func_code,action)
-    return f
+    return __transform_function__(f,[__cache_globals__])
+cache_globals.bytecode_pass = __cache_globals__
 
+def __invalidator__(f,passes=None):
+    """Returns a callable that puts f back to the code it has right now
 
-def __smartdebug__(co,func_globals):
-    """Apply smartdebug to code objects, see @smartdebug"""
+    If passes are given, they are run over f again after that (so we
+    fold whatever the globals are now).  It only ever fires once so
+    that stale closures made from old code don't keep re-running it"""
+    original = f.func_code
+    fired = []
+    def invalidate():
+        if fired: return
+        fired.append(True)
+        f.func_code = original
+        if passes: __transform_function__(f,passes)
+    return invalidate
 
-    from byteplay import Code,SetLineno,Label,LOAD_GLOBAL,POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE,JUMP_FORWARD
-    code = Code.from_code(co)
-    instructions = code.code
+def __guard__(code,unfolded,guards,invalidate):
+    """Protect folded code with a prologue that checks the folds still hold
 
-    # First, find all the "if DEBUG:" and "if not DEBUG"
-    # We collect in reverse order so that we can update
-    # in place more easily
-    debugs = []
-    for offset,op_arg in enumerate(instructions):
-        if op_arg == (LOAD_GLOBAL,'DEBUG') and instructions[offset+1][0] in (POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE):
-            debugs.insert(0,offset)
-
-    # We want the bounds of the DEBUG true part and DEBUG false part for each
-    # most ifs look like
-    # LOAD_GLOBAL DEBUG
-    # POP_JUMP_IF_FALSE L1  (sense may be reversed with _TRUE)
-    #   ...
-    # JUMP_FORWARD L2
-    # L1:
-    #   ...
-    # L2:
-    # They look different at the ends of loops, but I'm skipping those
-    def back_one(x):
-        while x > 0:
-            opcode = instructions[x][0]
-            if opcode != SetLineno and not isinstance(opcode,Label):
-                break
-            x -= 1
-        return x
-    def offset_of(L):
-        for off,(op,_) in enumerate(instructions):
-            if op is L: return off
-        return None
-    def true_false(x):
-        pop_jump,L1 = instructions[x+1]
-        O1 = offset_of(L1)
-        if O1 < x: return None  # Jumping backward, Loop if
-        OJF = back_one(O1)
-        jf,L2 = instructions[OJF]
-        if jf != JUMP_FORWARD: return None # Not my pattern
-        O2 = offset_of(L2)
-        if pop_jump == POP_JUMP_IF_FALSE:
-            return ((x+2,OJF),(OJF+1,O2),(x,O2))
-        return ((OJF+1,O2),(x+2,OJF),(x,O2))
-        
-
-    while debugs:
-        x = debugs[0]
-        del debugs[0]
-        bounds = true_false(x)
-        if not bounds: continue
-        (t0,t1),(f0,f1),(a,b) = bounds
-        if func_globals.get('DEBUG',False):
-            using = instructions[t0:t1]
-        else:
-            using = instructions[f0:f1]
-        instructions[a:b] = using
+    guards is a list of (instructions,value) pairs.  At the top of the
+    code, we load each one and check it is still the value we folded.
+    If one isn't, we call invalidate() and carry on in a copy of the
+    unfolded instructions, so this call still sees the new value"""
+    from byteplay import Label,SetLineno,LOAD_CONST,COMPARE_OP,POP_JUMP_IF_FALSE,CALL_FUNCTION,POP_TOP
+    slow = Label()
+    prologue = []
+    for load,value in guards:
+        prologue.extend(load)
+        prologue.extend([(LOAD_CONST,value),(COMPARE_OP,'is'),(POP_JUMP_IF_FALSE,slow)])
+    code.code[:0] = prologue
 
-    return code.to_code()
+    # The folded code always ends in a return, so we never fall in
+    # here.  Line numbers can't go backwards in co_lnotab, so the copy
+    # loses its own (it only runs once per rebinding anyway)
+    code.code.extend([(slow,None),(LOAD_CONST,invalidate),(CALL_FUNCTION,0),(POP_TOP,None)])
+    code.code.extend(x for x in __clone_instructions__(unfolded) if x[0] != SetLineno)
+    return
 
-def smartdebug(f):
-    """a decorator to intelligently remove if DEBUG: code
+def __guarded_cache_globals__(code,f,respecialize=False):
+    "Cache global objects in co_consts behind guards.  See @guarded_cache_globals"
+    from byteplay import LOAD_CONST, LOAD_GLOBAL, LOAD_ATTR
+    from types import ModuleType
+    func_globals = f.func_globals
+    unfolded = code.code[:]
 
-    We often spend a lot of time sprinkling debug code around
-    our functions.  We sometimes want it turned on, and more
-    often turned off.  This decorator checks the global DEBUG
-    statement once, and then strips out conditional code as
-    needed.
-    """
-    def action(co):
-        return __smartdebug__(co,f.func_globals)
-    f.func_code = __transform_codeobjects__(f.func_code,action)
-    return f
+    # Same folding as __cache_globals__, except that we only follow
+    # attributes of modules (we can check those cheaply, where a
+    # class attribute can hand back a new bound method each time).
+    # We remember the path to each fold as (name,attr,...)
+    missing = object()
+    folds = {}
+    module = None
+    pc = 0
+    while pc < len(code.code):
+        op,arg = code.code[pc]
+        path = None
+        if op == LOAD_GLOBAL:
+            const = func_globals.get(arg,missing)
+            if const is missing:
+                const = __builtins__.get(arg,missing)
+            if const is not missing:
+                code.code[pc] = __fold__(const,('global',arg))
+                path = (arg,)
 
-def __levels__(instructions):
-    "find implied stack levels for each bytecode.  Not general purpose"
-    from byteplay import getse
-    levels = []
-    level = 0
-    for pc,(op,arg) in enumerate(instructions):
-        try:
-            pop,push = getse(op,arg)
-        except ValueError:
-            pop = 0
-            push = 0
-        level += (push-pop)
-        levels.append(level)
-    return levels
+        elif op == LOAD_ATTR and module is not None:
+            const = getattr(code.code[pc-1][1],arg,missing)
+            if const is not missing:
+                path = module+(arg,)
+                code.code[pc-1:pc+1] = [__fold__(const,('global',)+path)]
+                pc -= 1
 
-def __unprint__(co):
+        module = None
+        if path is not None:
+            folds[path] = const
+            if isinstance(const,ModuleType): module = path
+        pc += 1
+
+    if not folds: return False
+
+    # A global name is checked with a LOAD_GLOBAL (which also sees it
+    # if it shadows a builtin).  An attribute is checked against the
+    # module we already checked, so sort parents first
+    guards = []
+    for path in sorted(folds,key=lambda p: (len(p),p)):
+        if len(path) == 1:
+            load = [(LOAD_GLOBAL,path[0])]
+        else:
+            load = [(LOAD_CONST,folds[path[:-1]]),(LOAD_ATTR,path[-1])]
+        guards.append((load,folds[path]))
+
+    passes = None
+    if respecialize:
+        passes = [__respecialize_globals__]
+    __guard__(code,unfolded,guards,__invalidator__(f,passes))
+    return True
+
+def __respecialize_globals__(code,f):
+    "__guarded_cache_globals__ that re-specializes when a guard fails"
+    return __guarded_cache_globals__(code,f,True)
+
+def guarded_cache_globals(f=None,respecialize=False):
+    """Like @cache_globals, but safe when globals get rebound
+
+    The folded constants are checked at the top of each call (one
+    lookup per global or module attribute used, however often the
+    body uses it).  If someone rebinds one -- reloads a module, swaps
+    out a config object, monkey patches math.sin -- that call runs
+    the original code, and the function goes back to its original
+    code object for good.  With respecialize=True, it instead folds
+    the new values in and guards those:
+
+    @guarded_cache_globals
+    def f(x): ...
+
+    @guarded_cache_globals(respecialize=True)
+    def g(x): ...
+
+    Only attributes of modules are folded.  Deleting a global the
+    function uses makes the check raise NameError on the next call.
+    In a pipeline, falling back drops what the other passes did too."""
+    if f is None:
+        return lambda f: guarded_cache_globals(f,respecialize)
+    if respecialize:
+        return __transform_function__(f,[__respecialize_globals__])
+    return __transform_function__(f,[__guarded_cache_globals__])
+guarded_cache_globals.bytecode_pass = __guarded_cache_globals__
+
+def __pure_constant__(x):
+    "True for the immutable builtin values that are safe to compute with ahead of time"
+    if type(x) in (int,long,float,complex,bool,str,unicode,type(None)): return True
+    if type(x) in (tuple,frozenset):
+        for y in x:
+            if not __pure_constant__(y): return False
+        return True
+    return False
+
+def __constant_operations__():
+    "Opcode (or comparison) -> (function,number of arguments) for what we fold"
+    import operator
+    from byteplay import opmap
+    binary = {
+        'ADD':operator.add, 'SUBTRACT':operator.sub, 'MULTIPLY':operator.mul,
+        'DIVIDE':operator.div, 'TRUE_DIVIDE':operator.truediv,
+        'FLOOR_DIVIDE':operator.floordiv, 'MODULO':operator.mod,
+        'POWER':operator.pow, 'LSHIFT':operator.lshift, 'RSHIFT':operator.rshift,
+        'AND':operator.and_, 'OR':operator.or_, 'XOR':operator.xor,
+        }
+    operations = {
+        opmap['UNARY_POSITIVE']:(operator.pos,1),
+        opmap['UNARY_NEGATIVE']:(operator.neg,1),
+        opmap['UNARY_INVERT']:(operator.invert,1),
+        opmap['UNARY_NOT']:(operator.not_,1),
+        opmap['BINARY_SUBSCR']:(operator.getitem,2),
+        '<':(operator.lt,2), '<=':(operator.le,2),
+        '==':(operator.eq,2), '!=':(operator.ne,2),
+        '>':(operator.gt,2), '>=':(operator.ge,2),
+        'in':(lambda x,y: x in y,2), 'not in':(lambda x,y: x not in y,2),
+        'is':(operator.is_,2), 'is not':(operator.is_not,2),
+        }
+    for name,function in binary.iteritems():
+        # On immutable values, the in-place versions do the same thing
+        operations[opmap['BINARY_'+name]] = (function,2)
+        operations[opmap['INPLACE_'+name]] = (function,2)
+    return operations
+
+def __evaluate_constant__(function,args,limit=20):
+    """function(*args), unless that could be slow or make something big
+
+    Returns a (value,) tuple, or () if we shouldn't fold.  Like the
+    compiler's own peephole optimizer, we keep sequences to 20 items"""
+    import operator
+    integers = (int,long)
+    if function in (operator.pow,operator.lshift):
+        x,y = args
+        if isinstance(x,integers) and isinstance(y,integers) and y > 128 and abs(x) > 1:
+            return ()
+    elif function is operator.mul:
+        for x,y in (args,args[::-1]):
+            if isinstance(x,(str,unicode,tuple)) and isinstance(y,integers) and len(x)*y > limit:
+                return ()
+    try:
+        value = function(*args)
+    except Exception:
+        return ()  # Let it raise when it runs, like it used to
+    if isinstance(value,(str,unicode,tuple,frozenset)) and len(value) > limit:
+        return ()
+    return (value,)
+
+def __remove_unreachable__(code):
+    "Drop the instructions nothing can get to (and jumps to the next one).  True if there were any"
+    from byteplay import Label,SetLineno,hasjump,JUMP_ABSOLUTE,JUMP_FORWARD,RETURN_VALUE,RAISE_VARARGS,BREAK_LOOP,CONTINUE_LOOP
+    instructions = code.code
+    stops = (JUMP_ABSOLUTE,JUMP_FORWARD,RETURN_VALUE,RAISE_VARARGS,BREAK_LOOP,CONTINUE_LOOP)
+    where = dict( (op,pc) for pc,(op,_) in enumerate(instructions) if isinstance(op,Label) )
+    live = [False]*len(instructions)
+    worklist = [0]
+    while worklist:
+        pc = worklist.pop()
+        while pc < len(instructions) and not live[pc]:
+            live[pc] = True
+            op,arg = instructions[pc]
+            if op in hasjump: worklist.append(where[arg])
+            if op in stops: break
+            pc += 1
+    changed = not all(live)
+    if changed:
+        instructions[:] = [x for x,alive in zip(instructions,live) if alive]
+
+    # Dropping a branch often leaves a jump to the very next instruction
+    pc = 0
+    while pc < len(instructions):
+        op,arg = instructions[pc]
+        if op in (JUMP_ABSOLUTE,JUMP_FORWARD):
+            following = pc+1
+            while following < len(instructions) and instructions[following][0] is not arg and \
+                  (instructions[following][0] == SetLineno or isinstance(instructions[following][0],Label)):
+                following += 1
+            if following < len(instructions) and instructions[following][0] is arg:
+                del instructions[pc]
+                changed = True
+                continue
+        pc += 1
+    return changed
+
+def __fold_constants__(code,f):
+    "Fold operations on constants and the branches they decide.  See @fold_constants"
+    from byteplay import LOAD_CONST,COMPARE_OP,BUILD_TUPLE,POP_TOP,JUMP_ABSOLUTE, \
+        POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE,JUMP_IF_FALSE_OR_POP,JUMP_IF_TRUE_OR_POP
+    operations = __constant_operations__()
+    instructions = code.code
+
+    def constants(pc,n):
+        "The n pure constants loaded right before pc (or None)"
+        if pc < n: return None
+        loads = instructions[pc-n:pc]
+        for op,arg in loads:
+            if op != LOAD_CONST or not __pure_constant__(arg): return None
+        return loads
+
+    changed = False
+    pc = 0
+    while pc < len(instructions):
+        op,arg = instructions[pc]
+        replacement = None
+        if op == COMPARE_OP or op in operations:
+            function,n = operations.get(arg if op == COMPARE_OP else op,(None,0))
+            loads = function and constants(pc,n)
+            value = loads and __evaluate_constant__(function,[x[1] for x in loads])
+            if value:
+                replacement = (n,[(LOAD_CONST,value[0])])
+
+        elif op == BUILD_TUPLE:
+            loads = constants(pc,arg)
+            if loads is not None:
+                replacement = (arg,[(LOAD_CONST,tuple(x[1] for x in loads))])
+
+        elif op == POP_TOP:
+            loads = constants(pc,1)
+            if loads: replacement = (1,[])
+
+        elif op in (POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE,JUMP_IF_FALSE_OR_POP,JUMP_IF_TRUE_OR_POP):
+            # The test is decided, so we either always jump or never do
+            loads = constants(pc,1)
+            if loads:
+                jumps = bool(loads[0][1]) == (op in (POP_JUMP_IF_TRUE,JUMP_IF_TRUE_OR_POP))
+                if not jumps:
+                    replacement = (1,[])
+                elif op in (POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE):
+                    replacement = (1,[(JUMP_ABSOLUTE,arg)])
+                else:
+                    replacement = (0,[(JUMP_ABSOLUTE,arg)])  # The test stays as the value
+
+        if replacement is None:
+            pc += 1
+            continue
+
+        # The values we used may have been folded from globals, so
+        # the code cache needs to check they haven't changed
+        n,new = replacement
+        for load in instructions[pc-n:pc]: __assume__(load)
+        instructions[pc-n:pc+1] = new
+        pc = pc-n+len(new)
+        changed = True
+
+    if __remove_unreachable__(code): changed = True
+    return changed
+
+def fold_constants(f):
+    """This decorator computes constant expressions ahead of time
+
+    After @cache_globals (or the mass rewriters) have turned math.pi
+    or CONFIG.retries into a constant, something like math.pi * 2 or
+    CONFIG.retries + 1 still gets computed on every call.  This folds
+    operations on constants (for numbers, strings, tuples and the like;
+    other objects might have side effects), and when a test like
+    "if CONFIG.verbose:" is decided, it removes the branch that can't
+    run.  Unused constants and names drop out when the code is
+    reassembled.  Use it after the caching:
+
+    @pipeline(cache_globals,fold_constants)
+    def f(x): ..."""
+    return __transform_function__(f,[__fold_constants__])
+fold_constants.bytecode_pass = __fold_constants__
+
+
+def __bake_flags__(code,f,wanted,default=(),tests_only=False):
+    """Turn loads of the globals wanted(name) picks into constants, then fold.  True if changed
+
+    Flags missing from the globals become default[0] if there is one
+    (otherwise they're left alone).  With tests_only, we only touch
+    loads that go straight into a conditional jump, and a flag that
+    isn't a plain constant (an object with a __nonzero__) is baked in
+    as its truth where the jump pops it"""
+    from byteplay import LOAD_GLOBAL,LOAD_CONST, \
+        POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE,JUMP_IF_FALSE_OR_POP,JUMP_IF_TRUE_OR_POP
+    tests = (POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE,JUMP_IF_FALSE_OR_POP,JUMP_IF_TRUE_OR_POP)
+    func_globals = f.func_globals
+    instructions = code.code
+    baked = False
+    for pc,(op,arg) in enumerate(instructions):
+        if op != LOAD_GLOBAL or not wanted(arg): continue
+        if tests_only and instructions[pc+1][0] not in tests: continue
+        if arg in func_globals:
+            value = func_globals[arg]
+            if tests_only and not __pure_constant__(value):
+                # Folding won't touch it, and DEBUG or x keeps the
+                # value itself
+                if instructions[pc+1][0] not in (POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE): continue
+                value = bool(value)
+            instructions[pc] = __fold__(value,('global',arg))
+        elif default:
+            instructions[pc] = (LOAD_CONST,default[0])
+        else:
+            continue
+        baked = True
+
+    # Folding does the real work of picking the branches
+    if not baked: return False
+    __fold_constants__(code,f)
+    return True
+
+def __specialize_flags__(flags):
+    "A pass that bakes in the flags (names, or a predicate on names).  See @specialize_flags"
+    from types import FunctionType
+    if callable(flags):
+        wanted = flags
+        key = None
+        if isinstance(flags,FunctionType) and flags.__name__ != '<lambda>' and not flags.func_closure:
+            key = ('specialize_flags',flags.__module__,flags.__name__)
+    else:
+        flags = tuple(sorted(flags))
+        wanted = frozenset(flags).__contains__
+        key = ('specialize_flags',flags)
+
+    def transform(code,f):
+        return __bake_flags__(code,f,wanted)
+    if key is not None:
+        transform.cache_key = key
+    if not callable(flags):
+        transform.cache_flags = flags
+    return transform
+
+def specialize_flags(*flags):
+    """A decorator that compiles in module level feature flags
+
+    Hot paths often branch on flags that are fixed for the life of
+    the process.  Name them (or give a predicate that picks them by
+    name) and their current values are baked into the function, then
+    folded (see @fold_constants) so every branch they decide goes away.
+    That covers if/elif chains, ifs in loops, "and"/"or" and "not":
+
+    @specialize_flags('USE_CACHE','VERBOSE')
+    def f(x): ...
+
+    @specialize_flags(lambda name: name.startswith('FEATURE_'))
+    def g(x): ...
+
+    Flags that aren't defined yet are left alone.  Changing a flag
+    later has no effect on functions that were already specialized.
+    See make_flags_constant for a whole module"""
+    if len(flags) == 1 and callable(flags[0]): flags = flags[0]
+    transform = __specialize_flags__(flags)
+    def decorator(f):
+        return __transform_function__(f,[transform])
+    return decorator
+
+def __smartdebug__(code,f):
+    """Apply smartdebug to code objects, see @smartdebug"""
+    # DEBUG is just a flag (False if it isn't there), though we only
+    # bake it into tests so other uses still see the live value
+    return __bake_flags__(code,f,lambda name: name == 'DEBUG',(False,),True)
+
+def smartdebug(f):
+    """a decorator to intelligently remove if DEBUG: code
+
+    We often spend a lot of time sprinkling debug code around
+    our functions.  We sometimes want it turned on, and more
+    often turned off.  This decorator checks the global DEBUG
+    statement once, and then strips out conditional code as
+    needed.  See @specialize_flags for other flags.
+    """
+    return __transform_function__(f,[__smartdebug__])
+smartdebug.bytecode_pass = __smartdebug__
+__smartdebug__.cache_flags = ('DEBUG',)
+
+class StackLevels(list):
+    """The stack level after each instruction in a byteplay code list
+
+    levels[pc] is the number of values on the stack after
+    instructions[pc] runs (labels and SetLineno just pass the level
+    along).  Unlike a running sum, this follows the control flow: each
+    basic block starts at the level its predecessors leave it, so
+    the levels are right after branches, inside loops, and in
+    conditional expressions.  We use the same stack model that
+    byteplay uses to find co_stacksize.  Code that can't be reached
+    starts at 0.
+
+    Each block is visited once, so this is linear in the size of
+    the code.  After an edit, delete() patches the levels up in
+    place when it can rather than starting over.
+
+    levels = StackLevels(code.code)
+    start = levels.expression_start(pc)   # what feeds instruction pc?
+    levels.delete(start,pc+1)             # ... and get rid of it all
+    """
+    def __init__(self,instructions):
+        list.__init__(self)
+        self.instructions = instructions
+        self.recompute()
+        return
+
+    def recompute(self):
+        "Work out all the levels from scratch"
+        from byteplay import Label,isopcode,getse,hasflow,hasjump, \
+            STOP_CODE,RETURN_VALUE,RAISE_VARARGS,BREAK_LOOP, \
+            JUMP_FORWARD,JUMP_ABSOLUTE,CONTINUE_LOOP, \
+            POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE, \
+            JUMP_IF_FALSE_OR_POP,JUMP_IF_TRUE_OR_POP, \
+            FOR_ITER,SETUP_LOOP,SETUP_EXCEPT,SETUP_FINALLY,SETUP_WITH, \
+            POP_BLOCK,END_FINALLY,WITH_CLEANUP
+        instructions = self.instructions
+        size = len(instructions)
+        label_pos = dict((op,pos) for pos,(op,arg) in enumerate(instructions)
+                         if isinstance(op,Label))
+
+        # Who jumps where (handy for anyone walking backwards)
+        self.sources = {}
+        for pos,(op,arg) in enumerate(instructions):
+            if op in hasjump: self.sources.setdefault(arg,[]).append(pos)
+
+        # Like byteplay, the state is a tuple with the number of values
+        # pushed inside each block (SETUP_LOOP, SETUP_EXCEPT, ...).  A
+        # SETUP_FINALLY target is recorded with the 3 values an
+        # exception would push
+        sf_targets = set(label_pos[arg] for op,arg in instructions
+                         if op == SETUP_FINALLY)
+        before = [None]*size
+        after = [0]*size
+        starts = set([0])
+
+        def add(stack,n):
+            if not stack: stack = (0,)
+            return stack[:-1]+(stack[-1]+n,)
+
+        def walk(pos,stack):
+            "Follow one basic block, returns where control can go next"
+            while pos < size:
+                op,arg = instructions[pos]
+                if isinstance(op,Label):
+                    if pos in sf_targets: stack = add(stack,2)
+                    if before[pos] is not None: return []
+                    starts.add(pos)
+                before[pos] = stack
+                if not isopcode(op):
+                    after[pos] = sum(stack)
+                    pos += 1
+                    continue
+
+                jumps = []
+                fallthrough = True
+                if op in (STOP_CODE,RETURN_VALUE,RAISE_VARARGS,BREAK_LOOP):
+                    if op == RETURN_VALUE: stack = add(stack,-1)
+                    if op == RAISE_VARARGS: stack = add(stack,-arg)
+                    fallthrough = False
+                elif op not in hasflow:
+                    pop,push = getse(op,arg)
+                    stack = add(stack,push-pop)
+                elif op in (JUMP_FORWARD,JUMP_ABSOLUTE,CONTINUE_LOOP):
+                    jumps.append((label_pos[arg],stack))
+                    fallthrough = False
+                elif op in (POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE):
+                    stack = add(stack,-1)
+                    jumps.append((label_pos[arg],stack))
+                elif op in (JUMP_IF_FALSE_OR_POP,JUMP_IF_TRUE_OR_POP):
+                    jumps.append((label_pos[arg],stack))
+                    stack = add(stack,-1)
+                elif op == FOR_ITER:
+                    jumps.append((label_pos[arg],add(stack,-1)))
+                    stack = add(stack,1)
+                elif op == SETUP_LOOP:
+                    jumps.append((label_pos[arg],stack))
+                    stack = stack+(0,)
+                elif op in (SETUP_EXCEPT,SETUP_FINALLY):
+                    jumps.append((label_pos[arg],add(stack,3 if op == SETUP_EXCEPT else 1)))
+                    stack = stack+(0,)
+                elif op == SETUP_WITH:
+                    jumps.append((label_pos[arg],stack))
+                    stack = add(stack,-1)+(1,)
+                elif op == POP_BLOCK:
+                    stack = stack[:-1]
+                elif op == END_FINALLY:
+                    stack = add(stack,-3)
+                elif op == WITH_CLEANUP:
+                    stack = add(stack,2)
+                after[pos] = sum(stack)
+
+                # Any flow op ends the basic block
+                if op in hasflow or not fallthrough:
+                    if fallthrough: jumps.append((pos+1,stack))
+                    for target,_ in jumps: starts.add(target)
+                    return jumps
+                pos += 1
+            return []
+
+        # Everything we can reach from the top, then anything left over
+        for entry in xrange(size):
+            if before[entry] is not None: continue
+            starts.add(entry)
+            work = [(entry,(0,))]
+            while work:
+                work.extend(walk(*work.pop()))
+
+        self[:] = after
+        self.__before = [sum(stack) for stack in before]
+        self.__blocks = [len(stack)-1 for stack in before]
+        self.starts = sorted(x for x in starts if x < size)
+        return
+
+    def before(self,pc):
+        "stack level just before instructions[pc] runs"
+        return self.__before[pc]
+
+    def blocks(self,pc):
+        "How many blocks (loops, try, with) are open just before instructions[pc] runs"
+        return self.__blocks[pc]
+
+    def expression_start(self,pc):
+        """Where does the code that computes the values used by instructions[pc] begin?
+
+        We walk back while the stack is above the level left after
+        pc.  If that takes in a label that is jumped to from further
+        back (as in a if b else c, or a and b), we take in the jump
+        and keep going so the whole expression is covered"""
+        from byteplay import Label
+        target = self[pc]
+        start = pc
+        while True:
+            k = start-1
+            while k >= 0 and self[k] > target: k -= 1
+            start = k+1
+
+            earliest = start
+            for i in xrange(start,pc+1):
+                op = self.instructions[i][0]
+                if isinstance(op,Label):
+                    earliest = min([earliest]+self.sources.get(op,[]))
+            if earliest == start: return start
+            start = earliest
+
+    def delete(self,start,stop):
+        """Delete instructions[start:stop] and bring the levels up to date
+
+        If the run is straight-line code that leaves the stack the way
+        it found it, nothing else can change and we just patch up the
+        levels.  Otherwise, we start over"""
+        from byteplay import isopcode,hasflow
+        run = self.instructions[start:stop]
+        straight = all(isopcode(op) and op not in hasflow for op,_ in run)
+        neutral = stop > start and self[stop-1] == self.__before[start]
+        del self.instructions[start:stop]
+        if not (straight and neutral):
+            self.recompute()
+            return
+
+        # Nothing in the run can start a block or jump, so all we need
+        # to do is slide everything after it down
+        size = stop-start
+        del self[start:stop]
+        del self.__before[start:stop]
+        del self.__blocks[start:stop]
+        self.starts = [x if x < start else x-size for x in self.starts
+                       if x <= start or x >= stop]
+        for label,pcs in self.sources.iteritems():
+            self.sources[label] = [x if x < start else x-size for x in pcs]
+        return
+
+def __unprint__(code,f):
     "Apply unprint to code objects.  See @unprint"
-    from byteplay import Code,getse, \
+    from byteplay import getse, \
         PRINT_ITEM,PRINT_NEWLINE, \
         PRINT_ITEM_TO, PRINT_NEWLINE_TO, \
         POP_TOP, ROT_TWO, DUP_TOP
 
-    code = Code.from_code(co)
     instructions = code.code
 
     # Now we kill every PRINT_NEWLINE and PRINT_ITEM
     # (and associated value computations)
-    levels = __levels__(instructions)
+    levels = StackLevels(instructions)
     kills = set()
 
     def killback(pc):
-        kills.add(pc)
-        target_level = levels[pc]
-        pc -= 1
-        while pc >= 0 and levels[pc] > target_level:
-            kills.add(pc)
-            pc -= 1
-        return pc
+        start = levels.expression_start(pc)
+        kills.update(xrange(start,pc+1))
+        return start-1
     for pc,(op,arg) in enumerate(instructions):
         if pc in kills: continue
 
@@ -545,7 +2007,7 @@ def __unprint__(co):
     for x in reversed(sorted(kills)):
         del instructions[x]
     
-    return code.to_code()
+    return bool(kills)
 
 def unprint(f):
     """A decorator to remove print statements
@@ -553,40 +2015,190 @@ def unprint(f):
     Strips out all print statements (and any side effects involved
     in their output)."""
     
-    f.func_code = __transform_codeobjects__(f.func_code,__unprint__)
-    return f
+    return __transform_function__(f,[__unprint__])
+unprint.bytecode_pass = __unprint__
 
-def __debuggable__(co):
-    "Apply DEBUG() calls in a code object.  See @debuggable"
-    from byteplay import Code, LOAD_GLOBAL, CALL_FUNCTION, POP_TOP
-    # First, we want to crack open the function and look at it's bytecodes
-    code = Code.from_code(co)
+def __log_methods__():
+    "Logger method name -> the level it logs at"
+    import logging
+    return {
+        'debug':logging.DEBUG,
+        'info':logging.INFO,
+        'warning':logging.WARNING, 'warn':logging.WARNING,
+        'error':logging.ERROR, 'exception':logging.ERROR,
+        'critical':logging.CRITICAL, 'fatal':logging.CRITICAL,
+        }
+
+def __logger_of__(value):
+    """The logger that decides whether value.debug(...) etc. log anything (or None)
+
+    The logging module's own functions use the root logger (but set
+    it up first if it has no handlers, so we leave those alone then)"""
+    import logging
+    if isinstance(value,(logging.Logger,logging.LoggerAdapter)): return value
+    if value is logging and logging.root.handlers: return logging.root
+    return None
+
+def __logging_state__(f):
+    "Which levels are on for the loggers f's globals can see (for the code cache key)"
+    levels = sorted(set(__log_methods__().itervalues()))
+    state = []
+    for name,value in sorted(f.func_globals.iteritems()):
+        logger = __logger_of__(value)
+        if logger is not None:
+            state.append((name,[logger.isEnabledFor(level) for level in levels]))
+    return state
+
+def __unlog__(code,f,loggers=None,methods=None):
+    """Apply unlog to code objects.  See @unlog
+
+    loggers limits us to the globals with those names, and methods
+    to those logger methods"""
+    from byteplay import LOAD_GLOBAL,LOAD_CONST,LOAD_ATTR,POP_TOP, \
+        CALL_FUNCTION,CALL_FUNCTION_VAR,CALL_FUNCTION_KW,CALL_FUNCTION_VAR_KW
+    calls = (CALL_FUNCTION,CALL_FUNCTION_VAR,CALL_FUNCTION_KW,CALL_FUNCTION_VAR_KW)
+    levels_of = __log_methods__()
+    if methods is not None:
+        levels_of = dict( (m,levels_of[m]) for m in methods )
+    func_globals = f.func_globals
+    named = None
+    if loggers is not None:
+        named = [func_globals.get(name) for name in loggers]
+
+    def disabled(load,source,method):
+        "Is the call to source.method we found one that won't log?"
+        if method not in levels_of: return False
+        if load == LOAD_GLOBAL:
+            if loggers is not None and source not in loggers: return False
+            source = func_globals.get(source)
+        elif load != LOAD_CONST or (named is not None and not [x for x in named if x is source]):
+            return False
+        logger = __logger_of__(source)
+        return logger is not None and not logger.isEnabledFor(levels_of[method])
+
+    # Like unprint, we find the whole statement by walking back from
+    # where its value gets thrown away, so arguments go too
+    instructions = code.code
+    levels = StackLevels(instructions)
+    changed = False
     pc = 0
-    while pc < len(code.code):
-        # Look for LOAD_GLOBAL,DEBUG
-        op,arg = code.code[pc]
-        if op != LOAD_GLOBAL or arg != 'DEBUG':
+    while pc < len(instructions):
+        if instructions[pc][0] != POP_TOP or pc == 0 or instructions[pc-1][0] not in calls:
             pc += 1
             continue
-        expr_start = pc
-        pc += 1
+        start = levels.expression_start(pc)
+        if pc-start < 3:
+            pc += 1
+            continue
+        (load,source),(attr,method) = instructions[start:start+2]
+        if attr != LOAD_ATTR or not disabled(load,source,method):
+            pc += 1
+            continue
+
+        # The method has to be what the last call calls (not, say,
+        # log.debug(x)(y)).  Its arguments all sit above it
+        above = levels[start+1]
+        if [i for i in xrange(start+2,pc-1) if levels[i] <= above]:
+            pc += 1
+            continue
+
+        levels.delete(start,pc+1)
+        pc = start
+        changed = True
+
+    return changed
+__unlog__.cache_state = __logging_state__
+__unlog__.refreshable = True
+
+def __unlog_pass__(loggers,methods):
+    "The unlog pass for some loggers and methods (None for all)"
+    if loggers is None and methods is None: return __unlog__
+    if loggers is not None: loggers = tuple(sorted(loggers))
+    if methods is not None: methods = tuple(sorted(methods))
+    def transform(code,f):
+        return __unlog__(code,f,loggers,methods)
+    transform.cache_key = ('unlog',loggers,methods)
+    transform.cache_state = __logging_state__
+    transform.refreshable = True
+    return transform
+
+def unlog(f=None,loggers=None,methods=None):
+    """A decorator to remove logging calls that won't log anything
+
+    The trouble with
+
+    log.debug('state is %s' % expensive())
 
-        # Figure out the "stack level" at each opcode
-        levels = __levels__(code.code)
-        start_level = levels[expr_start]
+    is that we pay for expensive() even when debug logging is off.
+    Much like @unprint, this strips out calls on loggers (and the
+    logging module itself) whose level is disabled right now, along
+    with everything computed for their arguments.  It only looks at
+    loggers that are globals (or have been folded into constants),
+    and you can limit it to some of them or some of the methods:
 
-        # Walk forward seeking a CALL_FUNCTION at the same level
-        n = start_level
-        for n in range(pc+1,len(code.code)):
-            if levels[n] == start_level: break
+    @unlog(loggers=['log'],methods=['debug','info'])
+    def f(x): ...
 
-        # We should be at a CALL_FUNCTION.  It's value should
-        # not be used.  If it is, we don't remove it
-        if code.code[n][0] != CALL_FUNCTION: continue
-        if code.code[n+1][0] != POP_TOP: continue
-        del code.code[expr_start:n+2]
+    If you change the levels later, call refresh_logging()."""
+    if f is None:
+        return lambda f: unlog(f,loggers,methods)
+    return __transform_function__(f,[__unlog_pass__(loggers,methods)])
+unlog.bytecode_pass = __unlog__
 
-    return code.to_code()
+def refresh_logging():
+    """Redo @unlog (and the import hook's logging option) for the current levels
+
+    Every function that went through it gets its original code back
+    and its transforms run again, so calls that would now log come
+    back (and ones that wouldn't go).  Returns how many were redone"""
+    redone = __refreshable__.items()
+    for f,(original,passes) in redone:
+        f.func_code = original
+        __transform_function__(f,passes)
+    return len(redone)
+
+def __debuggable__(code,f):
+    "Apply DEBUG() calls in a code object.  See @debuggable"
+    from byteplay import Label,isopcode,hasjump,LOAD_GLOBAL,CALL_FUNCTION,POP_TOP
+    if f.func_globals.get("DEBUGGING",False): return False
+
+    # Like unlog, we find the whole statement by walking back from
+    # where its value gets thrown away, so arguments that branch
+    # (DEBUG(a if c else b)) go too.  We keep the levels up to date
+    # as we delete calls
+    instructions = code.code
+    levels = StackLevels(instructions)
+    changed = False
+    pc = 0
+    while pc < len(instructions):
+        if instructions[pc][0] != POP_TOP or pc == 0 or instructions[pc-1][0] != CALL_FUNCTION:
+            pc += 1
+            continue
+        start = levels.expression_start(pc)
+        if instructions[start] != (LOAD_GLOBAL,'DEBUG'):
+            pc += 1
+            continue
+
+        # DEBUG has to be what the call calls (not DEBUG(x)(y)), so
+        # its arguments all sit above it.  The tests and labels inside
+        # an argument are the only things that leave it on top.  And
+        # nothing after the statement can jump into it
+        above = levels[start]
+        if [i for i in xrange(start+1,pc-1) if levels[i] <= above and
+            isopcode(instructions[i][0]) and instructions[i][0] not in hasjump]:
+            pc += 1
+            continue
+        outside = [x for op,_ in instructions[start:pc+1] if isinstance(op,Label)
+                   for x in levels.sources.get(op,[]) if not start <= x <= pc]
+        if outside:
+            pc += 1
+            continue
+
+        levels.delete(start,pc+1)
+        pc = start
+        changed = True
+
+    return changed
 
 def debuggable(f):
     """A decorator to remove DEBUG() calls when DEBUGGING is False
@@ -598,10 +2210,867 @@ def debuggable(f):
     debugging = f.func_globals.get("DEBUGGING",False)
     if debugging: return f
 
-    f.func_code = __transform_codeobjects__(f.func_code,__debuggable__)
+    return __transform_function__(f,[__debuggable__])
+debuggable.bytecode_pass = __debuggable__
+__debuggable__.cache_flags = ('DEBUGGING',)
+
+def __hoist_attributes__(code,f,exclude=()):
+    """Hoist method lookups on unchanging locals out of loops.  See @hoist_attributes"""
+    from byteplay import Label,SetLineno,hasjrel,hasjump,LOAD_FAST,STORE_FAST,DELETE_FAST, \
+        LOAD_ATTR,STORE_ATTR,DELETE_ATTR,SETUP_LOOP,SETUP_EXCEPT,POP_BLOCK,GET_ITER,FOR_ITER, \
+        POP_TOP,JUMP_FORWARD,JUMP_ABSOLUTE,CALL_FUNCTION,CALL_FUNCTION_VAR,CALL_FUNCTION_KW, \
+        CALL_FUNCTION_VAR_KW,SETUP_FINALLY,SETUP_WITH
+    calls = (CALL_FUNCTION,CALL_FUNCTION_VAR,CALL_FUNCTION_KW,CALL_FUNCTION_VAR_KW)
+    blocks = (SETUP_LOOP,SETUP_EXCEPT,SETUP_FINALLY,SETUP_WITH)
+    if SETUP_LOOP not in [op for op,_ in code.code]: return False
+
+    # Find the chains (x.a, x.a.b, ...) that get called right away.
+    # We leave plain attribute reads alone:  any call in the loop
+    # could change self.count, and a method we hoist has to be on a
+    # local the loop does nothing else with (see hoist_loop).  We
+    # know a chain by its LOAD_FAST
+    levels = StackLevels(code.code)
+    chains = {}
+    for pc,(op,arg) in enumerate(code.code):
+        if op != LOAD_FAST: continue
+        end = pc+1
+        while end < len(code.code) and code.code[end][0] == LOAD_ATTR: end += 1
+        if end == pc+1: continue
+        level = levels[end-1]
+        for n in xrange(end,len(code.code)):
+            if levels[n] <= level: break
+        if code.code[n][0] in calls and levels[n] == level:
+            chains[id(code.code[pc])] = tuple(arg for _,arg in code.code[pc:end])
+
+    taken = set(arg for op,arg in code.code if op in (LOAD_FAST,STORE_FAST))
+    made = []
+    def hidden():
+        name = '__hoisted_%d__'%len(made)
+        while name in taken: name += '_'
+        made.append(name)
+        return name
+
+    # Who jumps to each label, so we can tell if a loop is only
+    # entered from the top
+    jumpers = {}
+    for x in code.code:
+        if x[0] in hasjump: jumpers.setdefault(x[1],set()).add(id(x))
+
+    slow_copies = []
+    def hoist(instructions):
+        "Hoist out of the loops in instructions (and loops in those).  Returns the new instructions"
+        result = []
+        pc = 0
+        while pc < len(instructions):
+            op,arg = instructions[pc]
+            stop = pc
+            if op == SETUP_LOOP:
+                # The loop's block runs to its POP_BLOCK (its end label
+                # can be much further on, jumps get threaded through it)
+                depth = 0
+                for stop in xrange(pc,len(instructions)):
+                    if instructions[stop][0] in blocks: depth += 1
+                    if instructions[stop][0] == POP_BLOCK: depth -= 1
+                    if depth == 0: break
+            if stop > pc and depth == 0:
+                result.extend(hoist_loop(instructions[pc:stop+1]))
+                pc = stop+1
+                continue
+            result.append(instructions[pc])
+            pc += 1
+        return result
+
+    def hoist_loop(loop):
+        "loop runs from its SETUP_LOOP to its POP_BLOCK"
+        # We only do for loops, where we can wait until the first trip
+        # round to look things up:  SETUP_LOOP / <iterable> / GET_ITER /
+        # top: FOR_ITER done / <body> / JUMP_ABSOLUTE top / done: POP_BLOCK
+        done = loop[-2][0]
+        for get in xrange(1,len(loop)-3):
+            if loop[get][0] == GET_ITER and loop[get+2] == (FOR_ITER,done): break
+        else:
+            return loop[:1]+hoist(loop[1:])
+        body = loop[get+3:-2]
+
+        # Anything the loop stores to, under any name, is off limits.
+        # That covers aliases (y = x; y.a = 1) at the cost of some misses
+        stored = set(exclude)
+        for op,arg in body:
+            if op in (STORE_FAST,DELETE_FAST,STORE_ATTR,DELETE_ATTR): stored.add(arg)
+
+        # So is any local the loop hands to someone else (swap(x)), or
+        # calls more than one method on (x.a.b() and x.reset()):  they
+        # could rebind x.a, or each other.  Plain reads of its
+        # attributes are fine
+        unsafe = set()
+        called = {}
+        for pc,(op,arg) in enumerate(body):
+            if op != LOAD_FAST: continue
+            chain = chains.get(id(body[pc]))
+            if chain is not None:
+                if stored.intersection(chain): unsafe.add(arg)
+                called.setdefault(arg,set()).add(chain)
+            elif pc+1 == len(body) or body[pc+1][0] != LOAD_ATTR:
+                unsafe.add(arg)
+        unsafe.update(name for name,seen in called.iteritems() if len(seen) > 1)
+
+        names = {}
+        fast = []
+        pc = 0
+        while pc < len(body):
+            chain = chains.get(id(body[pc]))
+            if chain is None or chain[0] in unsafe or stored.intersection(chain):
+                fast.append(body[pc])
+                pc += 1
+                continue
+            if chain not in names: names[chain] = hidden()
+            fast.append((LOAD_FAST,names[chain]))
+            pc += len(chain)
+        if not names: return loop[:1]+hoist(loop[1:])
+
+        # We need the only way in to be from the top, and the copy
+        # below goes at the very end (after the final return) where
+        # relative jumps out of the loop would go backwards.  The
+        # peephole optimizer can make those, but only JUMP_FORWARDs
+        inside = set(op for op,_ in loop if isinstance(op,Label))
+        ids = set(id(x) for x in loop)
+        if [label for label in inside if jumpers.get(label,set())-ids]:
+            return loop[:1]+hoist(loop[1:])
+        jumps = [(op,arg) for op,arg in loop[1:] if op in hasjrel and arg not in inside]
+        if [op for op,_ in jumps if op != JUMP_FORWARD]: return loop[:1]+hoist(loop[1:])
+        outside = set(arg for _,arg in jumps)
+
+        # Look them all up once we know we are going round at least
+        # once (the lookup can have side effects), with a FOR_ITER of
+        # its own.  If any lookup fails (the loop may only touch x.a
+        # when x isn't None) we carry on in a copy of the loop as it
+        # was, so the failure happens where it would have.  As for
+        # __guard__, the copy gives up its line numbers
+        fallback,first,after = Label(),Label(),Label()
+        prologue = [(FOR_ITER,done),(SETUP_EXCEPT,fallback)]
+        for chain,name in sorted(names.iteritems()):
+            prologue.append((LOAD_FAST,chain[0]))
+            prologue.extend((LOAD_ATTR,attr) for attr in chain[1:])
+            prologue.append((STORE_FAST,name))
+        prologue.extend([(POP_BLOCK,None),(JUMP_ABSOLUTE,first)])
+
+        # The copy is entered with the iterator and the first item on
+        # the stack, and is still inside the loop's block
+        copy = [(fallback,None),(POP_TOP,None),(POP_TOP,None),(POP_TOP,None)]
+        cloned = __clone_instructions__(loop[get+1:get+3]+[(first,None)]+body+loop[-3:])
+        copy.append((JUMP_ABSOLUTE,cloned[2][0]))
+        for op,arg in cloned:
+            if op == SetLineno: continue
+            if op == JUMP_FORWARD and arg in outside: op = JUMP_ABSOLUTE
+            copy.append((op,arg))
+        copy.append((JUMP_ABSOLUTE,after))
+        slow_copies.append(copy)
+        return loop[:get+1]+prologue+loop[get+1:get+3]+[(first,None)]+hoist(fast)+loop[-3:]+[(after,None)]
+
+    instructions = hoist(code.code)
+    if not slow_copies: return False
+    for copy in slow_copies: instructions.extend(copy)
+    code.code[:] = instructions
+    return True
+
+def __hoist_attributes_pass__(exclude):
+    "The hoisting pass, leaving the names in exclude alone"
+    if not exclude: return __hoist_attributes__
+    exclude = tuple(sorted(exclude))
+    def transform(code,f):
+        return __hoist_attributes__(code,f,exclude)
+    transform.cache_key = ('hoist_attributes',exclude)
+    return transform
+
+def hoist_attributes(f=None,exclude=()):
+    """Look up methods on unchanging locals once per loop, not every time round
+
+    In
+
+    for x in xs:
+        out.append(x)
+        self.buf.write(str(x))
+
+    every trip around the loop looks up out.append and self.buf.write
+    (and makes a new bound method for each).  We rewrite it as if it
+    were
+
+    for x in xs:
+        if first time round:
+            __hoisted_0__ = out.append
+            __hoisted_1__ = self.buf.write
+        __hoisted_0__(x)
+        __hoisted_1__(str(x))
+
+    (the first trip has a FOR_ITER of its own, so there is no test)
+
+    A lookup x.a.b(...) in a for loop is hoisted when it is called
+    on the spot, x is a local the loop never assigns, the loop never
+    stores to (or deletes) an attribute called a or b on *anything*,
+    and the loop does nothing else with x than read its attributes
+    and make that one call.  So passing x to swap(x), or calling
+    x.reset() too, keeps x.a.b(...) in the loop.  The lookups happen
+    after the first item comes out of the iterator, so a loop that
+    doesn't go round doesn't make them.  We still can't see what
+    everything the loop calls does, so if something reaches self.buf
+    another way (a global, or another reference to the same object)
+    and rebinds it, name it in exclude (local or attribute names):
+
+    @hoist_attributes(exclude=['buf'])
+    def f(self,xs): ...
+
+    If a lookup fails, the loop carries on as written, so the error
+    comes where it would have (or not at all).  while loops are
+    left alone.  For globals, see @cache_globals"""
+    if f is None:
+        return lambda f: hoist_attributes(f,exclude)
+    return __transform_function__(f,[__hoist_attributes_pass__(exclude)])
+hoist_attributes.bytecode_pass = __hoist_attributes__
+
+def __reuse_attributes__(code,f):
+    "Load repeated attribute chains on locals once per basic block.  See @reuse_attributes"
+    from byteplay import isopcode,LOAD_FAST,STORE_FAST,DELETE_FAST,LOAD_ATTR,LOAD_CONST, \
+        LOAD_GLOBAL,LOAD_DEREF,LOAD_CLOSURE,POP_TOP,ROT_TWO,ROT_THREE,ROT_FOUR,DUP_TOP,DUP_TOPX, \
+        BUILD_TUPLE,BUILD_LIST,NOP
+    # Almost anything can run Python code (an __add__, a __nonzero__,
+    # a property, an __iter__), and that could change what a chain
+    # gives back.  These can't, so they are all we let in between
+    inert = set([LOAD_FAST,LOAD_CONST,LOAD_GLOBAL,LOAD_DEREF,LOAD_CLOSURE,POP_TOP,
+                 ROT_TWO,ROT_THREE,ROT_FOUR,DUP_TOP,DUP_TOPX,BUILD_TUPLE,BUILD_LIST,NOP])
+    instructions = code.code
+    if LOAD_ATTR not in [op for op,_ in instructions]: return False
+    levels = StackLevels(instructions)
+
+    # Walk each basic block, noting every LOAD_FAST x; LOAD_ATTR a;
+    # LOAD_ATTR b ... as (pc,chain).  Each prefix of a chain gets a key
+    # that changes whenever something could change what it loads
+    occurrences = []
+    uses = {}
+    era = 0
+    eras = {}  # Stores to each local
+    starts = set(levels.starts)
+    chained = set()  # The LOAD_ATTRs of the chains
+    for pc,(op,arg) in enumerate(instructions):
+        if pc in starts: era += 1
+        if op in (STORE_FAST,DELETE_FAST):
+            eras[arg] = pc
+        elif op == LOAD_FAST:
+            stop = pc+1
+            while stop < len(instructions) and instructions[stop][0] == LOAD_ATTR and stop not in starts:
+                stop += 1
+            if stop == pc+1: continue
+            # Straight loads: each one just adds to the stack
+            if [k for k in xrange(pc,stop) if levels[k] != levels.before(pc)+1]: continue
+            chain = tuple(x for _,x in instructions[pc:stop])
+            keys = [(chain[:n],era,eras.get(arg)) for n in xrange(2,len(chain)+1)]
+            occurrences.append((pc,keys))
+            for key in keys: uses[key] = uses.get(key,0)+1
+            chained.update(xrange(pc+1,stop))
+        elif isopcode(op) and op not in inert and pc not in chained:
+            era += 1
+
+    # Each chain shares the longest prefix it has in common with
+    # another one (if it has one)
+    chosen = []
+    for pc,keys in occurrences:
+        shared = [key for key in keys if uses[key] > 1]
+        if shared: chosen.append((pc,shared[-1]))
+    counts = {}
+    for _,key in chosen: counts[key] = counts.get(key,0)+1
+    chosen = [(pc,key) for pc,key in chosen if counts[key] > 1]
+    if not chosen: return False
+
+    # The first one computes it into a hidden local, the rest load that
+    # (working back so the offsets hold)
+    taken = set(arg for op,arg in instructions if op in (LOAD_FAST,STORE_FAST))
+    names = {}
+    first = {}
+    for pc,key in chosen:
+        if key in names: continue
+        name = '__shared_%d__'%len(names)
+        while name in taken: name += '_'
+        names[key] = name
+        first[key] = pc
+    for pc,key in reversed(chosen):
+        size = len(key[0])
+        if first[key] == pc:
+            instructions[pc+size:pc+size] = [(DUP_TOP,None),(STORE_FAST,names[key])]
+        else:
+            instructions[pc:pc+size] = [(LOAD_FAST,names[key])]
+    return True
+
+def reuse_attributes(f):
+    """A decorator to look up repeated attribute chains once
+
+    Methods tend to say self.state.counters over and over:
+
+    def tick(self,n):
+        if self.state.counters.total > n:
+            self.state.counters.reset(self.state.counters.total-n)
+
+    and each one is a LOAD_FAST and a couple of LOAD_ATTRs.  Within
+    straight-line code (a basic block), we keep the chain the first
+    time we load it in a hidden local and reuse that after.  It is
+    loaded afresh after anything that could run other code and so
+    change it:  a call, an operator or comparison (there may be an
+    __add__ or __eq__ behind it), a store into an attribute or item,
+    or any attribute load that isn't part of a chain.  Only moving
+    values around the stack, loading locals, constants and globals,
+    and building tuples and lists are let through.  Assigning the
+    local starts over too.  Above, the second line loads
+    self.state.counters once for the method and its argument.  The
+    attribute loads in the chains themselves are taken to be plain
+    lookups:  a property that changes things when read would fool us.
+
+    This is about locals and self.  For globals, see @cache_globals"""
+    return __transform_function__(f,[__reuse_attributes__])
+reuse_attributes.bytecode_pass = __reuse_attributes__
+
+def __inlinable__(g,f,max_size):
+    """g's instructions (a byteplay code list) if we can inline it in f, else None
+
+    It has to be a plain function over the same globals, with no
+    *args, **kwargs, closures, blocks (loops, try, with) or yields,
+    that doesn't call itself, has at most max_size instructions, and
+    never reads a local that might not be assigned yet"""
+    from byteplay import Code,Label,SetLineno,isopcode,hasjump,CO_VARARGS,CO_VARKEYWORDS, \
+        LOAD_CONST,LOAD_GLOBAL,LOAD_NAME,STORE_NAME,DELETE_NAME,EXEC_STMT,YIELD_VALUE, \
+        SETUP_LOOP,SETUP_EXCEPT,SETUP_FINALLY,SETUP_WITH,RETURN_VALUE,RAISE_VARARGS, \
+        LOAD_FAST,STORE_FAST,DELETE_FAST,JUMP_ABSOLUTE,JUMP_FORWARD
+    from types import FunctionType
+    if not isinstance(g,FunctionType) or g is f: return None
+    co = g.func_code
+    if co.co_flags & (CO_VARARGS|CO_VARKEYWORDS) or co.co_freevars or co.co_cellvars: return None
+    if g.func_globals is not f.func_globals: return None
+    if [name for name in co.co_varnames[:co.co_argcount] if not isinstance(name,str) or name.startswith('.')]:
+        return None  # def g((a,b)): ...
+
+    instructions = [x for x in Code.from_code(co).code if x[0] != SetLineno]
+    if len([op for op,_ in instructions if isopcode(op)]) > max_size: return None
+    refuse = (LOAD_NAME,STORE_NAME,DELETE_NAME,EXEC_STMT,YIELD_VALUE,
+              SETUP_LOOP,SETUP_EXCEPT,SETUP_FINALLY,SETUP_WITH)
+    for op,arg in instructions:
+        if op in refuse: return None
+        if op == LOAD_CONST and arg is g: return None
+        if op == LOAD_GLOBAL and arg == g.__name__: return None
+
+    # Every return has to leave just the value on the stack
+    levels = StackLevels(instructions)
+    for pc,(op,arg) in enumerate(instructions):
+        if op == RETURN_VALUE and levels.before(pc) != 1: return None
+
+    # g's locals become f's, so they keep their values from the last
+    # time we went through (round a loop, say).  A read that could
+    # come before g assigns the local would see that instead of
+    # raising UnboundLocalError, so every path to a read has to
+    # assign it first
+    where = dict( (op,pc) for pc,(op,_) in enumerate(instructions) if isinstance(op,Label) )
+    stops = (RETURN_VALUE,RAISE_VARARGS,JUMP_ABSOLUTE,JUMP_FORWARD)
+    assigned = [None]*len(instructions)   # What is surely assigned before each one
+    worklist = [(0,frozenset(co.co_varnames[:co.co_argcount]))]
+    while worklist:
+        pc,known = worklist.pop()
+        if pc >= len(instructions): continue
+        if assigned[pc] is not None:
+            if assigned[pc] <= known: continue
+            known = assigned[pc] & known
+        assigned[pc] = known
+        op,arg = instructions[pc]
+        if op in (LOAD_FAST,DELETE_FAST) and arg not in known: return None
+        if op == STORE_FAST: known = known | set([arg])
+        if op == DELETE_FAST: known = known - set([arg])
+        if op in hasjump: worklist.append((where[arg],known))
+        if op not in stops: worklist.append((pc+1,known))
+    return instructions
+
+def __inline_calls__(code,f,max_size=30,budget=200):
+    "Splice small functions into the code that calls them.  See @inline_calls"
+    from byteplay import Label,LOAD_CONST,LOAD_FAST,STORE_FAST,DELETE_FAST, \
+        CALL_FUNCTION,JUMP_ABSOLUTE,RETURN_VALUE
+    from types import FunctionType
+    instructions = code.code
+    callees = {}
+    spliced = set()   # We don't inline into what we inlined
+    taken = set(arg for op,arg in instructions if op in (LOAD_FAST,STORE_FAST))
+    changed = False
+    levels = StackLevels(instructions)
+    pc = 0
+    while pc < len(instructions):
+        instruction = instructions[pc]
+        op,g = instruction
+        pc += 1
+        if op != LOAD_CONST or not isinstance(g,FunctionType) or id(instruction) in spliced: continue
+
+        # Find the call (with positional arguments only) that uses it
+        level = levels[pc-1]
+        for n in xrange(pc,len(instructions)):
+            if levels[n] <= level: break
+        if levels[n] != level or instructions[n][0] != CALL_FUNCTION: continue
+        argc = instructions[n][1]
+        if argc > 255: continue  # keyword arguments
+        co = g.func_code
+        defaults = g.func_defaults or ()
+        if not co.co_argcount-len(defaults) <= argc <= co.co_argcount: continue
+
+        if g not in callees: callees[g] = __inlinable__(g,f,max_size)
+        body = callees[g]
+        if body is None or len(body) > budget: continue
+        budget -= len(body)
+
+        # g's locals get names of their own, its arguments are stored
+        # into them (after any defaults we have to fill in), and its
+        # returns jump past the end with the value on the stack
+        names = {}
+        for name in co.co_varnames:
+            fresh = '%s.%s'%(g.__name__,name)
+            while fresh in taken: fresh += '_'
+            taken.add(fresh)
+            names[name] = fresh
+        end = Label()
+        splice = [(LOAD_CONST,value) for value in defaults[len(defaults)-(co.co_argcount-argc):]]
+        splice.extend((STORE_FAST,names[name]) for name in reversed(co.co_varnames[:co.co_argcount]))
+        for op,arg in __clone_instructions__(body):
+            if op in (LOAD_FAST,STORE_FAST,DELETE_FAST): arg = names[arg]
+            if op == RETURN_VALUE: op,arg = JUMP_ABSOLUTE,end
+            splice.append((op,arg))
+        if splice[-1] == (JUMP_ABSOLUTE,end): del splice[-1]
+        splice.append((end,None))
+        spliced.update(id(x) for x in splice)
+
+        __assume__(instruction)
+        instructions[n:n+1] = splice
+        del instructions[pc-1]
+        levels = StackLevels(instructions)
+        pc -= 1
+        changed = True
+    return changed
+
+def __inline_calls_pass__(max_size,budget):
+    "The inlining pass for some limits"
+    if (max_size,budget) == (30,200): return __inline_calls__
+    def transform(code,f):
+        return __inline_calls__(code,f,max_size,budget)
+    transform.cache_key = ('inline_calls',max_size,budget)
+    return transform
+
+def inline_calls(f=None,max_size=30,budget=200):
+    """Splice small functions into f where it calls them
+
+    Once @cache_globals (or make_local_functions_constant) has turned
+    g(y*2) into a call on a constant, we know exactly what g is, so we
+    can skip setting up a frame for it:
+
+    def g(x): return x+1
+
+    @inline_calls
+    @cache_globals
+    def f(y): return g(y*2)
+
+    runs as if it were
+
+    def f(y):
+        g.x = y*2       # g's locals get names of their own
+        return g.x+1
+
+    We only inline plain functions (same module, positional arguments,
+    defaults are fine) with no loops, try or with blocks, yields, or
+    closures, that don't call themselves, always assign a local before
+    reading it (the renamed locals keep their values between calls),
+    and have at most max_size instructions.  Each f can grow by at
+    most budget instructions.  Only one level is done: what g calls
+    is still called.  g won't show up in tracebacks, and its locals
+    live until f returns.
+    Note that later changes to g (or to g.func_code) won't be seen"""
+    if f is None:
+        return lambda f: inline_calls(f,max_size,budget)
+    return __transform_function__(f,[__inline_calls_pass__(max_size,budget)])
+inline_calls.bytecode_pass = __inline_calls__
+
+def __tail_calls__(code,f):
+    "Turn return f(...) in f into a jump back to the top.  See @tail_calls"
+    from byteplay import Label,SetLineno,CO_VARARGS,CO_VARKEYWORDS, \
+        LOAD_GLOBAL,LOAD_CONST,LOAD_DEREF,LOAD_FAST,STORE_FAST,DUP_TOP,POP_TOP, \
+        COMPARE_OP,POP_JUMP_IF_FALSE,JUMP_ABSOLUTE,JUMP_FORWARD,CALL_FUNCTION, \
+        RETURN_VALUE,YIELD_VALUE
+    co = f.func_code
+    if code is not __recording__.top: return False
+    if co.co_flags & (CO_VARARGS|CO_VARKEYWORDS) or co.co_cellvars: return False
+    instructions = code.code
+    if YIELD_VALUE in [op for op,_ in instructions]: return False
+    where = dict( (op,pc) for pc,(op,_) in enumerate(instructions) if isinstance(op,Label) )
+    def returns(pc):
+        "Does control go straight from instructions[pc] to a return?"
+        while pc < len(instructions):
+            op,arg = instructions[pc]
+            if op in (JUMP_ABSOLUTE,JUMP_FORWARD):
+                pc = where[arg]
+            elif op == SetLineno or isinstance(op,Label):
+                pc += 1
+            else:
+                return op == RETURN_VALUE
+        return False
+
+    # Find the calls whose value is returned, where the function comes
+    # from f's name and nothing else is on the stack (or in a block)
+    name = f.__name__
+    params = co.co_varnames[:co.co_argcount]
+    defaults = f.func_defaults or ()
+    levels = StackLevels(instructions)
+    sites = []
+    for pc,(op,arg) in enumerate(instructions):
+        if not ((op in (LOAD_GLOBAL,LOAD_DEREF) and arg == name) or (op == LOAD_CONST and arg is f)): continue
+        if levels.before(pc) != 0 or levels.blocks(pc): continue
+        for n in xrange(pc+1,len(instructions)):
+            if levels[n] <= 1: break
+        op,argc = instructions[n]
+        if levels[n] != 1 or op != CALL_FUNCTION or not returns(n+1): continue
+        if argc > 255 or not len(params)-len(defaults) <= argc <= len(params): continue
+        sites.append((pc,n))
+    if not sites: return False
+
+    # Pop the arguments into temporaries.  If the function we got is
+    # still f, copy them (and any defaults) into the parameters and
+    # jump to the top.  Otherwise, f has been rebound (say, wrapped by
+    # a memoizer), so push them back and make the call after all
+    top = Label()
+    temporaries = ['__tail_%d__'%i for i in xrange(len(params))]
+    for pc,n in reversed(sites):
+        argc = instructions[n][1]
+        call = Label()
+        rewrite = [(STORE_FAST,temporaries[i]) for i in reversed(xrange(argc))]
+        if instructions[pc][0] != LOAD_CONST:
+            rewrite.extend([(DUP_TOP,None),(LOAD_CONST,f),(COMPARE_OP,'is'),(POP_JUMP_IF_FALSE,call)])
+        rewrite.append((POP_TOP,None))
+        rewrite.extend((LOAD_FAST,temporaries[i]) for i in xrange(argc))
+        rewrite.extend((LOAD_CONST,value) for value in defaults[len(defaults)-(len(params)-argc):])
+        rewrite.extend((STORE_FAST,param) for param in reversed(params))
+        rewrite.append((JUMP_ABSOLUTE,top))
+        if instructions[pc][0] != LOAD_CONST:
+            rewrite.append((call,None))
+            rewrite.extend((LOAD_FAST,temporaries[i]) for i in xrange(argc))
+            rewrite.append((CALL_FUNCTION,argc))
+        else:
+            __assume__(instructions[pc])
+        instructions[n:n+1] = rewrite
+    instructions[:0] = [(top,None)]
+    return True
+
+def tail_calls(f):
+    """A decorator to make f's calls to itself in a return into loops
+
+    def walk(node,depth=0):
+        if node.child is None: return depth
+        return walk(node.child,depth+1)
+
+    runs out of stack on a deep enough tree, and pays for a new frame
+    at every level.  When f returns the value of a call to itself,
+    we store the arguments into the parameters (filling in defaults)
+    and jump back to the top instead.  The call has to be the whole
+    of what's returned (return f(x) if x else 0 is fine, return
+    1+f(x) is not) and can't be in a loop, try or with block.
+
+    We check it really is f being called first:  if the name has been
+    rebound (to a memoizing wrapper, say), the call is made as
+    written.  After @cache_globals, the name is already the constant
+    f and there's nothing to check.  Functions with *args, **kwargs
+    or closures over their own variables are left alone.  Note that
+    f's other locals keep their values from the last time round, and
+    a traceback won't show the calls we skipped"""
+    return __transform_function__(f,[__tail_calls__])
+tail_calls.bytecode_pass = __tail_calls__
+
+def __range_builtins__(f):
+    "The builtin range and xrange by name, unless f's globals hide them"
+    import __builtin__
+    return dict( (name,getattr(__builtin__,name)) for name in ('range','xrange') if name not in f.func_globals )
+
+def __unroll_loops__(code,f,max_size=100):
+    "Unroll for loops over constant ranges and tuples.  See @unroll_loops"
+    from byteplay import Label,SetLineno,isopcode,hasjump,LOAD_CONST,LOAD_GLOBAL,LOAD_FAST, \
+        STORE_FAST,DELETE_FAST,CALL_FUNCTION,GET_ITER,FOR_ITER,SETUP_LOOP,POP_BLOCK,JUMP_ABSOLUTE
+    instructions = code.code
+    ranges = __range_builtins__(f)
+
+    def values(loads,limit):
+        "What the loop gets from iterating over what loads loads (or None, or if there are more than limit)"
+        for op,arg in loads[1:]:
+            if op != LOAD_CONST or type(arg) not in (int,long): return None
+        op,arg = loads[0]
+        if len(loads) == 1:
+            if op != LOAD_CONST or type(arg) is not tuple or len(arg) > limit: return None
+            return arg
+        if op == LOAD_GLOBAL and arg in ranges:
+            function = ranges[arg]
+        elif op == LOAD_CONST and arg in ranges.values():
+            function = arg
+        else:
+            return None
+
+        # Count them before we make them:  xrange(10**9) is a constant too
+        args = [arg for _,arg in loads[1:]]
+        if len(args) == 1:
+            start,stop,step = 0,args[0],1
+        elif len(args) in (2,3):
+            start,stop,step = (args+[1])[:3]
+        else:
+            return None
+        if step == 0: return None
+        count = max((stop-start+step-(1 if step > 0 else -1))//step,0)
+        if count > limit: return None
+        try:
+            return tuple(function(*args))
+        except (TypeError,ValueError,OverflowError):
+            return None
+
+    def unroll(pc):
+        """Unroll the loop that starts at instructions[pc]
+
+        Returns the index just past its POP_BLOCK and the instructions
+        to replace it all with, or None"""
+        # SETUP_LOOP / <iterable> / GET_ITER / top: FOR_ITER done / STORE_FAST i /
+        #   <body> / JUMP_ABSOLUTE top / done: POP_BLOCK
+        for get in xrange(pc+2,min(pc+7,len(instructions)-3)):
+            if instructions[get][0] == GET_ITER: break
+        else:
+            return None
+        loads = instructions[pc+1:get]
+        if len(loads) > 1:
+            if loads[-1] != (CALL_FUNCTION,len(loads)-2): return None
+            loads = loads[:-1]
+        top = instructions[get+1][0]
+        op,done = instructions[get+2]
+        store,i = instructions[get+3]
+        if not isinstance(top,Label) or op != FOR_ITER or store != STORE_FAST: return None
+        stop = [n for n,x in enumerate(instructions) if x[0] is done][0]
+        if instructions[stop-1] != (JUMP_ABSOLUTE,top) or stop+1 == len(instructions) or \
+           instructions[stop+1][0] != POP_BLOCK:
+            return None
+        body = instructions[get+4:stop-1]
+        size = len([op for op,_ in body if isopcode(op)])+2
+        sequence = values(loads,max_size//size)
+        if sequence is None: return None
+
+        # Nothing outside may jump into the body
+        ids = set(id(x) for x in instructions[pc:stop+2])
+        inside = set(op for op,_ in body if isinstance(op,Label))
+        for x in instructions[:pc]+instructions[stop:]:
+            if x[0] in hasjump and x[1] in inside: return None
+
+        # If the body doesn't change i, each copy can use its value
+        # as a constant, and if nothing else reads i, we don't even
+        # have to store it
+        changes = [op for op,arg in body if op in (STORE_FAST,DELETE_FAST) and arg == i]
+        elsewhere = [x for x in instructions if x[0] in (LOAD_FAST,DELETE_FAST) and x[1] == i and id(x) not in ids]
+        unrolled = []
+        for n,value in enumerate(sequence):
+            following = done if n == len(sequence)-1 else Label()
+            if changes or elsewhere:
+                unrolled.extend([(LOAD_CONST,value),(STORE_FAST,i)])
+            for op,arg in __clone_instructions__(body):
+                if op == SetLineno and n: continue  # Line numbers can't go backwards
+                if op == LOAD_FAST and arg == i and not changes: op,arg = LOAD_CONST,value
+                if op in hasjump and arg is top: arg = following
+                unrolled.append((op,arg))
+            if following is not done: unrolled.append((following,None))
+        for load in loads: __assume__(load)
+        return stop+2,[instructions[pc]]+unrolled+[(done,None),instructions[stop+1]]
+
+    changed = False
+    pc = 0
+    while pc < len(instructions):
+        if instructions[pc][0] == SETUP_LOOP:
+            unrolled = unroll(pc)
+            if unrolled is not None:
+                # Loops in the body get their chance as we carry on
+                stop,replacement = unrolled
+                instructions[pc:stop] = replacement
+                changed = True
+        pc += 1
+
+    # The loop variable is a constant now, so there's usually some folding to do
+    if changed: __fold_constants__(code,f)
+    return changed
+__unroll_loops__.cache_state = lambda f: sorted(__range_builtins__(f))
+
+def __unroll_loops_pass__(max_size):
+    "The unrolling pass for a size limit"
+    if max_size == 100: return __unroll_loops__
+    def transform(code,f):
+        return __unroll_loops__(code,f,max_size)
+    transform.cache_key = ('unroll_loops',max_size)
+    transform.cache_state = __unroll_loops__.cache_state
+    return transform
+
+def unroll_loops(f=None,max_size=100):
+    """Unroll loops that go round a fixed number of times
+
+    Small fixed-size kernels (3x3 matrices, fixed-width checksums)
+    spend much of their time in the loop machinery itself:
+
+    @unroll_loops
+    def trace(m):
+        total = 0
+        for i in range(3):
+            total += m[i][i]
+        return total
+
+    runs as if it were
+
+    def trace(m):
+        total = 0
+        total += m[0][0]
+        total += m[1][1]
+        total += m[2][2]
+        return total
+
+    We unroll for loops over range or xrange with constant arguments
+    (literals, or globals @cache_globals has turned into constants)
+    or over a constant tuple, if the copies come to at most max_size
+    instructions.  The loop variable becomes a constant in each copy
+    (unless the body assigns to it) and then we fold constants.
+    Loops in the body get unrolled too if they are still small
+    enough.  break, continue and else work as before.  Like
+    @cache_globals, this assumes range and xrange aren't rebound
+    later on, and tracebacks from all but the first trip round show
+    the wrong line"""
+    if f is None:
+        return lambda f: unroll_loops(f,max_size)
+    return __transform_function__(f,[__unroll_loops_pass__(max_size)])
+unroll_loops.bytecode_pass = __unroll_loops__
+
+def pipeline(*passes):
+    """A decorator to apply several transforms in a single pass
+
+    Stacking @cache_globals, @smartdebug, @unprint, ... means that
+    each one takes the code apart and puts it back together again.
+    This takes the code apart once, runs all the transforms over
+    it, and only reassembles the code objects that changed:
+
+    @pipeline(smartdebug,unprint,cache_globals)
+    def f(x): ...
+
+    The transforms run in the order given (note that stacked
+    decorators run bottom up).  You can also give your own pass: a
+    function taking a byteplay Code object (edit its code list in
+    place) and the function being transformed, and returning True
+    if it changed anything."""
+    passes = [getattr(p,'bytecode_pass',p) for p in passes]
+    def decorator(f):
+        return __transform_function__(f,passes)
+    return decorator
+
+def __counting_stub__(co,tick,threshold,promote):
+    """co with a prologue that calls promote() once tick() gets to threshold (or None if we can't)
+
+    This runs for every function we tier, most of which never get
+    hot, so we patch the bytecode string directly instead of taking
+    the code apart with byteplay.  The absolute jumps move down by
+    the size of the prologue, and co_lnotab skips over it"""
+    import dis
+    from types import CodeType
+    n = len(co.co_consts)
+    if n+2 > 0xffff: return None
+
+    #     if tick() < threshold: goto body
+    #     promote()
+    # body:
+    prologue = [('LOAD_CONST',n),('CALL_FUNCTION',0),('LOAD_CONST',n+1),('COMPARE_OP',dis.cmp_op.index('<')),
+                ('POP_JUMP_IF_TRUE',22),('LOAD_CONST',n+2),('CALL_FUNCTION',0),('POP_TOP',None)]
+    size = 22
+    code = []
+    for name,arg in prologue:
+        code.append(chr(dis.opmap[name]))
+        if arg is not None: code.append(chr(arg&0xff)+chr(arg>>8))
+
+    pc = 0
+    while pc < len(co.co_code):
+        op = ord(co.co_code[pc])
+        if op < dis.HAVE_ARGUMENT:
+            code.append(co.co_code[pc])
+            pc += 1
+            continue
+        if op == dis.EXTENDED_ARG: return None
+        arg = ord(co.co_code[pc+1]) | ord(co.co_code[pc+2])<<8
+        if op in dis.hasjabs:
+            arg += size
+            if arg > 0xffff: return None
+        code.append(chr(op)+chr(arg&0xff)+chr(arg>>8))
+        pc += 3
+
+    return CodeType(co.co_argcount,co.co_nlocals,max(co.co_stacksize,2),co.co_flags,
+                    ''.join(code),co.co_consts+(tick,threshold,promote),co.co_names,co.co_varnames,
+                    co.co_filename,co.co_name,co.co_firstlineno,chr(size)+chr(0)+co.co_lnotab,
+                    co.co_freevars,co.co_cellvars)
+
+def __optimize_or_log__(f,optimize):
+    """optimize(f), but if it fails, log why and leave f's code as it was
+
+    Used where there's nobody to hand the error to:  the call that
+    happens to promote a tiered function, or a module being imported"""
+    import logging
+    original = f.func_code
+    try:
+        optimize(f)
+    except Exception:
+        f.func_code = original
+        logging.getLogger('bytecode_toys').exception(
+            'could not optimize %s.%s, leaving it as it was',f.__module__,f.__name__)
     return f
 
-def make_local_functions_constant():
+def __tier__(f,optimize,threshold):
+    """Give f a counting stub that runs optimize(f) (on f's own code) on the threshold-th call.  Returns f
+
+    If two threads get there at once, only one of them optimizes"""
+    import itertools
+    original = f.func_code
+    lock = threading.Lock()
+    promoted = []
+    def promote():
+        if promoted: return
+        with lock:
+            if promoted: return
+            promoted.append(True)
+            if f.func_code is not stub: return  # Someone else has rewritten f since
+            f.func_code = original
+            __optimize_or_log__(f,optimize)
+        return
+
+    stub = None
+    if threshold > 0:
+        stub = __counting_stub__(original,itertools.count(1).next,threshold,promote)
+    if stub is None:
+        optimize(f)
+    else:
+        f.func_code = stub
+    return f
+
+def tiered(*passes,**options):
+    """Like @pipeline, but only for functions that get called
+
+    Rewriting every function as a module is imported costs startup
+    time, and most functions aren't called often enough to pay it
+    back.  This gives f a stub instead:  a counter at the top of its
+    code (a C call and a compare).  On the threshold-th call (1000 by
+    default), the transforms run once and f gets the code they make:
+
+    @tiered(smartdebug,unprint,cache_globals,threshold=100)
+    def f(x): ...
+
+    Threads that cross the threshold together don't both do the
+    work.  If a transform fails, the error is logged (to the
+    bytecode_toys logger) and f keeps its original code, rather than
+    the unlucky call raising it.  If something else rewrites f in
+    the meantime, we leave its code alone.  A threshold of 0 transforms f right away.
+    See the threshold option of OptimizingImporter to do this to
+    whole modules"""
+    threshold = options.pop('threshold',1000)
+    if options: raise TypeError('unexpected options %s'%', '.join(sorted(options)))
+    passes = [getattr(p,'bytecode_pass',p) for p in passes]
+    def decorator(f):
+        return __tier__(f,lambda f: __transform_function__(f,passes),threshold)
+    return decorator
+
+def make_local_functions_constant(guarded=False):
     """A mass code object rewriter
 
     The idea here is that you often write functions that call other
@@ -609,23 +3078,23 @@ def make_local_functions_constant():
     we didn't have to do a full blown global dictionary lookup just
     to get the function that is sitting right next door to us.
 
-    This is only for top-level functions, but it possible to extend
-    to methods and nested functions.
+    We rewrite the top-level functions, the methods (static, class,
+    and property ones too) of classes defined in the module, and the
+    functions nested inside all of those.  Closure variables that
+    can no longer be rebound are folded as well.  Returns the number
+    of lookups taken out of each function, by (dotted) name.
+
+    With guarded=True, each function checks its folded functions are
+    still current (see @guarded_cache_globals) and goes back to its
+    original code if one was rebound.
     """
 
     import inspect
-    from types import FunctionType
-
     frame = inspect.currentframe(1)
-    local_functions = {}
-    for sym,value in frame.f_globals.iteritems():
-        if isinstance(value,FunctionType) and value.func_globals is frame.f_globals:
-            local_functions[sym] = value
+    return __mass_replace__(__module_functions__(frame.f_globals),
+                            __local_functions__(frame.f_globals),guarded)
 
-    __mass_replace__(local_functions.values(),local_functions)
-    return
-
-def make_local_modules_constant():
+def make_local_modules_constant(guarded=False):
     """A mass code object rewriter
 
     The idea here is that when you import a module and then
@@ -638,35 +3107,1045 @@ def make_local_modules_constant():
     def foo(x):
         # Math is never going to change once imported
         return math.sin(x)+1
+
+    Unless, of course, someone reloads it.  guarded=True works as
+    for make_local_functions_constant, and so do methods, closures,
+    and the counts we return.
     """
     import inspect
-    from types import FunctionType,ModuleType
+    frame = inspect.currentframe(1)
+    return __mass_replace__(__module_functions__(frame.f_globals),
+                            __local_modules__(frame.f_globals),guarded)
+
+def make_flags_constant(*flags):
+    """A mass code object rewriter
+
+    Like @specialize_flags (which see) on every function in the
+    calling module (methods too), so you can put
 
+    make_flags_constant('USE_CACHE','VERBOSE')
+
+    at the bottom of a module instead of decorating everything.
+    """
+    import inspect
+    if len(flags) == 1 and callable(flags[0]): flags = flags[0]
     frame = inspect.currentframe(1)
-    local_functions = []
-    local_modules = {}
-    for sym,value in frame.f_globals.iteritems():
-        if isinstance(value,FunctionType) and value.func_globals is frame.f_globals:
-            local_functions.append(value)
-        elif isinstance(value,ModuleType):
-            local_modules[sym] = value
-
-    __mass_replace__(local_functions,local_modules)
+    transform = __specialize_flags__(flags)
+    for _,f in __module_functions__(frame.f_globals):
+        __transform_function__(f,[transform])
     return
 
-def __mass_replace__(functions,what):
-    "Mass replace the global from what in the functions"
-    def transform(co):
-        from byteplay import Code, LOAD_CONST, LOAD_GLOBAL
-        code = Code.from_code(co)
-        newcode = []
+def __local_functions__(namespace):
+    "The functions defined at the top level of a module namespace, by name"
+    from types import FunctionType
+    return dict( (sym,value) for sym,value in namespace.iteritems()
+                 if isinstance(value,FunctionType) and value.func_globals is namespace )
+
+def __local_modules__(namespace):
+    "The modules imported into a module namespace, by name"
+    from types import ModuleType
+    return dict( (sym,value) for sym,value in namespace.iteritems()
+                 if isinstance(value,ModuleType) )
+
+def __module_functions__(namespace):
+    """All the functions a module namespace defines, as (dotted name,function) pairs
+
+    That is top-level functions, and the methods, staticmethods,
+    classmethods and property functions of classes defined in the
+    module (and classes nested in those).  Functions nested inside
+    these come along with their code"""
+    from types import FunctionType,ClassType
+    module = namespace.get('__name__')
+    result = []
+    seen = set()
+    def visit(name,value):
+        if id(value) in seen: return
+        if isinstance(value,FunctionType):
+            if value.func_globals is not namespace: return
+            seen.add(id(value))
+            result.append((name,value))
+        elif isinstance(value,(staticmethod,classmethod)):
+            visit(name,value.__func__)
+        elif isinstance(value,property):
+            for accessor in (value.fget,value.fset,value.fdel):
+                if accessor is not None: visit(name,accessor)
+        elif isinstance(value,(type,ClassType)) and getattr(value,'__module__',None) == module:
+            seen.add(id(value))
+            for attr,member in sorted(vars(value).iteritems()):
+                visit(name+'.'+attr,member)
+    for sym,value in sorted(namespace.iteritems()):
+        visit(sym,value)
+    return result
+
+def __fixed_cells__(functions):
+    """The closure variables of functions that can't be rebound any more
+
+    Returns {function:{name:value}}.  Only the frame of the function
+    that made a cell can store into it (there's no nonlocal), so once
+    no frame refers to a cell, what it holds is fixed.  We look for
+    those frames in one sweep for all the functions"""
+    import gc
+    from types import FrameType
+    cells = []
+    for f in functions: cells.extend(f.func_closure or ())
+    if not cells: return {}
+    live = set()
+    for frame in gc.get_referrers(*cells):
+        if isinstance(frame,FrameType):
+            live.update(id(x) for x in gc.get_referents(frame))
+    del cells
+
+    fixed = {}
+    for f in functions:
+        values = {}
+        for name,cell in zip(f.func_code.co_freevars,f.func_closure or ()):
+            if id(cell) in live: continue
+            try:
+                values[name] = cell.cell_contents
+            except ValueError:
+                pass  # Never filled in
+        if values: fixed[f] = values
+    return fixed
+
+def __count_lookups__(co,names,cells):
+    "How many loads of the globals in names (and, in co itself, the closure variables in cells) co has"
+    from opcode import opmap
+    from types import CodeType
+    derefs = co.co_cellvars+co.co_freevars
+    count = 0
+    for op,arg in __instructions__(co):
+        if op == opmap['LOAD_GLOBAL'] and co.co_names[arg] in names: count += 1
+        elif op == opmap['LOAD_DEREF'] and derefs[arg] in cells: count += 1
+    for const in co.co_consts:
+        if isinstance(const,CodeType): count += __count_lookups__(const,names,())
+    return count
+
+def __replace_globals__(what,guarded=False,fixed=None):
+    """A pass that replaces the globals named in what with their values
+
+    fixed (see __fixed_cells__) gives closure variables to replace too"""
+    def transform(code,f):
+        from byteplay import LOAD_GLOBAL,LOAD_DEREF
+        cells = {}
+        if fixed and code is __recording__.top: cells = fixed.get(f,{})
+        unfolded = code.code[:]
+        used = set()
+        changed = False
         for pc,(op,arg) in enumerate(code.code):
             if op == LOAD_GLOBAL and arg in what:
-                code.code[pc] = (LOAD_CONST,what[arg])
-        return code.to_code()
+                code.code[pc] = __fold__(what[arg],('global',arg))
+                used.add(arg)
+            elif op == LOAD_DEREF and arg in cells:
+                code.code[pc] = __fold__(cells[arg],('cell',arg))
+                changed = True
+        if guarded and used:
+            guards = [([(LOAD_GLOBAL,sym)],what[sym]) for sym in sorted(used)]
+            __guard__(code,unfolded,guards,__invalidator__(f))
+        return changed or bool(used)
+    def fixed_names(f):
+        return sorted((fixed or {}).get(f,()))
+    transform.cache_key = ('replace_globals',tuple(sorted(what)),guarded,fixed is not None)
+    transform.cache_state = fixed_names
+    return transform
+
+def __mass_replace__(functions,what,guarded=False):
+    """Mass replace the global from what (and fixed closure variables) in the functions
+
+    functions are (name,function) pairs.  Returns the number of
+    lookups we took out of each one, by name"""
+    fixed = __fixed_cells__([f for _,f in functions])
+    transform = __replace_globals__(what,guarded,fixed)
+    counts = {}
+    for name,value in functions:
+        counts[name] = __count_lookups__(value.func_code,what,fixed.get(value,()))
+        __transform_function__(value,[transform])
+
+    return counts
+
+class OptimizingImporter:
+    """An import hook (PEP 302 finder and loader) that optimizes modules
+
+    Calling make_local_functions_constant() and friends at the bottom
+    of every module gets old fast.  Put one of these on sys.meta_path
+    (see install_optimizer) and every module under the packages you
+    name gets the treatment as it is imported:
+
+    install_optimizer(['myservice'],deny=['myservice.plugins'])
+    import myservice.core      # optimized
+    import myservice.plugins.x # not optimized
+
+    A package prefix covers the package and everything under it.
+    deny wins over packages, so you can carve out the odd module.
+
+    The options (all on unless noted) are
+      functions -- fold calls to the module's own functions
+      modules   -- fold references to imported modules
+      debug     -- strip DEBUG() calls and dead "if DEBUG:" code
+      prints    -- remove print statements
+      logging   -- remove disabled logging calls, see @unlog (off
+                   by default)
+      guarded   -- check the folded values on entry (off by default)
+      flags     -- flag names (or a predicate) to compile in, see
+                   @specialize_flags (none by default)
+      hoist     -- look up methods on locals before loops, see
+                   @hoist_attributes (off by default)
+      latency   -- keep call latency histograms, see @measure_latency
+                   (off by default)
+      threshold -- only rewrite a function once it has been called
+                   this many times, see @tiered (None, the default,
+                   rewrites everything at import)
+
+    Top-level functions, methods and the functions nested in them
+    are all rewritten (see make_local_functions_constant).  A
+    function that can't be rewritten is logged (to the bytecode_toys
+    logger) and left as it was.  Only
+    modules loaded from source are handled; anything else
+    (extension modules, bytecode-only installs) is left to the
+    usual import machinery, as are modules imported before the
+    hook went in.
+    """
+
+    defaults = {
+        'functions':True,
+        'modules':True,
+        'debug':True,
+        'prints':True,
+        'guarded':False,
+        'flags':None,
+        'logging':False,
+        'hoist':False,
+        'latency':False,
+        'threshold':None,
+        }
+
+    def __init__(self,packages,deny=(),**options):
+        unknown = set(options)-set(self.defaults)
+        if unknown:
+            raise TypeError('unknown optimizer options: %s'%', '.join(sorted(unknown)))
+        self.packages = tuple(packages)
+        self.deny = tuple(deny)
+        self.options = dict(self.defaults)
+        self.options.update(options)
+        self.__found = {}
+        return
+
+    def wants(self,fullname):
+        "True if we should optimize the module called fullname"
+        def under(prefixes):
+            for prefix in prefixes:
+                if fullname == prefix or fullname.startswith(prefix+'.'):
+                    return True
+            return False
+        return under(self.packages) and not under(self.deny)
+
+    def find_module(self,fullname,path=None):
+        "PEP 302 finder: we load the source modules we want to optimize"
+        # Check first: the imports below come back through here
+        if not self.wants(fullname): return None
+        import imp,os
+        try:
+            handle,filename,(_,_,kind) = imp.find_module(fullname.rpartition('.')[2],path)
+        except ImportError:
+            return None
+        if handle is not None: handle.close()
+
+        if kind == imp.PKG_DIRECTORY:
+            filename = os.path.join(filename,'__init__.py')
+            if not os.path.exists(filename): return None
+        elif kind != imp.PY_SOURCE:
+            return None
+        self.__found[fullname] = (filename,kind == imp.PKG_DIRECTORY)
+        return self
+
+    def load_module(self,fullname):
+        "PEP 302 loader: run the module, then optimize its functions"
+        import imp,os,sys
+        filename,package = self.__found.pop(fullname)
+        with open(filename,'U') as source:
+            co = compile(source.read(),filename,'exec')
+
+        # Reloads reuse the module that is already there
+        module = sys.modules.get(fullname)
+        fresh = module is None
+        if fresh:
+            module = sys.modules[fullname] = imp.new_module(fullname)
+        module.__file__ = filename
+        module.__loader__ = self
+        if package:
+            module.__path__ = [os.path.dirname(filename)]
+            module.__package__ = fullname
+        else:
+            module.__package__ = fullname.rpartition('.')[0]
+
+        try:
+            exec co in module.__dict__
+        except:
+            if fresh: del sys.modules[fullname]
+            raise
+
+        self.optimize(module)
+        return sys.modules[fullname]
+
+    def optimize(self,module):
+        "Apply the configured rewrites to the functions and methods in module"
+        namespace = module.__dict__
+        options = self.options
+        functions = __module_functions__(namespace)
+
+        what = {}
+        if options['functions']: what.update(__local_functions__(namespace))
+        if options['modules']: what.update(__local_modules__(namespace))
+
+        passes = []
+        if options['debug']: passes.extend([__smartdebug__,__debuggable__])
+        if options['prints']: passes.append(__unprint__)
+        if options['logging']: passes.append(__unlog__)
+        if options['flags'] is not None: passes.append(__specialize_flags__(options['flags']))
+        if options['hoist']: passes.append(__hoist_attributes__)
+        if what:
+            fixed = __fixed_cells__([f for _,f in functions])
+            passes.append(__replace_globals__(what,options['guarded'],fixed))
+
+        def rewrite(f,name):
+            __transform_function__(f,passes)
+            if options['latency']:
+                measure_latency(f,'%s.%s'%(module.__name__,name))
+            return f
+        for name,f in functions:
+            if options['threshold'] is None:
+                __optimize_or_log__(f,lambda f,name=name: rewrite(f,name))
+            else:
+                __tier__(f,lambda f,name=name: rewrite(f,name),options['threshold'])
+        return module
+
+def install_optimizer(packages,deny=(),**options):
+    """Optimize the modules under packages as they are imported
+
+    Puts an OptimizingImporter (which see for the options) at the
+    front of sys.meta_path and returns it"""
+    import sys
+    importer = OptimizingImporter(packages,deny,**options)
+    sys.meta_path.insert(0,importer)
+    return importer
+
+def uninstall_optimizer(importer=None):
+    """Take an optimizing import hook back out of sys.meta_path
+
+    With no argument, all of them are removed.  Modules that were
+    already optimized stay that way"""
+    import sys
+    sys.meta_path[:] = [
+        x for x in sys.meta_path
+        if not (x is importer or (importer is None and isinstance(x,OptimizingImporter)))
+        ]
+    return
+
+# Rough savings (in nanoseconds) for each thing lookup_report counts.
+# These are ballpark CPython 2.7 numbers so reports stay comparable
+# from machine to machine; measure_lookup_costs() gets your own
+__lookup_costs__ = {
+    'globals':8.0,          # LOAD_GLOBAL that becomes a LOAD_CONST
+    'attributes':15.0,      # LOAD_ATTR folded away
+    'debug_branches':4.0,   # "if DEBUG:" test, not counting the DEBUG lookup
+    'debug_calls':72.0,     # DEBUG(...) call, not counting the lookup or its arguments
+    'prints':400.0,         # print item or newline
+    'log_calls':250.0,      # call on a disabled logger
+    }
+
+def __count_ops__(code,wanted):
+    "How many instructions in a byteplay Code (and the code nested in it) wanted((op,arg)) picks"
+    from byteplay import Code,LOAD_CONST
+    from types import CodeType
+    count = 0
+    for op,arg in code.code:
+        if wanted((op,arg)): count += 1
+        if op == LOAD_CONST and isinstance(arg,CodeType): arg = Code.from_code(arg)
+        if op == LOAD_CONST and isinstance(arg,Code): count += __count_ops__(arg,wanted)
+    return count
+
+def __eliminated__(f,transform,wanted):
+    "How many of the instructions wanted picks transform would take out of f (f is left alone)"
+    from byteplay import Code
+    co = f.func_code
+    code = Code.from_code(co)
+    before = __count_ops__(code,wanted)
+    __run_passes__(code,co,[transform],f)
+    return before-__count_ops__(code,wanted)
+
+def __lookup_counts__(f):
+    "What the transforms could take out of f.  See lookup_report"
+    from byteplay import LOAD_GLOBAL,LOAD_ATTR, \
+        PRINT_ITEM,PRINT_ITEM_TO,PRINT_NEWLINE,PRINT_NEWLINE_TO, \
+        CALL_FUNCTION,CALL_FUNCTION_VAR,CALL_FUNCTION_KW,CALL_FUNCTION_VAR_KW
+    prints = (PRINT_ITEM,PRINT_ITEM_TO,PRINT_NEWLINE,PRINT_NEWLINE_TO)
+    calls = (CALL_FUNCTION,CALL_FUNCTION_VAR,CALL_FUNCTION_KW,CALL_FUNCTION_VAR_KW)
+    debug = lambda x: x == (LOAD_GLOBAL,'DEBUG')
+    return {
+        'globals':__eliminated__(f,__cache_globals__,lambda x: x[0] == LOAD_GLOBAL),
+        'attributes':__eliminated__(f,__cache_globals__,lambda x: x[0] == LOAD_ATTR),
+        'debug_branches':__eliminated__(f,__smartdebug__,debug),
+        'debug_calls':__eliminated__(f,__debuggable__,debug),
+        'prints':__eliminated__(f,__unprint__,lambda x: x[0] in prints),
+        'log_calls':__eliminated__(f,__unlog__,lambda x: x[0] in calls),
+        }
+
+def lookup_report(target,costs=None,out=None):
+    """Count what the rewrites would save, without changing anything
+
+    Before turning on @cache_globals or the import hook across a
+    whole service, it is nice to know where it pays.  target is a
+    module or package (or its name; packages are walked, importing
+    the modules under them).  For every function and method we run
+    the transforms on a scratch copy of its code and count what they
+    would take out:
+
+      globals         LOAD_GLOBALs folded by cache_globals
+      attributes      LOAD_ATTRs folded along with them
+      debug_branches  "if DEBUG:" tests smartdebug removes
+      debug_calls     DEBUG() calls debuggable removes
+      prints          print items and newlines unprint removes
+      log_calls       disabled logging calls unlog removes
+
+    and estimate the time saved each time the code runs through
+    once (loops will save more), from costs (nanoseconds per item,
+    see measure_lookup_costs).  The report is a dict of functions
+    (by dotted name), totals, costs, and modules that wouldn't
+    import.  With out (a file name or file), it is also written as
+    JSON with sorted keys so releases diff cleanly."""
+    import json,pkgutil,sys
+    from types import ModuleType
+    if costs is None: costs = __lookup_costs__
+    if not isinstance(target,ModuleType):
+        __import__(target)
+        target = sys.modules[target]
+
+    modules = [target]
+    errors = {}
+    if hasattr(target,'__path__'):
+        def failed(name): errors[name] = repr(sys.exc_info()[1])
+        for _,name,_ in pkgutil.walk_packages(target.__path__,target.__name__+'.',onerror=failed):
+            try:
+                __import__(name)
+            except Exception:
+                failed(name)
+                continue
+            modules.append(sys.modules[name])
 
-    for value in functions:
-        value.func_code = __transform_codeobjects__(value.func_code,transform)
+    functions = {}
+    totals = dict.fromkeys(__lookup_costs__,0)
+    totals['estimated_ns'] = 0.0
+    for module in modules:
+        for name,f in __module_functions__(vars(module)):
+            counts = __lookup_counts__(f)
+            counts['estimated_ns'] = sum(counts[k]*costs.get(k,0.0) for k in __lookup_costs__)
+            functions[module.__name__+'.'+name] = counts
+            for k,v in counts.iteritems(): totals[k] = totals.get(k,0)+v
 
+    report = {'functions':functions,'totals':totals,'costs':dict(costs),'errors':errors}
+    if isinstance(out,basestring):
+        with open(out,'w') as handle:
+            json.dump(report,handle,indent=2,sort_keys=True)
+    elif out is not None:
+        json.dump(report,out,indent=2,sort_keys=True)
+    return report
+
+def __noop__(*args):
+    "What measure_lookup_costs calls for a DEBUG(...) that does nothing"
     return
 
+def measure_lookup_costs(target=0.01):
+    """Measure lookup_report's costs on this machine with LittleTimer
+
+    Each is the difference between timing a small body with and
+    without the thing the transforms remove.  The DEBUG in "if DEBUG:"
+    and DEBUG(...) is a global, and the report already counts it
+    under globals, so the branch and call costs leave that lookup
+    out.  Returns a dict you can hand to lookup_report(costs=...)"""
+    import logging,StringIO
+    sink = StringIO.StringIO()
+    quiet = logging.getLogger('bytecode_toys.measure')
+    quiet.setLevel(logging.INFO)
+
+    def ns(timer): return timer.time*1e9
+    with LittleTimer(None,target=target) as const:
+        x = 1
+    with LittleTimer(None,target=target) as glob:
+        x = __version__
+    with LittleTimer(None,target=target) as attr:
+        x = threading.local
+    with LittleTimer(None,target=target) as test:
+        if __code_cache__: pass
+    with LittleTimer(None,target=target) as call:
+        __noop__(1)
+    with LittleTimer(None,target=target) as printing:
+        print >>sink, 1
+    with LittleTimer(None,target=target) as log:
+        quiet.debug(1)
+    return {
+        'globals':max(ns(glob)-ns(const),0.0),
+        'attributes':max(ns(attr)-ns(glob),0.0),
+        'debug_branches':max(ns(test)-ns(glob),0.0),
+        'debug_calls':max(ns(call)-ns(glob),0.0),
+        'prints':ns(printing)/2,
+        'log_calls':ns(log),
+        }
+
+# Every function timed by @measure_latency, with its recorder
+__latencies__ = weakref.WeakKeyDictionary()
+
+class LatencyHistogram:
+    """A snapshot of call latencies, in log sized buckets
+
+    Bucket i holds the calls whose time falls in bounds(i).  There are
+    steps buckets for each power of two seconds, so a bucket is never
+    more than 1/steps of its lower bound wide.  The first starts at
+    2**-30 seconds (about a nanosecond) and takes anything quicker,
+    the last (at about three days) anything slower.  Histograms from
+    different threads, processes (they pickle) or runs add up with
+    merge or +"""
+    steps = 8
+    lowest = -29   # math.frexp exponent of the first bucket
+    size = steps*48
+
+    def __init__(self,name,counts=None,total=0.0):
+        self.name = name
+        self.counts = tuple(int(x) for x in counts or [0]*self.size)
+        self.total = total  # seconds
+        return
+
+    @classmethod
+    def bucket(cls,seconds):
+        "The bucket a call that took seconds goes in"
+        import math
+        if seconds <= 0: return 0
+        mantissa,exponent = math.frexp(seconds)
+        i = (exponent-cls.lowest)*cls.steps+int((mantissa-0.5)*2*cls.steps)
+        return min(max(i,0),cls.size-1)
+
+    @classmethod
+    def bounds(cls,i):
+        "The (low,high) times, in seconds, bucket i covers"
+        exponent,step = divmod(i,cls.steps)
+        scale = 2.0**(exponent+cls.lowest-1)
+        low,high = scale*(1+float(step)/cls.steps),scale*(1+float(step+1)/cls.steps)
+        if i == 0: low = 0.0
+        return (low,high)
+
+    def merge(self,*others):
+        "A new histogram with the calls from this one and others"
+        counts = list(self.counts)
+        total = self.total
+        for other in others:
+            counts = [a+b for a,b in zip(counts,other.counts)]
+            total += other.total
+        return LatencyHistogram(self.name,counts,total)
+
+    def __add__(self,other):
+        return self.merge(other)
+
+    @property
+    def count(self):
+        "How many calls"
+        return sum(self.counts)
+
+    @property
+    def mean(self):
+        "Average seconds per call"
+        return self.total/self.count if self.count else 0.0
+
+    def percentile(self,p):
+        "Upper bound (in seconds) on the time p percent of the calls beat"
+        needed = self.count*p/100.0
+        seen = 0
+        for i,n in enumerate(self.counts):
+            seen += n
+            if n and seen >= needed: return self.bounds(i)[1]
+        return 0.0
+
+    @property
+    def median(self):
+        return self.percentile(50)
+
+    @property
+    def p99(self):
+        return self.percentile(99)
+
+    def buckets(self):
+        "The (low,high,count) of each bucket that has calls in it"
+        return [self.bounds(i)+(n,) for i,n in enumerate(self.counts) if n]
+
+    def __str__(self):
+        lines = ['%s: %d calls, mean %.3g s, median < %.3g s, p99 < %.3g s'%(
+                self.name,self.count,self.mean,self.median,self.p99)]
+        for low,high,n in self.buckets():
+            lines.append('  %9.3g - %9.3g s %10d'%(low,high,n))
+        return '\n'.join(lines)
+
+class LatencyRecorder:
+    """Where a function timed by @measure_latency counts its calls
+
+    Each thread counts into its own fixed size array (no locks on
+    the way in), and snapshot() adds them up into a LatencyHistogram.
+    When a thread goes away, its counts are added into one array
+    kept for all the finished threads, so memory doesn't grow with
+    the number of threads that ever made a call.  reset() zeroes the
+    counts in place, so a call finishing on another thread at the
+    same moment may go uncounted"""
+
+    def __init__(self,name):
+        import array
+        self.name = name
+        self.__lock = threading.RLock()   # A thread can finish while we hold it
+        self.__live = {}   # weakref to each thread's holder -> its counts, with the total time on the end
+        self.__finished = array.array('d',[0.0])*(LatencyHistogram.size+1)
+        self.record = self.__recorder()
+        return
+
+    def __recorder(self):
+        "Build the record(seconds) function the timed code calls on its way out"
+        import array,math
+        local = threading.local()
+        lock = self.__lock
+        live = self.__live
+        finished = self.__finished
+        steps,size = LatencyHistogram.steps,LatencyHistogram.size
+        bias = -steps*(LatencyHistogram.lowest+1)
+
+        # The thread's local data goes when the thread does, taking the
+        # holder with it, and that's when we fold its counts in
+        class Holder(object): pass
+        def retire(ref):
+            with lock:
+                counts = live.pop(ref,None)
+                if counts is not None:
+                    for i,count in enumerate(counts): finished[i] += count
+            return
+
+        def record(seconds,frexp=math.frexp,local=local):
+            try:
+                counts = local.counts
+            except AttributeError:
+                counts = local.counts = array.array('d',[0.0])*(size+1)
+                local.holder = Holder()
+                with lock: live[weakref.ref(local.holder,retire)] = counts
+            # LatencyHistogram.bucket, but every call pays for this
+            i = 0
+            if seconds > 0:
+                mantissa,exponent = frexp(seconds)
+                i = exponent*steps+int(mantissa*2*steps)+bias
+            if 0 < i < size:
+                counts[i] += 1
+            else:
+                counts[0 if i <= 0 else size-1] += 1
+            counts[size] += seconds
+        return record
+
+    def threads(self):
+        "How many threads we are keeping counts for right now"
+        with self.__lock:
+            return len(self.__live)
+
+    def snapshot(self):
+        "The calls so far, from all threads, as a LatencyHistogram"
+        with self.__lock:
+            arrays = [self.__finished[:]]+[counts[:] for counts in self.__live.itervalues()]
+        histogram = LatencyHistogram(self.name)
+        for counts in arrays:
+            histogram = histogram.merge(LatencyHistogram(self.name,counts[:-1],counts[-1]))
+        return histogram
+
+    def reset(self):
+        "Forget the calls so far"
+        with self.__lock:
+            for counts in [self.__finished]+self.__live.values():
+                for i in xrange(len(counts)): counts[i] = 0
+        return
+
+def __measure_latency__(recorder,clock):
+    "A pass that times each call and hands the time to recorder.record"
+    def transform(code,f):
+        from byteplay import Label,LOAD_CONST,LOAD_FAST,STORE_FAST,CALL_FUNCTION, \
+            BINARY_SUBTRACT,POP_TOP,SETUP_FINALLY,POP_BLOCK,END_FINALLY,RETURN_VALUE,YIELD_VALUE
+        # Only f's own calls are timed, and a generator's "call" is
+        # everything between the yields, so we leave those alone
+        if code is not __recording__.top: return False
+        if [op for op,_ in code.code if op == YIELD_VALUE]: return False
+
+        # start = clock()
+        # try:
+        #     <body>
+        # finally:
+        #     record(clock()-start)
+        start = '__latency_start__'
+        finally_ = Label()
+        code.code[:0] = [
+            (LOAD_CONST,clock),(CALL_FUNCTION,0),(STORE_FAST,start),
+            (SETUP_FINALLY,finally_),
+            ]
+        code.code.extend([
+            (POP_BLOCK,None),
+            (LOAD_CONST,None),
+            (finally_,None),
+            (LOAD_CONST,recorder.record),
+            (LOAD_CONST,clock),(CALL_FUNCTION,0),(LOAD_FAST,start),(BINARY_SUBTRACT,None),
+            (CALL_FUNCTION,1),(POP_TOP,None),
+            (END_FINALLY,None),
+            (LOAD_CONST,None),(RETURN_VALUE,None),  # Never reached, but byteplay looks
+            ])
+        return True
+    return transform
+
+def measure_latency(f=None,name=None):
+    """Keep a latency histogram for every call to f
+
+    A profiler hook (sys.setprofile) runs on every call and return
+    in the program.  This puts the timing right in f's bytecode
+    instead, as if you had written
+
+    start = clock()
+    try:
+        <body>
+    finally:
+        record(clock()-start)
+
+    and record (see LatencyRecorder) just bumps a bucket in an array
+    for the calling thread.  Use it bare or with a name for the
+    histogram (default module.function):
+
+    @measure_latency
+    def f(x): ...
+
+    print f.latency.snapshot()
+
+    latency_histograms() has the histograms for everything timed
+    and reset_latencies() clears them.  Generators are left alone.
+    Put this outermost if you stack it with the other transforms,
+    so that it times what they made"""
+    if f is None: return lambda f: measure_latency(f,name)
+    if name is None: name = '%s.%s'%(f.__module__,f.__name__)
+    recorder = LatencyRecorder(name)
+    __transform_function__(f,[__measure_latency__(recorder,__best_clock__())])
+    f.latency = recorder
+    __latencies__[f] = recorder
+    return f
+
+def measure_local_latencies():
+    """A mass code object rewriter
+
+    @measure_latency on every function and method in the calling
+    module.  The histograms are named by dotted name, e.g.
+    mymodule.MyClass.method.  Call it after any other mass rewriters
+    so it times what they made"""
+    import inspect
+    frame = inspect.currentframe(1)
+    module = frame.f_globals.get('__name__')
+    for name,f in __module_functions__(frame.f_globals):
+        measure_latency(f,'%s.%s'%(module,name))
+    return
+
+def latency_histograms():
+    "A LatencyHistogram snapshot for each timed function, by name"
+    return dict( (recorder.name,recorder.snapshot()) for recorder in __latencies__.values() )
+
+def reset_latencies():
+    "Zero the histograms of all the timed functions"
+    for recorder in __latencies__.values():
+        recorder.reset()
+    return
+
+class BlockCounts:
+    """How many times each basic block of a function ran (see count_blocks)
+
+    counts is an array with a counter for each block, and lines the
+    source lines each block runs through (in order).  The counters are bumped
+    without a lock, so with several threads in the function the odd
+    count can get lost"""
+
+    def __init__(self,f,lines):
+        import array
+        self.name = '%s.%s'%(f.__module__,f.__name__)
+        self.filename = f.func_code.co_filename
+        self.original = f.func_code
+        self.lines = lines
+        self.counts = array.array('L',[0])*len(lines)
+        return
+
+    def by_line(self):
+        """The count for each line that starts a block, as {line:count}
+
+        A line that is in several blocks (a loop test, a conditional
+        expression) gets the biggest of their counts, which is how
+        many times the line ran"""
+        result = {}
+        for lines,n in zip(self.lines,self.counts):
+            for line in lines:
+                result[line] = max(n,result.get(line,0))
+        return result
+
+    def reset(self):
+        "Zero the counters"
+        for i in xrange(len(self.counts)): self.counts[i] = 0
+        return
+
+    def __str__(self):
+        "The function's source, with the counts down the side"
+        import linecache
+        counts = self.by_line()
+        first = min(counts) if counts else self.original.co_firstlineno
+        last = max(counts) if counts else first
+        result = [self.name]
+        for line in xrange(first,last+1):
+            text = linecache.getline(self.filename,line).rstrip()
+            count = '%10d'%counts[line] if line in counts else ' '*10
+            result.append('%s %5d  %s'%(count,line,text))
+        return '\n'.join(result)
+
+def __count_blocks__(code,f):
+    """A pass that bumps a counter at the top of each basic block of f's own code
+
+    The blocks start at the top, at each label, and after each
+    conditional jump.  The counters are in f.block_counts"""
+    from byteplay import Label,SetLineno,LOAD_CONST,DUP_TOPX,BINARY_SUBSCR, \
+        INPLACE_ADD,ROT_THREE,STORE_SUBSCR,POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE, \
+        JUMP_IF_FALSE_OR_POP,JUMP_IF_TRUE_OR_POP,FOR_ITER
+    if code is not __recording__.top: return False
+    branches = (POP_JUMP_IF_FALSE,POP_JUMP_IF_TRUE,JUMP_IF_FALSE_OR_POP,JUMP_IF_TRUE_OR_POP,FOR_ITER)
+
+    # Find where the blocks start (after any labels and line numbers
+    # right there, so the counter is on the right line) and the lines
+    # each one runs through
+    heads = []
+    lines = []
+    line = code.firstlineno
+    head = True
+    for pc,(op,arg) in enumerate(code.code):
+        if op == SetLineno:
+            line = arg
+            if lines and not head and line not in lines[-1]: lines[-1].append(line)
+        elif isinstance(op,Label):
+            head = True
+        else:
+            if head:
+                heads.append(pc)
+                lines.append([line])
+            head = op in branches
+
+    # counts[i] += 1 at each (working back so the offsets hold)
+    counts = BlockCounts(f,[tuple(x) for x in lines])
+    for i in reversed(xrange(len(heads))):
+        code.code[heads[i]:heads[i]] = [
+            (LOAD_CONST,counts.counts),(LOAD_CONST,i),(DUP_TOPX,2),(BINARY_SUBSCR,None),
+            (LOAD_CONST,1),(INPLACE_ADD,None),(ROT_THREE,None),(STORE_SUBSCR,None),
+            ]
+    f.block_counts = counts
+    return bool(heads)
+
+def count_blocks(f):
+    """Count how many times each basic block (and so each line) of f runs
+
+    sys.settrace calls back on every line of every function, which is
+    too slow to leave on anywhere that matters.  This writes a
+
+    counts[i] += 1
+
+    into f's bytecode at the top of each block instead, where counts
+    is an array made for f.  After a while, look at f.block_counts
+    (a BlockCounts: print it to see the source with the counts) and
+    take the counters back out with uncount_blocks(f).  Only f's own
+    code is counted, not the functions nested in it.  Works as a
+    decorator too:
+
+    @count_blocks
+    def f(x): ...
+    """
+    if hasattr(f,'block_counts'): return f
+    return __transform_function__(f,[__count_blocks__])
+
+def uncount_blocks(f):
+    """Take the counters count_blocks put in f back out
+
+    f gets back the code it had before count_blocks.  Returns the
+    BlockCounts, which keeps the counts it had (None if f wasn't
+    being counted)"""
+    counts = getattr(f,'block_counts',None)
+    if counts is None: return None
+    f.func_code = counts.original
+    del f.block_counts
+    return counts
+
+def __bake_arguments__(values):
+    "A pass that turns loads of the arguments in values (name -> value) into constants, then folds"
+    def transform(code,f):
+        from byteplay import LOAD_FAST,STORE_FAST,DELETE_FAST,LOAD_CONST
+        if code is not __recording__.top: return False
+
+        # An argument the body assigns to isn't a constant
+        instructions = code.code
+        assigned = set(arg for op,arg in instructions if op in (STORE_FAST,DELETE_FAST))
+        baked = False
+        for pc,(op,arg) in enumerate(instructions):
+            if op == LOAD_FAST and arg in values and arg not in assigned:
+                instructions[pc] = (LOAD_CONST,values[arg])
+                baked = True
+        if not baked: return False
+        __fold_constants__(code,f)
+        return True
+    return transform
+
+def __value_key__(value):
+    """What @specialize knows a value by, or None if it won't bake it in
+
+    Only the values __pure_constant__ likes are baked in:  anything
+    else (a namedtuple, an object with its own __eq__) could be equal
+    to the next one without acting the same, so it gets loaded as it
+    is.  Even equal constants can fold to different things:  3 and
+    3.0, 0.0 and -0.0, (3,) and (3.0,).  So we go by type as well as
+    value, all the way into tuples and frozensets, and by the sign of
+    zeros"""
+    from math import copysign
+    if not __pure_constant__(value): return None
+    kind = type(value)
+    if kind is float:
+        return (kind,value,copysign(1,value))
+    if kind is complex:
+        return (kind,value,copysign(1,value.real),copysign(1,value.imag))
+    if kind is tuple:
+        return (kind,tuple([__value_key__(x) for x in value]))
+    if kind is frozenset:
+        return (kind,frozenset([__value_key__(x) for x in value]))
+    return (kind,value)
+
+class Specializations:
+    """The variants @specialize has made of a function, least recently used first
+
+    There are at most maxsize of them.  hits, misses and evictions
+    count what happened on each call"""
+
+    def __init__(self,f,names,maxsize=32):
+        import collections
+        self.function = f
+        self.names = names
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self.__lock = threading.Lock()
+        self.__variants = collections.OrderedDict()
+        self.dispatch = self.__dispatcher()
+        return
+
+    def __dispatcher(self):
+        "Build the function that stands in for f:  it finds (or makes) the variant and calls it"
+        f = self.function
+        co = f.func_code
+        parameters = co.co_varnames[:co.co_argcount]
+        defaults = dict(zip(parameters[co.co_argcount-len(f.func_defaults or ()):],f.func_defaults or ()))
+        missing = object()
+        where = [(name,parameters.index(name),defaults.get(name,missing)) for name in self.names]
+        lock = self.__lock
+        variants = self.__variants
+        def dispatch(*args,**kwargs):
+            values = []
+            for name,i,default in where:
+                if name in kwargs:
+                    value = kwargs[name]
+                elif i < len(args):
+                    value = args[i]
+                elif default is missing:
+                    return f(*args,**kwargs)  # Let it complain
+                else:
+                    value = default
+                values.append(value)
+            key = tuple([__value_key__(value) for value in values])
+            if key.count(None) == len(key):
+                return f(*args,**kwargs)  # Nothing to bake in
+            with lock:
+                variant = variants.pop(key,None)
+                if variant is not None:
+                    variants[key] = variant
+                    self.hits += 1
+            if variant is None: variant = self.__make(key,values)
+            return variant(*args,**kwargs)
+        return dispatch
+
+    def __make(self,key,values):
+        "A new variant for values (the designated arguments', in order), known by key"
+        from types import FunctionType
+        f = self.function
+        values = dict( (name,value) for name,value,known in zip(self.names,values,key)
+                       if known is not None )
+        co = __transform_code__(f.func_code,[__bake_arguments__(values)],f)
+        variant = FunctionType(co,f.func_globals,f.__name__,f.func_defaults,f.func_closure)
+        with self.__lock:
+            self.misses += 1
+            if key in self.__variants: return self.__variants[key]  # Another thread beat us to it
+            self.__variants[key] = variant
+            while len(self.__variants) > self.maxsize:
+                self.__variants.popitem(last=False)
+                self.evictions += 1
+        return variant
+
+    def __len__(self):
+        return len(self.__variants)
+
+    def variants(self):
+        "The variants we have, least recently used first"
+        with self.__lock:
+            return self.__variants.values()
+
+    def info(self):
+        "The counts so far, as a dictionary"
+        with self.__lock:
+            return {'hits':self.hits,'misses':self.misses,'evictions':self.evictions,
+                    'maxsize':self.maxsize,'size':len(self.__variants)}
+
+    def clear(self):
+        "Throw away all the variants, and the counts"
+        with self.__lock:
+            self.__variants.clear()
+            self.hits = self.misses = self.evictions = 0
+        return
+
+def specialize(*names,**options):
+    """A decorator that compiles f for the values of some of its arguments
+
+    Functions are often called with a handful of recurring settings:
+
+    @specialize('schema','strict')
+    def encode(record,schema=DEFAULT,strict=False):
+        if strict: ...
+
+    Each call looks up a variant of encode made for its schema and
+    strict (by type and value, all the way into tuples, so 3 and 3.0
+    or 0.0 and -0.0 get variants of their own).  On a miss, we make
+    one by loading those arguments as constants and folding (see
+    @fold_constants), so "if strict:" is decided once.  Only numbers,
+    strings, None and tuples or frozensets of those are baked in:
+    other values are passed along as usual (if none of them can be,
+    we call the original).  Arguments the body assigns to are left
+    alone.  The maxsize
+    (default 32) most recently used variants are kept:
+
+    @specialize('mode',maxsize=4)
+    def g(x,mode): ...
+
+    The function we return has cache_info() (hits, misses, evictions,
+    maxsize and size) and cache_clear(), the original function as
+    generic, and the Specializations itself as specializations.
+    Each call pays for the lookup, so this only wins when the folding
+    saves more than that.  Later changes to the original function's
+    code aren't seen by the variants we have"""
+    maxsize = options.pop('maxsize',32)
+    if options: raise TypeError('unexpected options %s'%', '.join(sorted(options)))
+    def decorator(f):
+        co = f.func_code
+        unknown = [name for name in names if name not in co.co_varnames[:co.co_argcount]]
+        if unknown: raise ValueError('%s has no argument %s'%(f.__name__,', '.join(unknown)))
+        specializations = Specializations(f,names,maxsize)
+        dispatch = specializations.dispatch
+        for attr in ('__module__','__name__','__doc__'):
+            setattr(dispatch,attr,getattr(f,attr))
+        dispatch.generic = f
+        dispatch.specializations = specializations
+        dispatch.cache_info = specializations.info
+        dispatch.cache_clear = specializations.clear
+        return dispatch
+    return decorator
@@ -35,6 +35,91 @@ class TestToys(unittest.TestCase):
         self.assertEquals(out.read(),'')
         return
 
+    def test_unlog(self):
+        from bytecode_toys import unlog,refresh_logging
+        import logging
+        global LOG
+        LOG = logging.getLogger('bytecode_toys.testing')
+        LOG.addHandler(logging.NullHandler())
+        LOG.propagate = False
+        LOG.setLevel(logging.INFO)
+        calls = []
+        def expensive(x):
+            calls.append(x)
+            return x
+
+        @unlog
+        def f(x):
+            LOG.debug('value is %s' % expensive(x))
+            LOG.info('kept %s',expensive(x+1))
+            LOG.debug('%s and %s',x,x if x else expensive(x),extra={'y':x})
+            return x
+        try:
+            self.assertEquals(f(1),1)
+            self.assertEquals(calls,[2])
+            self.assertFalse( 'debug' in f.func_code.co_names )
+            self.assertTrue( 'info' in f.func_code.co_names )
+
+            # The calls come back when the level changes
+            LOG.setLevel(logging.DEBUG)
+            refresh_logging()
+            del calls[:]
+            self.assertEquals(f(1),1)
+            self.assertEquals(calls,[1,2])
+            self.assertTrue( 'debug' in f.func_code.co_names )
+        finally:
+            LOG.setLevel(logging.NOTSET)
+        return
+
+    def test_stack_levels(self):
+        from bytecode_toys import StackLevels,unprint,debuggable
+        from byteplay import Code,PRINT_ITEM
+        import sys,StringIO
+        def f(a,b,c):
+            print a if c else b
+            return a
+        code = Code.from_code(f.func_code)
+        levels = StackLevels(code.code)
+        self.assertEquals(len(levels),len(code.code))
+        pc = [op for op,arg in code.code].index(PRINT_ITEM)
+        self.assertEquals(levels[pc],0)
+
+        # The conditional expression is all part of what gets printed
+        start = levels.expression_start(pc)
+        self.assertEquals(code.code[start],(code.code[start][0],'c'))
+
+        f = unprint(f)
+        save = sys.stdout
+        out = StringIO.StringIO()
+        try:
+            sys.stdout = out
+            self.assertEquals(f(1,2,3),1)
+        finally:
+            sys.stdout = save
+        self.assertEquals(out.getvalue(),'')
+
+        @debuggable
+        def g(x):
+            DEBUG()
+            DEBUG(x,1 if x else 2)
+            DEBUG(1 if x else 2)
+            DEBUG(x and x.bit_length(),x)
+            return x
+        self.assertEquals(g(5),5)
+        self.assertFalse( 'DEBUG' in g.func_code.co_names )
+
+        # Unless the value gets used
+        @debuggable
+        def h(x):
+            return DEBUG(x if x else 2)
+        self.assertTrue( 'DEBUG' in h.func_code.co_names )
+        @debuggable
+        def k(x):
+            DEBUG(x if x else 2)(x)
+            return x
+        self.assertTrue( 'DEBUG' in k.func_code.co_names )
+        return
+
     def test_smartdebug(self):
         from bytecode_toys import smartdebug
         global DEBUG
@@ -54,6 +139,50 @@ class TestToys(unittest.TestCase):
             return x
         self.assertEquals(f(0),10)
         self.assertEquals(g(0),0)
+
+        # Any object will do, by its truth
+        class Switch(object):
+            def __nonzero__(self): return False
+        DEBUG = Switch()
+        @smartdebug
+        def h(x):
+            if DEBUG:
+                x = 10
+            if not DEBUG:
+                x += 1
+            return x
+        self.assertEquals(h(0),1)
+        self.assertFalse( DEBUG in h.func_code.co_consts )
+        self.assertFalse( 10 in h.func_code.co_consts )
+        return
+
+    def test_specialize_flags(self):
+        from bytecode_toys import specialize_flags
+        global FEATURE_A,FEATURE_B,MODE
+        FEATURE_A,FEATURE_B,MODE = True,False,'slow'
+
+        @specialize_flags('FEATURE_A','FEATURE_B','MODE')
+        def f(xs):
+            total = 0
+            for x in xs:
+                if FEATURE_B:
+                    total -= x
+                elif MODE == 'fast' or not FEATURE_A:
+                    total += 2*x
+                else:
+                    total += x
+            return total
+        self.assertEquals(f([1,2,3]),6)
+        for name in ('FEATURE_A','FEATURE_B','MODE'):
+            self.assertFalse( name in f.func_code.co_names )
+        self.assertFalse( 'fast' in f.func_code.co_consts )
+
+        # Or pick them by name
+        @specialize_flags(lambda name: name.startswith('FEATURE_'))
+        def g():
+            return FEATURE_A and not FEATURE_B and MODE
+        self.assertEquals(g(),'slow')
+        self.assertEquals(g.func_code.co_names,('MODE',))
         return
 
     def test_cache_globals(self):
@@ -78,6 +207,856 @@ class TestToys(unittest.TestCase):
         self.assertTrue( 'sin' in g.func_code.co_names )
         self.assertTrue( 'pi' in g.func_code.co_names )
 
+        # Attributes of locals are left alone
+        @cache_globals
+        def h(s):
+            return s.upper()
+        self.assertEquals(h('hello'),'HELLO')
+        return
+
+    def test_guarded_cache_globals(self):
+        from bytecode_toys import guarded_cache_globals
+        global SCALE
+        SCALE = 2
+
+        @guarded_cache_globals
+        def f(x):
+            return SCALE*math.floor(x)
+        fast = f.func_code
+        self.assertTrue( math.floor in fast.co_consts )
+        self.assertEquals(f(1.5),2.0)
+        self.assertTrue( f.func_code is fast )
+
+        # Rebinding a global falls back to the original code, and
+        # this call already sees the new value
+        SCALE = 3
+        self.assertEquals(f(1.5),3.0)
+        self.assertFalse( f.func_code is fast )
+        self.assertFalse( math.floor in f.func_code.co_consts )
+
+        # So does patching a module attribute
+        @guarded_cache_globals(respecialize=True)
+        def g(x):
+            y = math.floor(x)
+            return SCALE*y
+        self.assertEquals(g(1.5),3.0)
+        floor = math.floor
+        try:
+            math.floor = math.ceil
+            self.assertEquals(g(1.5),6.0)
+            self.assertTrue( math.ceil in g.func_code.co_consts )
+        finally:
+            math.floor = floor
+        self.assertEquals(g(1.5),3.0)
+        return
+
+    def test_fold_constants(self):
+        from bytecode_toys import pipeline,cache_globals,fold_constants
+        from byteplay import Code,COMPARE_OP,BINARY_MULTIPLY
+        global SCALE
+        SCALE = 2
+
+        @pipeline(cache_globals,fold_constants)
+        def f(x):
+            if SCALE > 1:
+                return x*(math.pi*SCALE)
+            print 'never'
+            return x
+        self.assertEquals(f(1),2*math.pi)
+        self.assertTrue( 2*math.pi in f.func_code.co_consts )
+        self.assertFalse( 'never' in f.func_code.co_consts )
+        self.assertFalse( math in f.func_code.co_consts )
+        ops = [op for op,arg in Code.from_code(f.func_code).code]
+        self.assertFalse( COMPARE_OP in ops )
+        self.assertEquals(ops.count(BINARY_MULTIPLY),1)
+
+        # Errors still happen when the code runs
+        @pipeline(cache_globals,fold_constants)
+        def g(x):
+            if x: return SCALE/(SCALE-2)
+            return x
+        self.assertEquals(g(0),0)
+        self.assertRaises(ZeroDivisionError,g,1)
+        return
+
+    def test_hoist_attributes(self):
+        from bytecode_toys import hoist_attributes
+        import StringIO
+        class Counter(object):
+            def __init__(self):
+                self.pos = 0
+                self.seen = []
+            def advance(self):
+                self.pos += 1
+
+        @hoist_attributes
+        def f(counter,xs,out,log=None):
+            for x in xs:
+                out.append(x)
+                counter.seen.append(x)
+                if log is not None: log.append(x)
+                if x < 0: break
+            else:
+                out.append('done')
+            while counter.pos < 3:
+                counter.advance()
+            return out
+        names = f.func_code.co_varnames
+        self.assertTrue( '__hoisted_0__' in names )
+
+        c = Counter()
+        self.assertEquals(f(c,[1,2],[]),[1,2,'done'])
+        self.assertEquals(c.seen,[1,2])
+        self.assertEquals(c.pos,3)  # counter.pos is read every time round
+
+        # log.append fails up front, so that loop runs as written
+        log = []
+        self.assertEquals(f(Counter(),[1,-1,2],[],log),[1,-1])
+        self.assertEquals(log,[1,-1])
+        self.assertEquals(f(Counter(),[],[]),['done'])
+
+        # Anything stored to in the loop (or excluded) stays put, and
+        # so does anything on a local the loop does something else with
+        @hoist_attributes(exclude=['extend'])
+        def g(items,out,more,sink,swap):
+            for x in items:
+                out.append(x)
+                more.extend([x])
+                sink.write(x)
+                sink.write = sink.write
+                swap.buf.append(x)
+                reset(swap)
+            return out
+        def reset(holder): holder.buf = []
+        sink = StringIO.StringIO()
+        swap = Counter()
+        swap.buf = []
+        more = []
+        self.assertEquals(g([1,2],[],more,sink,swap),[1,2])
+        self.assertEquals(more,[1,2])
+        self.assertEquals(sink.getvalue(),'12')
+        self.assertEquals(swap.buf,[])
+        names = g.func_code.co_varnames
+        self.assertTrue( '__hoisted_0__' in names )
+        self.assertFalse( '__hoisted_1__' in names )
+
+        # Nor can a method on the same local
+        class Holder(object):
+            def __init__(self): self.buf = []
+            def reset(self): self.buf = []
+        @hoist_attributes
+        def k(holder,items):
+            seen = []
+            for x in items:
+                holder.buf.append(x)
+                seen.append(holder.buf)
+                holder.reset()
+            return seen
+        self.assertEquals(k(Holder(),[1,2,3]),[[1],[2],[3]])
+
+        # Nothing is looked up unless we go round at least once
+        class Lazy(object):
+            looked = 0
+            @property
+            def out(self):
+                Lazy.looked += 1
+                return []
+        @hoist_attributes
+        def h(lazy,xs):
+            for x in xs:
+                lazy.out.append(x)
+            return Lazy.looked
+        self.assertEquals(h(Lazy(),[]),0)
+        self.assertEquals(h(Lazy(),[1,2,3]),1)
+        return
+
+    def test_reuse_attributes(self):
+        from bytecode_toys import reuse_attributes
+        from byteplay import Code,LOAD_ATTR
+        class Thing(object): pass
+        @reuse_attributes
+        def f(self,n):
+            total = self.state.counters.a + self.state.counters.b*n
+            self.state.counters.a = total    # stores start over
+            return self.state.counters.a - self.state.counters.b
+        loads = [arg for op,arg in Code.from_code(f.func_code).code if op == LOAD_ATTR]
+        self.assertEquals(loads.count('counters'),3)   # Once a line
+
+        obj = Thing()
+        obj.state = Thing()
+        obj.state.counters = Thing()
+        obj.state.counters.a,obj.state.counters.b = 1,2
+        self.assertEquals(f(obj,3),5)
+        self.assertEquals(obj.state.counters.a,7)
+
+        # Calls could change anything
+        @reuse_attributes
+        def g(self):
+            self.state.bump()
+            return self.state.value
+        self.assertEquals(g.func_code.co_varnames,('self',))
+
+        # and so could operators
+        class Adder(object):
+            def __add__(self,n):
+                self.state = Thing()
+                return n
+        @reuse_attributes
+        def k(q):
+            a = q.state.value
+            b = q+1
+            return q.state
+        q = Adder()
+        q.state = Thing()
+        q.state.value = 1
+        self.assertTrue( k(q) is q.state )
+
+        # So does assigning the local
+        @reuse_attributes
+        def h(a,b):
+            x = a.state.value
+            a = b
+            return x,a.state.value
+        one,two = Thing(),Thing()
+        one.state,two.state = Thing(),Thing()
+        one.state.value,two.state.value = 1,2
+        self.assertEquals(h(one,two),(1,2))
+        return
+
+    def test_inline_calls(self):
+        from bytecode_toys import inline_calls,cache_globals
+        global helper,pick,spread,countdown,maybe
+        def helper(x): return x+1
+        def pick(a,b=10):
+            if a > b: return a
+            return b
+        def spread(*args): return len(args)
+        def countdown(n): return countdown(n-1) if n else 0
+        def maybe(flag):
+            if flag: v = 1
+            return v
+
+        @inline_calls
+        @cache_globals
+        def f(y):
+            return helper(y*2)+pick(y)+pick(y,1)+helper(helper(y))+spread(1,2)+countdown(2)
+        self.assertEquals(f(3),7+10+3+5+2+0)
+        self.assertTrue( 'helper.x' in f.func_code.co_varnames )
+        self.assertTrue( 'pick.b' in f.func_code.co_varnames )
+        self.assertFalse( helper in f.func_code.co_consts )
+        self.assertFalse( pick in f.func_code.co_consts )
+        self.assertTrue( spread in f.func_code.co_consts )     # *args
+        self.assertTrue( countdown in f.func_code.co_consts )  # recursive
+
+        # v would still be there from the last time round
+        @inline_calls
+        @cache_globals
+        def loop():
+            return [maybe(flag) for flag in (True,False)]
+        self.assertRaises(UnboundLocalError,loop)
+        self.assertTrue( maybe in loop.func_code.co_consts )
+
+        # Nothing gets bigger than the budget allows
+        @inline_calls(budget=10)
+        @cache_globals
+        def g(y):
+            return pick(y)+pick(y)
+        self.assertEquals(g(1),20)
+        self.assertEquals(g.func_code.co_consts.count(pick),1)
+        return
+
+    def test_tail_calls(self):
+        from bytecode_toys import tail_calls,cache_globals
+        from byteplay import Code,COMPARE_OP
+        global walk,total,even
+        @tail_calls
+        def walk(n,depth=0):
+            if n == 0: return depth
+            return walk(n-1,depth+1)
+        self.assertEquals(walk(100000),100000)   # way past the recursion limit
+
+        # Not a tail call, so it still recurses
+        @tail_calls
+        def total(n):
+            return n+total(n-1) if n else 0
+        self.assertEquals(total(10),55)
+        self.assertFalse( '__tail_0__' in total.func_code.co_varnames )
+
+        # If the name is rebound, we make the real call
+        calls = []
+        def wrapper(n,depth=0):
+            calls.append(n)
+            return original(n,depth)
+        original,walk = walk,wrapper
+        self.assertEquals(walk(3),3)
+        self.assertEquals(calls,[3,2,1,0])
+
+        # Once cache_globals has made it a constant, there's nothing to check
+        def even(n,answer=True):
+            if n == 0: return answer
+            return even(n-1,not answer)
+        tail_calls(cache_globals(even))
+        self.assertTrue(even(50000))
+        code = Code.from_code(even.func_code).code
+        self.assertFalse( (COMPARE_OP,'is') in code )
+        return
+
+    def test_unroll_loops(self):
+        from bytecode_toys import unroll_loops,cache_globals
+        from byteplay import Code,FOR_ITER
+        global SIZE
+        SIZE = 3
+        def trace(m):
+            total = 0
+            for i in range(SIZE):
+                total += m[i][i]
+            return total
+        trace = unroll_loops(cache_globals(trace))
+        self.assertEquals(trace([[1,2,3],[4,5,6],[7,8,9]]),15)
+        code = Code.from_code(trace.func_code).code
+        self.assertFalse( FOR_ITER in [op for op,_ in code] )
+
+        # break, continue, else, and the loop variable afterwards
+        @unroll_loops
+        def f(x):
+            out = []
+            for i in (1,2,3,4):
+                if i == 2: continue
+                if i == x: break
+                out.append(i)
+            else:
+                out.append('else')
+            return out,i
+        self.assertEquals(f(0),([1,3,4,'else'],4))
+        self.assertEquals(f(3),([1],3))
+
+        # Too big, or not a constant, and we leave it alone
+        @unroll_loops
+        def g(n):
+            total = 0
+            for i in xrange(1000): total += i
+            for i in range(n): total += i
+            for i in xrange(10**12): break   # Not even made
+            return total
+        self.assertEquals(g(4),499506)
+        code = Code.from_code(g.func_code).code
+        self.assertEquals([op for op,_ in code].count(FOR_ITER),3)
+        return
+
+    def test_specialize(self):
+        from bytecode_toys import specialize
+        from byteplay import Code,POP_JUMP_IF_FALSE
+        @specialize('strict','scale',maxsize=2)
+        def encode(record,strict=False,scale=1):
+            if strict:
+                if record < 0: raise ValueError(record)
+            return record*scale
+        self.assertEquals(encode(3),3)
+        self.assertEquals(encode(3),3)
+        self.assertEquals(encode(-3,scale=2),-6)
+        self.assertRaises(ValueError,encode,-3,True)
+        self.assertEquals(encode(-3,scale=2),-6)
+        self.assertEquals(encode.cache_info(),
+                          {'hits':2,'misses':3,'evictions':1,'maxsize':2,'size':2})
+        self.assertEquals(encode.__name__,'encode')
+
+        # The test on strict is gone from the variant that isn't strict
+        variant = encode.specializations.variants()[-1]
+        self.assertFalse( POP_JUMP_IF_FALSE in [op for op,_ in Code.from_code(variant.func_code).code] )
+        encode.cache_clear()
+        self.assertEquals(encode.cache_info()['size'],0)
+
+        # Equal isn't enough:  types, all the way down, and signs of zero
+        @specialize('t')
+        def half(t): return t[0]/2
+        self.assertEquals(half((3,)),1)
+        self.assertEquals(half((3.0,)),1.5)
+        @specialize('x')
+        def sign(x): return math.copysign(1,x)
+        self.assertEquals(sign(0.0),1.0)
+        self.assertEquals(sign(-0.0),-1.0)
+
+        # Other values are passed along, not baked in
+        self.assertEquals(encode(2,scale=[1]),[1,1])
+        self.assertEquals(encode(2,scale=[2]),[2,2])
+        class P(object):
+            def __init__(self,x): self.x = x
+            def __eq__(self,other): return isinstance(other,P)
+            def __hash__(self): return 0
+        @specialize('k','p')
+        def ratio(k,p): return k/p.x
+        self.assertEquals(ratio(1,P(1.0)),1.0)
+        self.assertEquals(ratio(1,P(2.0)),0.5)
+        self.assertEquals(ratio.cache_info()['misses'],1)
+        @specialize('p')
+        def scaled(p): return p.x
+        self.assertEquals(scaled(P(3)),3)
+        self.assertEquals(scaled.cache_info()['misses'],0)
+        self.assertRaises(ValueError,specialize('nope'),encode.generic)
+        return
+
+    def test_pipeline(self):
+        from bytecode_toys import pipeline,cache_globals,smartdebug,unprint
+        from types import CodeType
+        import sys,StringIO
+        global DEBUG
+        DEBUG = False
+
+        def f(x):
+            if DEBUG:
+                x = 10
+            print x
+            def g(y):
+                return y
+            return math.sin(x),g
+        nested = [k for k in f.func_code.co_consts if isinstance(k,CodeType)]
+
+        f = pipeline(smartdebug,unprint,cache_globals)(f)
+        save = sys.stdout
+        out = StringIO.StringIO()
+        try:
+            sys.stdout = out
+            value,g = f(0)
+        finally:
+            sys.stdout = save
+        self.assertEquals(out.getvalue(),'')
+        self.assertEquals(value,0.0)
+        self.assertEquals(g(3),3)
+        self.assertTrue( math.sin in f.func_code.co_consts )
+
+        # The nested function didn't need any work, so it is reused
+        self.assertTrue( g.func_code is nested[0] )
+        return
+
+    def test_tiered(self):
+        from bytecode_toys import tiered,cache_globals,smartdebug,OptimizingImporter
+        import imp,threading,logging,logging.handlers
+        global DEBUG
+        DEBUG = False
+
+        @tiered(smartdebug,cache_globals,threshold=3)
+        def f(x):
+            if DEBUG: x = 10
+            return math.floor(x)
+        stub = f.func_code
+        self.assertEquals([f(1.5),f(2.5)],[1.0,2.0])
+        self.assertTrue( f.func_code is stub )
+        self.assertEquals(f(3.5),3.0)       # This one did the work
+        self.assertFalse( f.func_code is stub )
+        self.assertTrue( math.floor in f.func_code.co_consts )
+        self.assertFalse( 'DEBUG' in f.func_code.co_names )
+
+        # Lots of threads crossing the threshold, one rewrite
+        rewrites = []
+        def counted(code,f):
+            rewrites.append(f)
+            return cache_globals.bytecode_pass(code,f)
+        @tiered(counted,threshold=50)
+        def g(): return math.pi
+        threads = [threading.Thread(target=lambda: [g() for _ in xrange(200)]) for _ in xrange(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEquals(rewrites,[g])
+        self.assertTrue( math.pi in g.func_code.co_consts )
+
+        # A pass that fails is logged, and the call that hit the
+        # threshold (and the ones after) still run the original
+        def broken(code,f): raise RuntimeError('pass blew up')
+        @tiered(broken,threshold=2)
+        def k(): return 7
+        stub = k.func_code
+        logger = logging.getLogger('bytecode_toys')
+        handler = logging.handlers.BufferingHandler(10)
+        logger.addHandler(handler)
+        propagate,logger.propagate = logger.propagate,False
+        try:
+            self.assertEquals([k(),k(),k()],[7,7,7])
+        finally:
+            logger.removeHandler(handler)
+            logger.propagate = propagate
+        self.assertEquals(len(handler.buffer),1)
+        self.assertTrue( 'k' in handler.buffer[0].getMessage() )
+        self.assertFalse( k.func_code is stub )
+
+        # The importer's threshold
+        module = imp.new_module('tiered_toy')
+        exec 'import math\ndef h(x): return math.floor(x)\n' in module.__dict__
+        OptimizingImporter([],threshold=2).optimize(module)
+        module.h(1)
+        self.assertFalse( math in module.h.func_code.co_consts )
+        module.h(1)
+        self.assertTrue( math in module.h.func_code.co_consts )
+        return
+
+    def test_code_cache(self):
+        from bytecode_toys import enable_code_cache,disable_code_cache,cache_globals
+        from types import FunctionType
+        import os,shutil,tempfile
+        root = tempfile.mkdtemp()
+        try:
+            cache = enable_code_cache(root)
+            def f(x):
+                return math.floor(x)*len(x.__class__.__name__)
+            original = f.func_code
+            cache_globals(f)
+            self.assertEquals(len(os.listdir(root)),1)
+            self.assertEquals(f(2.5),10.0)
+
+            # The same code with other globals comes back from the
+            # cache, with its folds looked up in the new globals
+            class fake:
+                floor = staticmethod(math.ceil)
+            g = cache_globals(FunctionType(original,{'math':fake}))
+            self.assertEquals((cache.hits,cache.misses),(1,1))
+            self.assertEquals(g(2.5),15.0)
+            self.assertTrue( fake.floor in g.func_code.co_consts )
+
+            # Entries past the size limit are evicted
+            cache.max_bytes = 0
+            cache.evict()
+            self.assertEquals(os.listdir(root),[])
+        finally:
+            disable_code_cache()
+            shutil.rmtree(root)
+        return
+
+    def test_mass_rewriters(self):
+        source = 'import math\n' \
+                 'def helper(x): return x+1\n' \
+                 'def make(n):\n' \
+                 '    def add(x): return helper(x)+n\n' \
+                 '    return add\n' \
+                 'add3 = make(3)\n' \
+                 'def counter():\n' \
+                 '    n = 1\n' \
+                 '    def get(): return n\n' \
+                 '    yield get\n' \
+                 '    n = 2\n' \
+                 '    yield get\n' \
+                 'running = counter()\n' \
+                 'get = next(running)\n' \
+                 'class Shape(object):\n' \
+                 '    def area(self): return helper(1)*math.pi\n' \
+                 '    @staticmethod\n' \
+                 '    def s(x): return helper(x)\n' \
+                 '    @classmethod\n' \
+                 '    def c(cls,x): return helper(x)\n' \
+                 '    @property\n' \
+                 '    def p(self): return helper(0)\n'
+        namespace = {'__name__':'toymodule'}
+        exec source in namespace
+        exec 'from bytecode_toys import make_local_functions_constant\n' \
+             'counts = make_local_functions_constant()' in namespace
+        counts = namespace['counts']
+        Shape = namespace['Shape']
+
+        self.assertEquals(counts['add3'],2)
+        self.assertEquals(counts['make'],1)
+        self.assertEquals(counts['helper'],0)
+        for name in ('Shape.area','Shape.s','Shape.c','Shape.p'):
+            self.assertEquals(counts[name],1)
+        self.assertEquals(Shape().area(),2*math.pi)
+        self.assertEquals((Shape.s(1),Shape.c(1),Shape().p),(2,2,1))
+        self.assertFalse( 'helper' in Shape.__dict__['s'].__func__.func_code.co_names )
+
+        # The closure variable is folded, and so is helper in the
+        # functions make will make from now on
+        add3 = namespace['add3']
+        self.assertEquals(add3(1),5)
+        self.assertTrue( 3 in add3.func_code.co_consts )
+        self.assertFalse( 'helper' in namespace['make'](4).func_code.co_names )
+
+        # counter() can still rebind n, so get() has to keep looking
+        self.assertEquals(counts['get'],0)
+        next(namespace['running'])
+        self.assertEquals(namespace['get'](),2)
+        return
+
+    def test_lookup_report(self):
+        from bytecode_toys import lookup_report,measure_lookup_costs
+        import imp,json,StringIO
+        module = imp.new_module('toyreport')
+        exec 'import math\n' \
+             'DEBUG = False\n' \
+             'def f(x):\n' \
+             '    if DEBUG: print x\n' \
+             '    DEBUG(x)\n' \
+             '    print x,\n' \
+             '    return math.sin(x)+len(x)\n' in vars(module)
+        original = module.f.func_code
+        out = StringIO.StringIO()
+        report = lookup_report(module,out=out)
+        self.assertTrue( module.f.func_code is original )
+
+        counts = report['functions']['toyreport.f']
+        self.assertEquals(counts['globals'],4)
+        self.assertEquals(counts['attributes'],1)
+        self.assertEquals(counts['debug_branches'],1)
+        self.assertEquals(counts['debug_calls'],1)
+        self.assertEquals(counts['prints'],3)
+        self.assertTrue( counts['estimated_ns'] > 0 )
+        self.assertEquals(json.loads(out.getvalue())['totals']['globals'],4)
+
+        # Costs measured here have the same keys, and don't go negative
+        costs = measure_lookup_costs(target=0.0005)
+        self.assertEquals(sorted(costs),sorted(report['costs']))
+        for cost in costs.itervalues(): self.assertTrue( cost >= 0 )
+        report = lookup_report(module,costs=costs)
+        self.assertEquals(report['costs'],costs)
+        return
+
+    def test_benchmarks(self):
+        import benchmarks
+        from bytecode_toys import smartdebug
+        results = benchmarks.run(['numeric_loop','debug_laden'],
+                                 ['cache_globals','debuggable'],
+                                 trials=3,target=0.0005)
+        self.assertEquals(sorted(results),
+                          ['debug_laden/cache_globals','debug_laden/debuggable',
+                           'numeric_loop/cache_globals','numeric_loop/debuggable'])
+        for result in results.values():
+            self.assertTrue( result['baseline'] > 0 )
+            self.assertTrue( result['transformed'] > 0 )
+
+        # The suite works on copies, never on the benchmarks module itself
+        self.assertTrue( 'math' in benchmarks.numeric_loop.func_code.co_names )
+
+        # smartdebug really strips debug_laden's tests, and we'd know if it didn't
+        module = benchmarks.__fresh__('check')
+        self.assertTrue( benchmarks.__no_debug_tests__(module) )
+        smartdebug(module.debug_laden)
+        self.assertEquals(benchmarks.__no_debug_tests__(module),None)
+        self.assertEquals(module.debug_laden(),benchmarks.debug_laden())
+        self.assertRaises(RuntimeError,benchmarks.run,['debug_laden'],['cache_globals'],1,0.0005,
+                          {'debug_laden/cache_globals':benchmarks.__no_debug_tests__})
+
+        # Regressions are against the baseline's speedup...
+        baseline = {'numeric_loop/cache_globals':{'speedup':1.5}}
+        now = {'numeric_loop/cache_globals':{'speedup':1.2,'pvalue':0.5}}
+        self.assertEquals(list(benchmarks.regressions(now,baseline,tolerance=0.1)),
+                          ['numeric_loop/cache_globals'])
+        self.assertEquals(benchmarks.regressions(now,baseline,tolerance=0.25),{})
+
+        # ... or against not transforming at all
+        now['numeric_loop/cache_globals'] = {'speedup':0.8,'pvalue':0.01}
+        self.assertEquals(list(benchmarks.regressions(now)),['numeric_loop/cache_globals'])
+        return
+
+    def test_optimizer(self):
+        from bytecode_toys import install_optimizer,uninstall_optimizer
+        import os,sys,shutil,tempfile,StringIO
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(root,'toypkg','skip'))
+            for name in ('__init__.py','skip/__init__.py'):
+                open(os.path.join(root,'toypkg',name),'w').close()
+            source = 'import math\n' \
+                     'def helper(x): return x+1\n' \
+                     'def f(x):\n' \
+                     '    DEBUG(x)\n' \
+                     '    print x\n' \
+                     '    return helper(math.floor(x))\n'
+            for name in ('toypkg/mod.py','toypkg/skip/mod.py'):
+                with open(os.path.join(root,name),'w') as out:
+                    out.write(source)
+
+            sys.path.insert(0,root)
+            importer = install_optimizer(['toypkg'],deny=['toypkg.skip'])
+            try:
+                from toypkg import mod
+                from toypkg.skip import mod as skipped
+            finally:
+                uninstall_optimizer(importer)
+                sys.path.remove(root)
+            self.assertFalse( importer in sys.meta_path )
+
+            save = sys.stdout
+            out = StringIO.StringIO()
+            try:
+                sys.stdout = out
+                self.assertEquals(mod.f(1.5),2.0)
+            finally:
+                sys.stdout = save
+            self.assertEquals(out.getvalue(),'')
+            self.assertTrue( mod.__loader__ is importer )
+            self.assertTrue( mod.helper in mod.f.func_code.co_consts )
+            self.assertTrue( math in mod.f.func_code.co_consts )
+            self.assertFalse( 'DEBUG' in mod.f.func_code.co_names )
+            self.assertTrue( 'helper' in skipped.f.func_code.co_names )
+        finally:
+            for name in ('toypkg','toypkg.mod','toypkg.skip','toypkg.skip.mod'):
+                sys.modules.pop(name,None)
+            shutil.rmtree(root)
+        return
+
+    def test_measure_latency(self):
+        from bytecode_toys import measure_latency,latency_histograms,reset_latencies,LatencyHistogram
+        import threading
+        @measure_latency
+        def f(x):
+            if x < 0: raise ValueError(x)
+            return 2*x
+        self.assertEquals(f(2),4)
+        self.assertRaises(ValueError,f,-1)
+        workers = [threading.Thread(target=lambda: [f(i) for i in xrange(100)])
+                   for _ in xrange(4)]
+        for t in workers: t.start()
+        for t in workers: t.join()
+
+        name = '%s.f'%__name__
+        histogram = latency_histograms()[name]
+        self.assertEquals(histogram.name,name)
+        self.assertEquals(histogram.count,402)
+        self.assertEquals(sum(n for _,_,n in histogram.buckets()),402)
+        self.assertTrue( histogram.total >= 0 )
+        self.assertTrue( histogram.percentile(50) <= histogram.percentile(99) )
+        self.assertEquals((histogram+histogram).count,804)
+
+        # Every time lands in the bucket that covers it
+        for seconds in (1e-12,1e-9,3e-6,0.25,1,1e5):
+            low,high = LatencyHistogram.bounds(LatencyHistogram.bucket(seconds))
+            self.assertTrue( low <= seconds < high )
+
+        reset_latencies()
+        self.assertEquals(f.latency.snapshot().count,0)
+        f(1)
+        self.assertEquals(f.latency.snapshot().count,1)
+
+        # Finished threads don't leave their arrays behind
+        for _ in xrange(20):
+            worker = threading.Thread(target=f,args=(1,))
+            worker.start()
+            worker.join()
+        self.assertEquals(f.latency.snapshot().count,21)
+        self.assertTrue( f.latency.threads() <= 2 )
+
+        # Generators are left alone
+        @measure_latency
+        def g(n):
+            for i in xrange(n): yield i
+        self.assertEquals(list(g(3)),[0,1,2])
+        self.assertEquals(g.latency.snapshot().count,0)
+        return
+
+    def test_count_blocks(self):
+        from bytecode_toys import count_blocks,uncount_blocks
+        def f(xs):
+            total = 0
+            for x in xs:
+                if x % 2:
+                    total += x
+                else:
+                    total -= 1
+            return total
+        original = f.func_code
+        first = original.co_firstlineno
+        count_blocks(f)
+        self.assertEquals(f(range(10)),20)
+        lines = f.block_counts.by_line()
+        self.assertEquals(lines[first+1],1)     # total = 0
+        self.assertEquals(lines[first+2],11)    # for x in xs
+        self.assertEquals(lines[first+3],10)    # if x % 2
+        self.assertEquals(lines[first+4],5)     # total += x
+        self.assertEquals(lines[first+6],5)     # total -= 1
+        self.assertEquals(lines[first+7],1)     # return total
+        self.assertTrue( 'for x in xs' in str(f.block_counts) )
+
+        f.block_counts.reset()
+        f([])
+        self.assertEquals(f.block_counts.by_line()[first+4],0)
+
+        # Taking them out puts the old code back
+        counts = uncount_blocks(f)
+        self.assertTrue( f.func_code is original )
+        self.assertFalse( hasattr(f,'block_counts') )
+        f(range(10))
+        self.assertEquals(counts.by_line()[first+2],1)
+        self.assertEquals(uncount_blocks(f),None)
+        return
+
+    def test_timer_trials(self):
+        from bytecode_toys import LittleTimer
+        b = 3
+        c = 4
+        with LittleTimer(100,trials=20) as T:
+            a = b*c
+
+        self.assertEquals(T.trials,20)
+        self.assertEquals(len(T.samples),20)
+        self.assertTrue( T.overhead >= 0 )
+        self.assertTrue( T.min <= T.median <= T.p90 <= T.p99 )
+        self.assertEquals( T.time, T.median )
+        self.assertTrue( T.stddev >= 0 )
+        self.assertTrue( T.time_errorbar > 0 )
+        return
+
+    def test_timer_auto(self):
+        from bytecode_toys import LittleTimer
+        b = 3
+        c = 4
+        with LittleTimer(None,target=0.01) as T:
+            a = b*c
+        self.assertTrue( T.n > 1 )
+        self.assertTrue( T.time > 0 )
+
+        # Past the unroll factor, we loop around blocks of copies
+        with LittleTimer(10007,unroll=100) as T:
+            a = b*c
+        self.assertEquals(T.n,10007)
+        self.assertEquals(T.unroll,100)
+        self.assertTrue( T.overhead > 0 )
+        return
+
+    def test_timer_compare(self):
+        from bytecode_toys import LittleTimer
+        def plain(x=3):
+            return x*2
+        def slower(x=3):
+            return [x*2 for i in xrange(20)]
+
+        C = LittleTimer.compare([plain,slower],n=100,trials=10)
+        self.assertEquals(C.labels,['plain','slower'])
+        self.assertEquals(C['slower'].trials,10)
+        self.assertEquals(C.speedup(0),1.0)
+        self.assertEquals(C.pvalue('plain'),1.0)
+        self.assertTrue( 0 <= C.pvalue('slower') <= 1 )
+        self.assertTrue( C.speedup('slower') > 0 )
+        self.assertTrue( 'slower' in str(C) )
+        return
+
+    def test_timer_memory(self):
+        from bytecode_toys import LittleTimer
+        keep = []
+        b = 3
+        with LittleTimer(500,memory=True) as T:
+            keep.append([b])
+        self.assertTrue( 0.9 < T.allocations < 1.1 )
+        self.assertTrue( T.retained_bytes > 0 )
+        self.assertEquals(len(T.collections),3)
+        self.assertTrue( T.collections[0] > T.collections[1] > 0 )
+
+        with LittleTimer(500,memory=True) as T:
+            c = b*2
+        self.assertTrue( T.allocations < 0.1 )
+        return
+
+    def test_timer_scaling(self):
+        from bytecode_toys import LittleTimer
+        import os
+        b = 3
+        with LittleTimer(100) as T:
+            c = b*2
+        S = T.scaling(2,trials=3)
+        self.assertEquals(S.workers,[1,2])
+        self.assertEquals(len(S.rates(2)),2)
+        self.assertTrue( S.throughput(1) > 0 )
+        self.assertEquals(S.efficiency(1),1.0)
+
+        # A worker that dies is reported, not waited on forever
+        parent = os.getpid()
+        with LittleTimer(10) as T:
+            if os.getpid() != parent: os._exit(3)
+        self.assertRaises(RuntimeError,T.scaling,2,trials=3)
         return
 
 